@@ -0,0 +1,32 @@
+import os
+import platform
+import subprocess
+
+# Root of the checkout the benchmarks run against
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Describes the machine and version a benchmark ran on, saved next to its results
+def environment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "commit": _git_commit(),
+    }
+
+
+# *PRIVATE HELPER FUNCTIONS*
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,325 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.common import environment
+from utils.message import Message, MessageType, MessageReader
+from utils.chunk_manager import ChunkManager
+
+# Payload sizes the message benchmarks run at
+PAYLOAD_SIZES = (4, 4 * 1024, 64 * 1024, 1024 * 1024)
+# Piece counts the piece state benchmarks run at
+PIECE_COUNTS = (10_000, 100_000, 1_000_000)
+# Piece sizes the hashing benchmarks run at
+PIECE_SIZES = (16 * 1024, 256 * 1024, 1024 * 1024)
+# Default slowdown over the baseline that counts as a regression
+REGRESSION_THRESHOLD = 0.10
+
+
+# One timed operation, set up once and run count times per measurement
+#
+# setup() returns the callable to time, which runs the operation count times.
+# bytes_per_op turns the timing into a throughput where that reads better.
+class Benchmark:
+    def __init__(self, name, setup, bytes_per_op=None):
+        self.name = name
+        self.setup = setup
+        self.bytes_per_op = bytes_per_op
+
+
+# Runs a benchmark until a measurement takes min_time, then keeps the fastest of repeat measurements
+def measure(benchmark, repeat=5, min_time=0.2):
+    run, teardown = benchmark.setup()
+    try:
+        count = 1
+        while (elapsed := _time(run, count)) < min_time:
+            count *= 2 if elapsed < min_time / 10 else max(2, int(min_time / max(elapsed, 1e-9)))
+        best = min([elapsed] + [_time(run, count) for _ in range(repeat - 1)]) / count
+    finally:
+        teardown()
+
+    result = {"seconds_per_op": best, "ops_per_second": 1 / best}
+    if benchmark.bytes_per_op is not None:
+        result["bytes_per_second"] = benchmark.bytes_per_op / best
+    return result
+
+
+# Checks every result against the baseline, a regression is one slower by more than threshold
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    rows = []
+    for name, result in results.items():
+        if (old := baseline.get(name)) is None:
+            rows.append((name, None, False))
+            continue
+        change = result["seconds_per_op"] / old["seconds_per_op"] - 1
+        rows.append((name, change, change > threshold))
+    return rows
+
+
+def all_benchmarks():
+    benchmarks = []
+    for size in PAYLOAD_SIZES:
+        benchmarks.append(Benchmark(f"message.to_bytes[{size}]", _to_bytes_setup(size), size))
+        benchmarks.append(
+            Benchmark(
+                f"message.from_socket[{size}]",
+                _receive_setup(size, lambda sock: lambda: Message.from_socket(sock, max_length=size)),
+                size,
+            )
+        )
+        benchmarks.append(
+            Benchmark(
+                f"message_reader.read[{size}]",
+                _receive_setup(size, lambda sock: MessageReader(sock, max_length=size).read),
+                size,
+            )
+        )
+    for count in PIECE_COUNTS:
+        benchmarks.append(
+            Benchmark(
+                f"chunk_manager.check_current_chunks[{count}]",
+                _chunk_manager_setup(count, lambda manager: manager.check_current_chunks),
+            )
+        )
+        benchmarks.append(
+            Benchmark(
+                f"chunk_manager.is_done[{count}]",
+                _chunk_manager_setup(count, lambda manager: manager.is_done),
+            )
+        )
+        benchmarks.append(
+            Benchmark(f"chunk_manager.claim_chunk[{count}]", _claim_setup(count, every=1))
+        )
+        benchmarks.append(
+            Benchmark(f"chunk_manager.claim_chunk_sparse_peer[{count}]", _claim_setup(count, every=100))
+        )
+    for size in PIECE_SIZES:
+        benchmarks.append(Benchmark(f"piece.verify_hash[{size}]", _verify_hash_setup(size), size))
+        benchmarks.append(Benchmark(f"storage.verify_piece[{size}]", _verify_piece_setup(size), size))
+    return benchmarks
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the protocol, bitfield and piece state hot paths and compare them to a baseline"
+    )
+    parser.add_argument("-k", "--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5, help="measurements per benchmark, the fastest is kept")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds each measurement runs for at least")
+    parser.add_argument("-o", "--output", help="save the results as json to this file")
+    parser.add_argument("--baseline", help="results json of an earlier run to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=REGRESSION_THRESHOLD * 100,
+        help="percent slower than the baseline that counts as a regression",
+    )
+    parser.add_argument("--list", action="store_true", help="list the benchmarks without running them")
+    args = parser.parse_args()
+
+    benchmarks = [benchmark for benchmark in all_benchmarks() if args.filter in benchmark.name]
+    if args.list:
+        for benchmark in benchmarks:
+            print(benchmark.name)
+        return
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+
+    results = {}
+    for benchmark in benchmarks:
+        results[benchmark.name] = result = measure(benchmark, args.repeat, args.min_time)
+        line = f"{benchmark.name:<52} {result['seconds_per_op'] * 1e6:>12.3f} us/op"
+        if "bytes_per_second" in result:
+            line += f" {result['bytes_per_second'] / 1024 / 1024:>10.1f} MB/s"
+        sys.stderr.write(line + "\n")
+
+    output = {"benchmark": "micro", "environment": environment(), "results": results}
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(output, output_file, indent=2)
+            output_file.write("\n")
+
+    if baseline is None:
+        return
+    regressions = 0
+    sys.stderr.write(f"\nCompared to {args.baseline} (regression above {args.threshold:g}%):\n")
+    for name, change, is_regression in compare(results, baseline, args.threshold / 100):
+        if change is None:
+            sys.stderr.write(f"{name:<52} {'new':>12}\n")
+            continue
+        regressions += is_regression
+        sys.stderr.write(
+            f"{name:<52} {change * 100:>+11.1f}%{'  REGRESSION' if is_regression else ''}\n"
+        )
+    if regressions:
+        sys.stderr.write(f"{regressions} benchmarks regressed\n")
+        sys.exit(1)
+
+
+# *PRIVATE HELPER FUNCTIONS*
+
+
+def _time(run, count):
+    started = time.perf_counter()
+    run(count)
+    return time.perf_counter() - started
+
+
+def _no_teardown():
+    pass
+
+
+def _to_bytes_setup(size):
+    def setup():
+        message = Message(MessageType.PIECE_RESPONSE, version=2, data=os.urandom(size))
+
+        def run(count):
+            for _ in range(count):
+                message.to_bytes()
+
+        return run, _no_teardown
+
+    return setup
+
+
+def _receive_setup(size, make_read):
+    # Streams count messages from a sender thread through a socketpair and reads them back
+    def setup():
+        sender, receiver = socket.socketpair()
+        encoded = Message(MessageType.PIECE_RESPONSE, version=2, data=os.urandom(size)).to_bytes()
+        read = make_read(receiver)
+
+        def send(count):
+            for _ in range(count):
+                sender.sendall(encoded)
+
+        def run(count):
+            sending = threading.Thread(target=send, args=(count,))
+            sending.start()
+            for _ in range(count):
+                if read() is None:
+                    raise RuntimeError("socketpair closed")
+            sending.join()
+
+        def teardown():
+            sender.close()
+            receiver.close()
+
+        return run, teardown
+
+    return setup
+
+
+def _new_chunk_manager(count, folder):
+    # A torrent of tiny pieces so a million of them only needs a small file
+    return ChunkManager(
+        torrent_id="00" * 20,
+        file_size=count * 16,
+        file_name="bench.bin",
+        piece_size=16,
+        pieces=["00" * 20] * count,
+        folder=folder,
+    )
+
+
+def _chunk_manager_setup(count, make_operation):
+    def setup():
+        folder = tempfile.mkdtemp(prefix="micro-")
+        manager = _new_chunk_manager(count, folder)
+        operation = make_operation(manager)
+
+        def run(runs):
+            for _ in range(runs):
+                operation()
+
+        def teardown():
+            manager.close()
+            shutil.rmtree(folder, ignore_errors=True)
+
+        return run, teardown
+
+    return setup
+
+
+def _claim_setup(count, every):
+    # Claims a piece from a peer that has every nth piece and gives it back, like a download that failed
+    def setup():
+        folder = tempfile.mkdtemp(prefix="micro-")
+        manager = _new_chunk_manager(count, folder)
+        peer_chunks = bytearray((count + 7) // 8)
+        for index in range(0, count, every):
+            peer_chunks[index >> 3] |= 0x80 >> (index & 7)
+        manager.add_peer(peer_chunks)
+
+        def run(runs):
+            for _ in range(runs):
+                index, _ = manager.claim_chunk(peer_chunks)
+                manager.release_chunk(index)
+
+        def teardown():
+            manager.close()
+            shutil.rmtree(folder, ignore_errors=True)
+
+        return run, teardown
+
+    return setup
+
+
+def _verify_hash_setup(size):
+    # The check every downloaded piece goes through before it is saved
+    def setup():
+        piece = os.urandom(size)
+        expected_hash = hashlib.sha1(piece).digest()
+
+        def run(count):
+            for _ in range(count):
+                if hashlib.sha1(piece).digest() != expected_hash:
+                    raise RuntimeError("hash mismatch")
+
+        return run, _no_teardown
+
+    return setup
+
+
+def _verify_piece_setup(size):
+    # Reads a piece back from a single file and checks it, as startup verification does
+    def setup():
+        folder = tempfile.mkdtemp(prefix="micro-")
+        pieces = [os.urandom(size) for _ in range(8)]
+        with open(os.path.join(folder, "bench.bin"), "wb") as data_file:
+            data_file.write(b"".join(pieces))
+        manager = ChunkManager(
+            torrent_id="00" * 20,
+            file_size=size * len(pieces),
+            file_name="bench.bin",
+            piece_size=size,
+            pieces=[hashlib.sha1(piece).hexdigest() for piece in pieces],
+            folder=folder,
+        )
+
+        def run(count):
+            for number in range(count):
+                if not manager.storage.verify_piece(number % len(pieces)):
+                    raise RuntimeError("piece failed verification")
+
+        def teardown():
+            manager.close()
+            shutil.rmtree(folder, ignore_errors=True)
+
+        return run, teardown
+
+    return setup
+
+
+if __name__ == "__main__":
+    main()
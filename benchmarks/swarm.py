@@ -0,0 +1,331 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import REPO_ROOT, environment
+from benchmarks.tracker import Tracker
+
+# The peer every benchmark runs, from the same checkout as the benchmark
+PEER_SCRIPT = os.path.join(REPO_ROOT, "peer.py")
+# Line a peer writes to stderr once it has the whole file
+COMPLETE_MARKER = "Succesfully downloaded"
+# Seconds peers get to close after SIGINT before they are killed
+SHUTDOWN_TIMEOUT = 15
+
+
+# One peer process of the swarm and the resources it used
+class SwarmPeer:
+    def __init__(self, name, role, port, folder, log_path):
+        self.name = name
+        self.role = role
+        self.port = port
+        self.folder = folder
+        self.log_path = log_path
+        self.process = None
+        self.started = None
+        self.completed = None
+        self.rusage = None
+        self.exit_code = None
+
+    def is_complete(self):
+        if self.completed is None:
+            with open(self.log_path, "r", errors="replace") as log_file:
+                if COMPLETE_MARKER in log_file.read():
+                    self.completed = time.monotonic()
+        return self.completed is not None
+
+    def result(self, file_sha1):
+        result = {
+            "name": self.name,
+            "role": self.role,
+            "port": self.port,
+            "time_to_complete": (
+                self.completed - self.started if self.completed is not None else None
+            ),
+            "cpu_user": self.rusage.ru_utime if self.rusage is not None else None,
+            "cpu_system": self.rusage.ru_stime if self.rusage is not None else None,
+            "peak_rss_kb": _peak_rss_kb(self.rusage) if self.rusage is not None else None,
+            "exit_code": self.exit_code,
+        }
+        if self.role == "leecher":
+            result["verified"] = _file_sha1(os.path.join(self.folder, "bench.bin")) == file_sha1
+        return result
+
+
+# Writes a file of random bytes and its .ntorrent, returns the torrent's data and the file's sha1
+def make_torrent(folder, file_size, piece_size, tracker_url, seed=0):
+    generator = random.Random(seed)
+    file_hash = hashlib.sha1()
+    pieces = []
+    with open(os.path.join(folder, "bench.bin"), "wb") as data_file:
+        for offset in range(0, file_size, piece_size):
+            piece = generator.randbytes(min(piece_size, file_size - offset))
+            data_file.write(piece)
+            file_hash.update(piece)
+            pieces.append(hashlib.sha1(piece).hexdigest())
+
+    torrent = {
+        "torrent_id": hashlib.sha1("".join(pieces).encode()).hexdigest(),
+        "tracker_url": tracker_url,
+        "file_size": file_size,
+        "file_name": "bench.bin",
+        "piece_size": piece_size,
+        "pieces": pieces,
+    }
+    with open(os.path.join(folder, "bench.ntorrent"), "w") as torrent_file:
+        json.dump(torrent, torrent_file)
+    return torrent, file_hash.hexdigest()
+
+
+# Runs one swarm of seeds and leechers on loopback and returns the results
+def run_swarm(
+    seeds=1,
+    leechers=4,
+    file_size=16 * 1024 * 1024,
+    piece_size=16 * 1024,
+    engine="thread",
+    storage="file",
+    peer_args=(),
+    base_port=9300,
+    timeout=300,
+    work_dir=None,
+    keep=False,
+):
+    work_dir = tempfile.mkdtemp(prefix="swarm-", dir=work_dir)
+    tracker = Tracker().start()
+    peers = []
+    try:
+        torrent, file_sha1 = make_torrent(work_dir, file_size, piece_size, tracker.url)
+        torrent_path = os.path.join(work_dir, "bench.ntorrent")
+
+        # Starts the seeds and waits for each one to verify its file and announce
+        for number in range(seeds):
+            peer = _create_peer(work_dir, f"seed{number}", "seed", base_port + len(peers))
+            _place_seed_file(work_dir, peer.folder, torrent, storage)
+            _start_peer(peer, torrent_path, engine, storage, peer_args)
+            peers.append(peer)
+        deadline = time.monotonic() + timeout
+        while len(tracker.swarm(torrent["torrent_id"])) < seeds:
+            if time.monotonic() > deadline or any(peer.process.poll() is not None for peer in peers):
+                raise RuntimeError("seeds never announced, see their logs in " + work_dir)
+            time.sleep(0.1)
+
+        # Starts every leecher at once and waits until they all have the file
+        started = time.monotonic()
+        for number in range(leechers):
+            peer = _create_peer(work_dir, f"leecher{number}", "leecher", base_port + len(peers))
+            _start_peer(peer, torrent_path, engine, storage, peer_args)
+            peers.append(peer)
+        leecher_peers = [peer for peer in peers if peer.role == "leecher"]
+        while not all(peer.is_complete() for peer in leecher_peers):
+            if time.monotonic() - started > timeout:
+                break
+            time.sleep(0.05)
+        elapsed = time.monotonic() - started
+    finally:
+        _stop_peers(peers)
+        tracker.close()
+
+    results = [peer.result(file_sha1) for peer in peers]
+    leecher_results = [result for result in results if result["role"] == "leecher"]
+    completed = [result["time_to_complete"] for result in leecher_results if result["time_to_complete"] is not None]
+    is_complete = len(completed) == len(leecher_results) and all(
+        result["verified"] for result in leecher_results
+    )
+    report = {
+        "config": {
+            "seeds": seeds,
+            "leechers": leechers,
+            "file_size": file_size,
+            "piece_size": piece_size,
+            "pieces": len(torrent["pieces"]),
+            "engine": engine,
+            "storage": storage,
+            "peer_args": list(peer_args),
+            "timeout": timeout,
+        },
+        "environment": environment(),
+        "summary": {
+            "complete": is_complete,
+            "elapsed": elapsed,
+            "time_to_complete_max": max(completed) if completed else None,
+            "time_to_complete_mean": sum(completed) / len(completed) if completed else None,
+            "throughput_bytes_per_second": (
+                file_size * len(completed) / max(completed) if completed else 0.0
+            ),
+            "cpu_seconds": sum(
+                result["cpu_user"] + result["cpu_system"]
+                for result in results
+                if result["cpu_user"] is not None
+            ),
+            "peak_rss_kb_max": max(
+                (result["peak_rss_kb"] for result in results if result["peak_rss_kb"] is not None),
+                default=None,
+            ),
+        },
+        "peers": results,
+    }
+
+    if keep:
+        report["work_dir"] = work_dir
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time a swarm of seeds and leechers on loopback with a local tracker"
+    )
+    parser.add_argument("--seeds", type=int, default=1, help="number of peers starting with the file")
+    parser.add_argument("--leechers", type=int, default=4, help="number of peers downloading the file")
+    parser.add_argument("--file-size", type=float, default=16, help="size of the synthetic file in MB")
+    parser.add_argument("--piece-size", type=int, default=16, help="piece size in KB")
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread", help="engine every peer runs")
+    parser.add_argument("--storage", choices=["file", "chunks"], default="file", help="storage every peer uses")
+    parser.add_argument(
+        "--peer-arg",
+        action="append",
+        default=[],
+        help="extra option passed to every peer, repeat for more, e.g. --peer-arg=--upload-slots=2",
+    )
+    parser.add_argument("--base-port", type=int, default=9300, help="first port handed to the peers")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for the leechers")
+    parser.add_argument("--repeat", type=int, default=1, help="number of times to run the swarm")
+    parser.add_argument("--keep", action="store_true", help="keep the work folder with peer logs")
+    parser.add_argument("-o", "--output", help="write the results as json to this file instead of stdout")
+    args = parser.parse_args()
+
+    if args.seeds < 1 or args.leechers < 1 or args.repeat < 1:
+        sys.stderr.write("Seeds, leechers and repeat must be at least 1\n")
+        sys.exit(1)
+
+    runs = []
+    for run in range(args.repeat):
+        report = run_swarm(
+            seeds=args.seeds,
+            leechers=args.leechers,
+            file_size=int(args.file_size * 1024 * 1024),
+            piece_size=args.piece_size * 1024,
+            engine=args.engine,
+            storage=args.storage,
+            peer_args=args.peer_arg,
+            base_port=args.base_port,
+            timeout=args.timeout,
+            keep=args.keep,
+        )
+        summary = report["summary"]
+        sys.stderr.write(
+            f"Run {run + 1}/{args.repeat}: "
+            f"{'complete' if summary['complete'] else 'INCOMPLETE'} in {summary['elapsed']:.2f}s, "
+            f"{summary['throughput_bytes_per_second'] / 1024 / 1024:.1f} MB/s, "
+            f"{summary['cpu_seconds']:.1f} CPU seconds\n"
+        )
+        runs.append(report)
+
+    output = json.dumps({"benchmark": "swarm", "runs": runs}, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+    if not all(report["summary"]["complete"] for report in runs):
+        sys.exit(1)
+
+
+# *PRIVATE HELPER FUNCTIONS*
+
+
+def _create_peer(work_dir, name, role, port):
+    folder = os.path.join(work_dir, name)
+    os.makedirs(folder)
+    return SwarmPeer(name, role, port, folder, os.path.join(work_dir, f"{name}.log"))
+
+
+def _place_seed_file(work_dir, folder, torrent, storage):
+    source = os.path.join(work_dir, "bench.bin")
+    if storage == "file":
+        shutil.copyfile(source, os.path.join(folder, "bench.bin"))
+        return
+
+    # Splits the file into the legacy chunks/ layout
+    os.makedirs(os.path.join(folder, "chunks"))
+    with open(source, "rb") as data_file:
+        for index, piece_hash in enumerate(torrent["pieces"]):
+            with open(os.path.join(folder, "chunks", f"bench.bin_{index}_{piece_hash}"), "wb") as chunk:
+                chunk.write(data_file.read(torrent["piece_size"]))
+
+
+def _start_peer(peer, torrent_path, engine, storage, peer_args):
+    command = [
+        sys.executable,
+        PEER_SCRIPT,
+        "--host", "127.0.0.1",
+        "--port", str(peer.port),
+        "--dest", peer.folder,
+        "--engine", engine,
+        "--storage", storage,
+        *peer_args,
+        f"bench-{peer.name}",
+        torrent_path,
+    ]
+    with open(peer.log_path, "wb") as log_file:
+        peer.process = subprocess.Popen(
+            command, stdout=subprocess.DEVNULL, stderr=log_file, start_new_session=True
+        )
+    peer.started = time.monotonic()
+
+
+def _stop_peers(peers):
+    # Closes every peer like a keyboard interrupt would, then collects what it used
+    running = [peer for peer in peers if peer.process is not None]
+    for peer in running:
+        try:
+            peer.process.send_signal(signal.SIGINT)
+        except ProcessLookupError:
+            pass
+
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    while running:
+        for peer in list(running):
+            pid, status, rusage = os.wait4(peer.process.pid, os.WNOHANG)
+            if pid == 0:
+                continue
+            peer.process.returncode = peer.exit_code = os.waitstatus_to_exitcode(status)
+            peer.rusage = rusage
+            running.remove(peer)
+        if running and time.monotonic() > deadline:
+            for peer in running:
+                peer.process.kill()
+            deadline = float("inf")
+        time.sleep(0.05)
+
+
+def _peak_rss_kb(rusage):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if sys.platform == "darwin":
+        return rusage.ru_maxrss // 1024
+    return rusage.ru_maxrss
+
+
+def _file_sha1(path):
+    file_hash = hashlib.sha1()
+    try:
+        with open(path, "rb") as data_file:
+            while block := data_file.read(1024 * 1024):
+                file_hash.update(block)
+    except OSError:
+        return None
+    return file_hash.hexdigest()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Seconds peers are told to wait between announces
+ANNOUNCE_INTERVAL = 5
+
+
+# Stand-in for the course tracker that answers /announce the way tracker_task expects
+#
+# Every announce adds the peer to its torrent's swarm and gets back the whole
+# swarm as [address, peer_id] pairs. The transfer stats sent with each
+# announce are kept so a benchmark can see which peers registered and what
+# they reported last.
+class Tracker:
+    def __init__(self, port=0, interval=ANNOUNCE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self._swarms = {}
+        tracker = self
+
+        class AnnounceHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != "/announce":
+                    self.send_error(404)
+                    return
+                try:
+                    query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                    peer_list = tracker.announce(query)
+                except (KeyError, ValueError):
+                    self.send_error(400)
+                    return
+                body = json.dumps({"interval": tracker.interval, "peers": peer_list}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), AnnounceHandler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}/announce"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.setName("Benchmark Tracker")
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def announce(self, query):
+        peer = {
+            "address": f"{query['ip']}:{int(query['port'])}",
+            "uploaded": int(query.get("uploaded", 0)),
+            "downloaded": int(query.get("downloaded", 0)),
+            "left": int(query.get("left", 0)),
+        }
+        with self.lock:
+            swarm = self._swarms.setdefault(query["torrent_id"], {})
+            swarm[query["peer_id"]] = peer
+            return [[entry["address"], peer_id] for peer_id, entry in swarm.items()]
+
+    def swarm(self, torrent_id):
+        # Snapshot of every peer that announced the torrent, by peer id
+        with self.lock:
+            return {peer_id: dict(peer) for peer_id, peer in self._swarms.get(torrent_id, {}).items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the stand-in tracker on its own")
+    parser.add_argument("-p", "--port", type=int, default=8088, help="port to serve /announce on")
+    parser.add_argument(
+        "--interval", type=int, default=ANNOUNCE_INTERVAL, help="seconds between announces"
+    )
+    args = parser.parse_args()
+
+    tracker = Tracker(port=args.port, interval=args.interval)
+    print(f"Tracker listening on {tracker.url}")
+    try:
+        tracker.server.serve_forever()
+    except KeyboardInterrupt:
+        tracker.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
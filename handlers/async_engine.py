@@ -0,0 +1,620 @@
+import asyncio
+import threading
+import logging
+import sys
+from collections import deque
+
+# Utility scripts
+from utils.message import (
+    Message,
+    MessageType,
+    LATEST_VERSION,
+    SUPPORTED_VERSIONS,
+    V1_MAX_LENGTH,
+    HAVE_INDEX_SIZE,
+    max_payload_length,
+)
+from utils.chunk_manager import ChunkManager
+from utils.connection_manager import ConnectionManager
+from utils.piece_writer import PieceWriter
+from utils.torrent_registry import TorrentRegistry
+from utils.upload_scheduler import UploadScheduler
+from utils.peer_stats import PeerStats, REQUEST_TIMEOUT
+from utils.metrics import Metrics
+
+# Creates a thread that runs the asyncio engine for both uploads and downloads
+def create_async_engine_thread(
+    chunk_manager,
+    registry,
+    connection_manager,
+    piece_writer,
+    upload_scheduler,
+    metrics,
+    server_port,
+    thread_event,
+    pipeline_depth=1,
+    endgame_threshold=0,
+):
+    engine_thread = threading.Thread(
+        target=asyncio.run,
+        args=(
+            engine_task(
+                chunk_manager,
+                registry,
+                connection_manager,
+                piece_writer,
+                upload_scheduler,
+                metrics,
+                server_port,
+                thread_event,
+                pipeline_depth,
+                endgame_threshold,
+            ),
+        ),
+    )
+    engine_thread.setName("Async Engine Thread")
+    engine_thread.start()
+    return engine_thread
+
+
+# Engine task runs the upload server and every download connection on one event loop
+#
+# Between dialing peers and handing out upload slots the loop sleeps until
+# the connection manager, the upload scheduler, the last completed chunk or
+# shutdown wakes it, or a backoff or rechoke comes due.
+async def engine_task(
+    chunk_manager: ChunkManager,
+    registry: TorrentRegistry,
+    connection_manager: ConnectionManager,
+    piece_writer: PieceWriter,
+    upload_scheduler: UploadScheduler,
+    metrics: Metrics,
+    server_port,
+    thread_event,
+    pipeline_depth=1,
+    endgame_threshold=0,
+):
+    loop = asyncio.get_running_loop()
+
+    # Creates the upload server, connections are routed to their torrent by the registry
+    server = await asyncio.start_server(
+        lambda reader, writer: upload_task(reader, writer, registry, upload_scheduler, metrics),
+        port=server_port,
+        reuse_address=True,
+    )
+    logging.info(f" ASYNC_ENGINE: Created server on port {server_port}")
+
+    # Keeps a reference to every running download so it isn't garbage collected
+    download_tasks = {}
+    is_finished = False
+
+    # Wakes the loop when peers change, an upload slot frees up, the last chunk completes or the peer closes
+    wakeup = _LoopWakeup(loop)
+
+    def wake_when_done(index):
+        if chunk_manager.is_done():
+            wakeup.set()
+
+    def wake_on_close():
+        loop.remove_reader(thread_event.fileno())
+        wakeup.set()
+
+    connection_manager.add_wakeup(wakeup)
+    upload_scheduler.add_wakeup(wakeup)
+    chunk_manager.add_completion_listener(wake_when_done)
+    loop.add_reader(thread_event.fileno(), wake_on_close)
+
+    while not thread_event.is_set():
+        wakeup.clear()
+
+        # Hands out upload slots, choke changes are queued onto the loop
+        upload_scheduler.tick()
+
+        # Checks if all blocks are collected
+        if not is_finished and chunk_manager.is_done():
+            is_finished = True
+            logging.info(" ASYNC_ENGINE: All chunks are downloaded")
+            logging.info(" ASYNC_ENGINE: Creating file...")
+            await loop.run_in_executor(None, piece_writer.assemble, chunk_manager)
+            logging.info(" ASYNC_ENGINE: Finished file")
+            sys.stderr.write(
+                f"Succesfully downloaded {chunk_manager.file_name}...continuing to seed torrent\n"
+            )
+
+        # Dials new peers and redials dropped ones once their backoff has passed
+        delays = [upload_scheduler.next_tick_delay()]
+        if not is_finished:
+            for peer_address, peer_id in connection_manager.peers_to_dial(chunk_manager.torrent_id):
+                download = asyncio.create_task(
+                    download_task(
+                        peer_address,
+                        peer_id,
+                        chunk_manager,
+                        connection_manager,
+                        piece_writer,
+                        upload_scheduler,
+                        metrics,
+                        pipeline_depth,
+                        endgame_threshold,
+                    )
+                )
+                download_tasks[peer_id] = download
+                download.add_done_callback(
+                    lambda _, peer_id=peer_id: download_tasks.pop(peer_id, None)
+                )
+            delays.append(connection_manager.next_dial_delay(chunk_manager.torrent_id))
+
+        await wakeup.wait(min((delay for delay in delays if delay is not None), default=None))
+
+    loop.remove_reader(thread_event.fileno())
+    chunk_manager.remove_completion_listener(wake_when_done)
+    upload_scheduler.remove_wakeup(wakeup)
+    connection_manager.remove_wakeup(wakeup)
+
+    # Closes the server and cancels any running downloads
+    logging.info(" ASYNC_ENGINE: Closing server socket...")
+    server.close()
+    for download in list(download_tasks.values()):
+        download.cancel()
+    await asyncio.gather(*download_tasks.values(), return_exceptions=True)
+    await server.wait_closed()
+    logging.info(" ASYNC_ENGINE: <<<Complete>>>")
+
+
+async def download_task(
+    peer_address,
+    peer_id,
+    chunk_manager: ChunkManager,
+    connection_manager: ConnectionManager,
+    piece_writer: PieceWriter,
+    upload_scheduler: UploadScheduler,
+    metrics: Metrics,
+    pipeline_depth=1,
+    endgame_threshold=0,
+):
+    loop = asyncio.get_running_loop()
+    peer_ip, peer_port = peer_address.split(":")
+
+    # Connects with the newest protocol version and falls back to version 1 for old peers
+    for version in (LATEST_VERSION, 1):
+        connection = await _open_peer_connection(
+            peer_ip, peer_port, peer_id, chunk_manager, version
+        )
+        if connection is None:
+            connection_manager.connection_failed(chunk_manager.torrent_id, peer_id)
+            return
+        reader, writer, hello_response = connection
+        if version == 1 or (
+            hello_response is not None and hello_response.type != MessageType.ERROR
+        ):
+            break
+        logging.info(
+            f" ASYNC_DOWNLOAD({peer_id}): Peer rejected version {version}, retrying with version 1"
+        )
+        writer.close()
+
+    outstanding_chunks = deque()
+    avalible_chunks = b""
+    pending_read = None
+    # Longest message the peer may send, longer ones close the connection
+    max_length = max_payload_length(chunk_manager.piece_size, chunk_manager.number_of_pieces)
+    is_opened = False
+    peer_stats = PeerStats(chunk_manager.piece_size, pipeline_depth)
+    # Set by a piece writer worker when a piece from this peer fails its hash check
+    hash_failed = threading.Event()
+    # Set while the peer has choked us and won't take new piece requests
+    is_choked = False
+    # Set when a chunk is given back, completes or fails its hash, so the connection can claim again
+    chunks_changed = _LoopWakeup(loop)
+    chunk_manager.add_wakeup(chunks_changed)
+
+    def on_invalid():
+        hash_failed.set()
+        chunks_changed.set()
+
+    try:
+        if not _check_message(
+            hello_response,
+            MessageType.HELLO_RESPONSE,
+            writer,
+            f"ASYNC_DOWNLOAD({peer_id})",
+            range(1, version + 1),
+        ):
+            return
+        version = hello_response.version
+        if version == 1 and chunk_manager.piece_size > V1_MAX_LENGTH:
+            logging.info(f" ASYNC_DOWNLOAD({peer_id}): Pieces are too big for protocol version 1")
+            return
+        is_opened = True
+        connection_manager.connection_opened(chunk_manager.torrent_id, peer_id, peer_stats)
+
+        avalible_chunks = chunk_manager.peer_bitfield(hello_response.data)
+        logging.info(f' ASYNC_DOWNLOAD({peer_id}): Chunks avalible "{avalible_chunks.hex()}"')
+        chunk_manager.add_peer(avalible_chunks)
+
+        # Requests chunks until the peer has nothing left we need
+        num_of_bytes_needed = (chunk_manager.number_of_pieces.bit_length() + 7) // 8
+        while True:
+            # Stops trusting the peer once one of its pieces had the wrong hash
+            if hash_failed.is_set():
+                logging.info(f" ASYNC_DOWNLOAD({peer_id}): Hash is incorrect")
+                writer.write(
+                    Message(MessageType.ERROR, data="Hash value is incorrect".encode()).to_bytes()
+                )
+                return
+
+            # Gives the requested chunks back to other peers once this one is too slow
+            if peer_stats.check_snubbed():
+                logging.info(
+                    f" ASYNC_DOWNLOAD({peer_id}): Peer is too slow, giving back {len(outstanding_chunks)} chunks"
+                )
+                return
+
+            # Keeps as many piece requests in flight as the peer's rate calls for
+            request_depth = peer_stats.pipeline_depth()
+            while not is_choked and len(outstanding_chunks) < request_depth:
+                claimed_chunk = chunk_manager.claim_chunk(
+                    avalible_chunks,
+                    {index for index, _ in outstanding_chunks},
+                    endgame_threshold,
+                )
+                if claimed_chunk is None:
+                    # Looks again after clearing a pending wakeup so a chunk given back in between isn't missed
+                    if chunks_changed.is_set():
+                        chunks_changed.clear()
+                        continue
+                    break
+                index, _ = claimed_chunk
+                logging.info(f" ASYNC_DOWNLOAD({peer_id}): Downloading chunk {index + 1}")
+                piece_request = Message(
+                    type_=MessageType.PIECE_REQUEST,
+                    version=version,
+                    data=int.to_bytes(index, byteorder="big", length=num_of_bytes_needed),
+                )
+                writer.write(piece_request.to_bytes())
+                outstanding_chunks.append(claimed_chunk)
+                peer_stats.request_sent()
+
+            if not outstanding_chunks and (version == 1 or chunk_manager.is_done()):
+                break
+
+            # Collects the next message, waking up in time to notice a request that timed out
+            # and with requests to spare when a chunk may be claimable again
+            if pending_read is None:
+                pending_read = asyncio.ensure_future(Message.from_stream(reader, max_length))
+            waiters = {pending_read}
+            if not is_choked and len(outstanding_chunks) < request_depth:
+                waiters.add(asyncio.ensure_future(chunks_changed.wait()))
+            time_left = peer_stats.time_left()
+            done, waiting = await asyncio.wait(
+                waiters,
+                timeout=max(time_left, 0) if time_left is not None else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for waiter in waiting - {pending_read}:
+                waiter.cancel()
+            if pending_read not in done:
+                continue
+            piece_response = pending_read.result()
+            pending_read = None
+
+            # Updates the peer's bitfield when it announces a new chunk
+            if piece_response is not None and piece_response.type == MessageType.HAVE:
+                chunk_manager.add_peer_chunk(
+                    avalible_chunks, int.from_bytes(piece_response.data, "big")
+                )
+                continue
+
+            # Stops or resumes requesting, requests already sent are still answered after a choke
+            if piece_response is not None and piece_response.type in (MessageType.CHOKE, MessageType.UNCHOKE):
+                is_choked = piece_response.type == MessageType.CHOKE
+                continue
+            if not outstanding_chunks:
+                logging.info(f" ASYNC_DOWNLOAD({peer_id}): Peer closed idle connection")
+                return
+
+            index, requested_piece_hash = outstanding_chunks[0]
+            if not _check_message(
+                piece_response,
+                MessageType.PIECE_RESPONSE,
+                writer,
+                f"ASYNC_DOWNLOAD({peer_id})",
+                (version,),
+            ):
+                return
+            outstanding_chunks.popleft()
+            latency = peer_stats.piece_received(len(piece_response.data))
+            metrics.record_download(len(piece_response.data), latency)
+            upload_scheduler.record_download(peer_ip, len(piece_response.data))
+
+            # Drops the piece if another peer already delivered it during endgame
+            if chunk_manager.is_chunk_available(index):
+                chunk_manager.release_chunk(index)
+                continue
+
+            # Hands the piece to the writer pool, waiting off the loop while its queue is full
+            piece = (chunk_manager, index, piece_response.data, requested_piece_hash, on_invalid)
+            if not piece_writer.submit(*piece, block=False):
+                await loop.run_in_executor(None, piece_writer.submit, *piece)
+
+        logging.info(f" ASYNC_DOWNLOAD({peer_id}): Finsihed downloading all avaliable chunks")
+    except OSError:
+        logging.info(f" ASYNC_DOWNLOAD({peer_id}): Connection to peer was lost")
+    finally:
+        if pending_read is not None:
+            pending_read.cancel()
+        chunk_manager.remove_wakeup(chunks_changed)
+
+        # Returns unfinished chunks so another peer can download them
+        for index, _ in outstanding_chunks:
+            chunk_manager.release_chunk(index)
+        chunk_manager.remove_peer(avalible_chunks)
+        if peer_stats.is_snubbed:
+            connection_manager.connection_snubbed(chunk_manager.torrent_id, peer_id)
+        elif is_opened:
+            connection_manager.connection_closed(chunk_manager.torrent_id, peer_id)
+        else:
+            connection_manager.connection_failed(chunk_manager.torrent_id, peer_id)
+        logging.info(f" ASYNC_DOWNLOAD({peer_id}): Closing connection to peer")
+        writer.close()
+
+
+async def upload_task(
+    reader, writer, registry: TorrentRegistry, upload_scheduler: UploadScheduler, metrics: Metrics
+):
+    loop = asyncio.get_running_loop()
+    addr = writer.get_extra_info("peername")
+    log_name = f"ASYNC_UPLOAD({addr[0]}:{addr[1]})"
+    logging.info(f" {log_name}: Accepted new upload peer")
+    metrics.upload_opened(addr, f"{addr[0]}:{addr[1]}")
+
+    version = 1
+    chunk_manager = None
+    cancel_on_close = None
+    is_registered = False
+    pending_messages = []
+    is_sending = False
+
+    def flush_messages():
+        while pending_messages:
+            message = pending_messages.pop(0)
+            writer.write(message.to_bytes())
+            if message.type == MessageType.CHOKE:
+                upload_scheduler.choke_sent(addr)
+
+    def queue_message(message):
+        pending_messages.append(message)
+        if not is_sending:
+            flush_messages()
+
+    # Chunks can complete on any thread so the have is handed over to the event loop
+    def announce_chunk(index):
+        have_message = Message(
+            type_=MessageType.HAVE, version=version, data=index.to_bytes(HAVE_INDEX_SIZE, "big")
+        )
+        loop.call_soon_threadsafe(queue_message, have_message)
+
+    # Tells a version 2 peer when it may or may not send piece requests
+    def send_choke(is_choked):
+        choke_message = Message(
+            type_=MessageType.CHOKE if is_choked else MessageType.UNCHOKE, version=version
+        )
+        loop.call_soon_threadsafe(queue_message, choke_message)
+
+    try:
+        # Handles hello request from peer
+        hello_request = await Message.from_stream(reader)
+        if not _check_message(
+            hello_request, MessageType.HELLO_REQUEST, writer, log_name, SUPPORTED_VERSIONS
+        ):
+            return
+
+        # Looks up the torrent the peer asked for
+        chunk_manager = registry.get(hello_request.data)
+        if chunk_manager is None:
+            logging.info(f" {log_name}: Failed to find torrent_id {bytes(hello_request.data).hex()}")
+            writer.write(
+                Message(MessageType.ERROR, data="Torrent ID was not valid".encode()).to_bytes()
+            )
+            return
+        if hello_request.version == 1 and chunk_manager.piece_size > V1_MAX_LENGTH:
+            logging.info(f" {log_name}: Pieces are too big for version 1")
+            writer.write(
+                Message(MessageType.ERROR, data="Pieces need protocol version 2".encode()).to_bytes()
+            )
+            return
+
+        # Cancels the connection when the torrent is removed, even while it waits for a request
+        cancel_on_close = _CancelOnClose(loop, asyncio.current_task(), chunk_manager)
+        chunk_manager.add_wakeup(cancel_on_close)
+
+        # Pushes have messages for chunks completed while a version 2 peer is connected,
+        # holding them back while a piece is being sent so the two never interleave
+        version = hello_request.version
+        if version >= 2:
+            chunk_manager.add_completion_listener(announce_chunk)
+
+        # Request is valid send a hello response with available chunks in the peer's version
+        hello_response = Message(
+            type_=MessageType.HELLO_RESPONSE,
+            version=version,
+            data=chunk_manager.check_current_chunks(),
+        )
+        writer.write(hello_response.to_bytes())
+
+        # Takes an upload slot if one is free, version 1 peers can't be choked and are always served
+        if version >= 2:
+            is_registered = True
+            if upload_scheduler.register(addr, addr[0], send_choke, f"{addr[0]}:{addr[1]}"):
+                logging.info(f" {log_name}: No free upload slot, choking peer")
+                writer.write(Message(type_=MessageType.CHOKE, version=version).to_bytes())
+        await writer.drain()
+
+        # Serves piece requests until the peer disconnects or the torrent is removed
+        max_length = max_payload_length(chunk_manager.piece_size, chunk_manager.number_of_pieces)
+        while (piece_request := await Message.from_stream(reader, max_length)) is not None:
+            if chunk_manager.is_closed:
+                return
+            if not _check_message(
+                piece_request, MessageType.PIECE_REQUEST, writer, log_name, (version,)
+            ):
+                return
+
+            # Refuses a choked peer once the requests it sent before seeing the choke had their grace period
+            if not upload_scheduler.may_request(addr):
+                logging.info(f" {log_name}: Peer kept requesting while choked, closing connection...")
+                writer.write(Message(MessageType.ERROR, data="Peer is choked".encode()).to_bytes())
+                return
+
+            request = int.from_bytes(piece_request.data, "big")
+            if request >= chunk_manager.number_of_pieces or not chunk_manager.is_chunk_available(request):
+                logging.info(f" {log_name}: Requested chunk is out of bounds...")
+                writer.write(
+                    Message(MessageType.ERROR, data="Requested chunk is invalid".encode()).to_bytes()
+                )
+                return
+
+            logging.info(f" {log_name}: Sending {chunk_manager.file_name}_{request}...")
+
+            is_sending = True
+
+            # Sends the chunk from the piece cache, or from the disk scheduler waited on off the loop
+            payload = chunk_manager.cached_chunk(request)
+            if payload is None and chunk_manager.piece_reader is not None:
+                payload = await loop.run_in_executor(None, chunk_manager.read_stored_chunk, request)
+            if payload is not None:
+                writer.write(Message(type_=MessageType.PIECE_RESPONSE, version=version).to_header(len(payload)))
+                writer.write(payload)
+                length = len(payload)
+            else:
+                # Sends the header then lets the kernel copy the chunk straight from disk to the socket
+                with chunk_manager.open_chunk(request) as (chunk_file, offset, length):
+                    writer.write(Message(type_=MessageType.PIECE_RESPONSE, version=version).to_header(length))
+                    await writer.drain()
+                    await loop.sendfile(writer.transport, chunk_file, offset, length)
+            chunk_manager.add_uploaded(length)
+            upload_scheduler.record_upload(addr, length)
+            metrics.record_upload(addr, length)
+
+            is_sending = False
+            flush_messages()
+            await writer.drain()
+    except OSError:
+        logging.info(f" {log_name}: Connection to peer was lost")
+    except asyncio.CancelledError:
+        # Ends quietly when the engine shuts down or the torrent is removed, the stream callback would otherwise log it
+        logging.info(f" {log_name}: Closing connection for shutdown")
+    finally:
+        if chunk_manager is not None and announce_chunk in chunk_manager.completion_listeners:
+            chunk_manager.remove_completion_listener(announce_chunk)
+        if cancel_on_close is not None:
+            chunk_manager.remove_wakeup(cancel_on_close)
+        if is_registered:
+            upload_scheduler.unregister(addr)
+        metrics.upload_closed(addr)
+        writer.close()
+
+
+# *PRIVATE HELPER FUNCTIONS*
+
+
+# Wakes a coroutine on the engine's loop, set() can be called from any thread
+#
+# Stands in for a Wakeup on the asyncio side so the thread side can wake the
+# loop with the same set() call. Only the first set() after a clear() hands
+# anything to the loop.
+class _LoopWakeup:
+    def __init__(self, loop):
+        self.loop = loop
+        self._event = asyncio.Event()
+        self._is_set = False
+
+    def set(self):
+        if self._is_set:
+            return
+        self._is_set = True
+        try:
+            self.loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            # The loop already closed, nobody is left to wake
+            pass
+
+    def is_set(self):
+        return self._is_set
+
+    def clear(self):
+        self._is_set = False
+        self._event.clear()
+
+    async def wait(self, timeout=None):
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+# Cancels an upload task once its torrent closes, set() is called from any thread
+#
+# Registered as a ChunkManager wakeup, which is also set whenever a chunk
+# completes, so it only acts once the torrent is closed.
+class _CancelOnClose:
+    def __init__(self, loop, task, chunk_manager):
+        self.loop = loop
+        self.task = task
+        self.chunk_manager = chunk_manager
+
+    def set(self):
+        if not self.chunk_manager.is_closed:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+        except RuntimeError:
+            # The loop already closed, the task went with it
+            pass
+
+
+async def _open_peer_connection(
+    peer_ip, peer_port, peer_id, chunk_manager: ChunkManager, version
+):
+    # Creates connection to peer
+    try:
+        reader, writer = await asyncio.open_connection(peer_ip, int(peer_port))
+    except OSError:
+        logging.info(f" ASYNC_DOWNLOAD({peer_id}): Failed to connect to peer")
+        return None
+
+    # Sends hello request offering the protocol version and waits for the response
+    hello_request = Message(
+        type_=MessageType.HELLO_REQUEST,
+        version=version,
+        data=bytes.fromhex(chunk_manager.torrent_id),
+    )
+    try:
+        writer.write(hello_request.to_bytes())
+        hello_response = await asyncio.wait_for(
+            Message.from_stream(
+                reader, max_payload_length(chunk_manager.piece_size, chunk_manager.number_of_pieces)
+            ),
+            REQUEST_TIMEOUT,
+        )
+    except (OSError, ValueError, asyncio.TimeoutError):
+        hello_response = None
+
+    return reader, writer, hello_response
+
+
+def _check_message(message: Message, expected_type, writer, log_name, versions):
+    if message is None:
+        logging.info(f" {log_name}: Failed to parse message, closing connection...")
+        error_text = "Failed to parse message"
+    elif message.version not in versions:
+        logging.info(f" {log_name}: Failed to verify version number")
+        error_text = "Invalid version number"
+    elif message.type != expected_type:
+        logging.info(f" {log_name}: Message isn't a {expected_type.name.lower()}")
+        error_text = f"Expected a {expected_type.name.lower()} type"
+    else:
+        return True
+
+    writer.write(Message(MessageType.ERROR, data=error_text.encode()).to_bytes())
+    return False
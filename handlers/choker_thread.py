@@ -0,0 +1,29 @@
+import threading
+import logging
+
+from utils.upload_scheduler import UploadScheduler
+from utils.wakeup import Wakeup, wait_any
+
+# Creates choker thread
+def create_choker_thread(upload_scheduler, thread_event):
+    # Spawn a thread that chokes and unchokes upload connections
+    choker_thread = threading.Thread(
+        target=choker_task, args=(upload_scheduler, thread_event)
+    )
+    choker_thread.setName("Choker Thread")
+    choker_thread.start()
+    return choker_thread
+
+
+# Runs the upload scheduler when the slots are due to be reranked or as soon as a closed connection frees one
+def choker_task(upload_scheduler: UploadScheduler, thread_event):
+    slot_freed = Wakeup()
+    upload_scheduler.add_wakeup(slot_freed)
+    while not thread_event.is_set():
+        slot_freed.clear()
+        upload_scheduler.tick()
+        wait_any([slot_freed, thread_event], upload_scheduler.next_tick_delay())
+
+    upload_scheduler.remove_wakeup(slot_freed)
+    slot_freed.close()
+    logging.info(" CHOKER_THREAD: <<<Complete>>>")
@@ -1,20 +1,50 @@
 import threading
 import socket
 import logging
-import queue
-import hashlib
 import sys
+from collections import deque
 
 # Utility scripts
-from utils.message import Message, MessageType
-from utils.chunk_manager import ChunkManager, ChunkStatus
+from utils.message import (
+    Message,
+    MessageType,
+    MessageReader,
+    LATEST_VERSION,
+    V1_MAX_LENGTH,
+    max_payload_length,
+)
+from utils.chunk_manager import ChunkManager
+from utils.connection_manager import ConnectionManager
+from utils.piece_writer import PieceWriter
+from utils.upload_scheduler import UploadScheduler
+from utils.peer_stats import PeerStats, REQUEST_TIMEOUT
+from utils.metrics import Metrics
+from utils.wakeup import Wakeup, wait_any
 
 # Creates client thread
-def create_client_thread(peer_list_queue, chunk_manager, current_peer_id, thread_event):
+def create_client_thread(
+    chunk_manager,
+    connection_manager,
+    piece_writer,
+    upload_scheduler,
+    metrics,
+    thread_event,
+    pipeline_depth=1,
+    endgame_threshold=0,
+):
     # Spawn a thread to communicate to the tracker
     client_thread = threading.Thread(
         target=client_task,
-        args=(peer_list_queue, chunk_manager, current_peer_id, thread_event),
+        args=(
+            chunk_manager,
+            connection_manager,
+            piece_writer,
+            upload_scheduler,
+            metrics,
+            thread_event,
+            pipeline_depth,
+            endgame_threshold,
+        ),
     )
     client_thread.setName("Client Thread")
     client_thread.start()
@@ -22,95 +52,194 @@ def create_client_thread(peer_list_queue, chunk_manager, current_peer_id, thread
 
 
 # Client task to control connection to at least 5 peers
+#
+# Sleeps until the connection manager has a peer to dial, the download is
+# done or the peer closes, with a timeout only while a peer is backing off.
 def client_task(
-    peer_list_queue, chunk_manager: ChunkManager, current_peer_id, thread_event
+    chunk_manager: ChunkManager,
+    connection_manager: ConnectionManager,
+    piece_writer: PieceWriter,
+    upload_scheduler: UploadScheduler,
+    metrics: Metrics,
+    thread_event,
+    pipeline_depth=1,
+    endgame_threshold=0,
 ):
 
+    # Download threads that may still be running, joined when the client closes
+    download_threads = []
+
+    # Wakes up when peers change, the last chunk completes or the peer closes
+    wakeup = Wakeup()
+
+    def wake_when_done(index):
+        if chunk_manager.is_done():
+            wakeup.set()
+
+    connection_manager.add_wakeup(wakeup)
+    chunk_manager.add_completion_listener(wake_when_done)
+
     while 1:
+        wakeup.clear()
 
         # Checks if all blocks are collected
         if chunk_manager.is_done() is True:
             logging.info(" CLIENT_THREAD: All chunks are downloaded")
             logging.info(" CLIENT_THREAD: Creating file...")
-            chunk_hashes = list(chunk_manager.piece_status_dictionary.keys())
-            with open(f"{chunk_manager.folder}/{chunk_manager.file_name}", "ab") as torrent_file:
-                for index in range(chunk_manager.number_of_pieces):
-                    with open(
-                        f"{chunk_manager.folder}/chunks/{chunk_manager.file_name}_{index}_{chunk_hashes[index]}",
-                        "rb",
-                    ) as chunk:
-                        torrent_file.write(chunk.read())
+            piece_writer.assemble(chunk_manager)
             logging.info(" CLIENT_THREAD: Finished file")
             logging.info(" CLIENT_THREAD: Closing client thread...")
             sys.stderr.write(
                 f"Succesfully downloaded {chunk_manager.file_name}...continuing to seed torrent\n"
             )
-            return
-
-        try:
-            # Gets the list of peers available
-            peer_list = peer_list_queue.get(block=True, timeout=1)
-        except queue.Empty:
-            if thread_event.is_set():
-                logging.info(" CLIENT_THREAD: Closing client socket...")
-                logging.info(" CLIENT_THREAD: <<<Complete>>>")
-                break
-            else:
-                # Loops back up to check the queue again
-                continue
+            break
 
-        # Loops through each peer and sets up a connection
-        for peer in peer_list:
-            # Skips over own peer id
-            if peer[1] == current_peer_id:
-                continue
+        if thread_event.is_set():
+            logging.info(" CLIENT_THREAD: Closing client socket...")
+            break
 
-            # Checks if peer is already connected
+        # Dials new peers and redials dropped ones once their backoff has passed
+        for peer_address, peer_id in connection_manager.peers_to_dial(chunk_manager.torrent_id):
             download_thread = threading.Thread(
                 target=download_task,
-                args=(peer[0], peer[1], chunk_manager, thread_event),
+                args=(
+                    peer_address,
+                    peer_id,
+                    chunk_manager,
+                    connection_manager,
+                    piece_writer,
+                    upload_scheduler,
+                    metrics,
+                    thread_event,
+                    pipeline_depth,
+                    endgame_threshold,
+                ),
             )
-            download_thread.setName(f"{peer[1]}")
+            download_thread.setName(f"{peer_id}")
             download_thread.start()
-
-
-def download_task(peer_address, peer_id, chunk_manager: ChunkManager, thread_event):
+            download_threads = [thread for thread in download_threads if thread.is_alive()]
+            download_threads.append(download_thread)
+
+        wait_any([wakeup, thread_event], connection_manager.next_dial_delay(chunk_manager.torrent_id))
+
+    # Lets the download threads finish so none is left waiting on the thread event
+    for download_thread in download_threads:
+        download_thread.join()
+    chunk_manager.remove_completion_listener(wake_when_done)
+    connection_manager.remove_wakeup(wakeup)
+    wakeup.close()
+    if thread_event.is_set():
+        logging.info(" CLIENT_THREAD: <<<Complete>>>")
+
+
+def download_task(
+    peer_address,
+    peer_id,
+    chunk_manager: ChunkManager,
+    connection_manager: ConnectionManager,
+    piece_writer: PieceWriter,
+    upload_scheduler: UploadScheduler,
+    metrics: Metrics,
+    thread_event,
+    pipeline_depth=1,
+    endgame_threshold=0,
+):
     peer_ip, peer_port = peer_address.split(":")
 
-    # Creates connection to peer
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Connects with the newest protocol version and falls back to version 1 for old peers
+    for version in (LATEST_VERSION, 1):
+        connection = _connect_to_peer(peer_ip, peer_port, peer_id, chunk_manager, version)
+        if connection is None:
+            connection_manager.connection_failed(chunk_manager.torrent_id, peer_id)
+            return
+        client_socket, message_reader, hello_response = connection
+        if version == 1 or (
+            hello_response is not None and hello_response.type != MessageType.ERROR
+        ):
+            break
+        logging.info(
+            f" DOWNLOAD_THREAD({peer_id}): Peer rejected version {version}, retrying with version 1"
+        )
+        client_socket.close()
+
+    # Checks response if its valid, a connection that drops while the error is sent failed all the same
     try:
-        client_socket.connect((peer_ip, int(peer_port)))
-    except:
-        logging.info(f" DOWNLOAD_THREAD({peer_id}): Failed to connect to peer")
+        is_valid = _check_hello_response(hello_response, client_socket, peer_id, version) == 0
+    except OSError:
+        client_socket.close()
+        is_valid = False
+    if not is_valid:
+        connection_manager.connection_failed(chunk_manager.torrent_id, peer_id)
         return
+    version = hello_response.version
 
-    # Sends hello request
-    hello_request = Message(
-        type_=MessageType.HELLO_REQUEST,
-        data=bytes.fromhex(chunk_manager.torrent_id),
-    ).to_bytes()
-    client_socket.sendall(hello_request)
-
-    # Waits until hello response is received
-    hello_response = Message.from_socket(socket=client_socket)
-
-    # Checks response if its valid
-    if _check_hello_response(hello_response, client_socket, peer_id) == 1:
+    # Checks that pieces fit in the negotiated message length
+    if version == 1 and chunk_manager.piece_size > V1_MAX_LENGTH:
+        logging.info(
+            f" DOWNLOAD_THREAD({peer_id}): Pieces are too big for protocol version 1, closing connection..."
+        )
+        client_socket.close()
+        connection_manager.connection_failed(chunk_manager.torrent_id, peer_id)
         return
+    peer_stats = PeerStats(chunk_manager.piece_size, pipeline_depth)
+    connection_manager.connection_opened(chunk_manager.torrent_id, peer_id, peer_stats)
 
     # Checks peers avaialbe chunks and requests for a valid chunk
-    avalible_chunks = bin(int.from_bytes(hello_response.data, byteorder="big"))[2:]
-    logging.info(f' DOWNLOAD_THREAD({peer_id}): Chunks avalible "{avalible_chunks}"')
+    avalible_chunks = chunk_manager.peer_bitfield(hello_response.data)
+    logging.info(f' DOWNLOAD_THREAD({peer_id}): Chunks avalible "{avalible_chunks.hex()}"')
+    chunk_manager.add_peer(avalible_chunks)
 
     # Loops until thread event is triggerd or is finshed
-    while not thread_event.is_set():
-        if (
-            isFinshed := _download_chunks(
-                chunk_manager, avalible_chunks, peer_id, client_socket
-            )
-        ) is True:
-            break
+    outstanding_chunks = deque()
+    # Set by a piece writer worker when a piece from this peer fails its hash check
+    hash_failed = Wakeup()
+    # Set while the peer has choked us and won't take new piece requests
+    peer_choked = threading.Event()
+    # Set when a chunk is given back or completes, so a connection with requests to spare can claim again
+    chunks_changed = Wakeup()
+    chunk_manager.add_wakeup(chunks_changed)
+    try:
+        # Times out a peer that stops partway through a message
+        client_socket.settimeout(REQUEST_TIMEOUT)
+
+        while not thread_event.is_set():
+            if (
+                isFinshed := _download_chunks(
+                    chunk_manager,
+                    piece_writer,
+                    upload_scheduler,
+                    metrics,
+                    avalible_chunks,
+                    peer_id,
+                    peer_ip,
+                    client_socket,
+                    message_reader,
+                    version,
+                    outstanding_chunks,
+                    hash_failed,
+                    peer_choked,
+                    chunks_changed,
+                    peer_stats,
+                    thread_event,
+                    endgame_threshold,
+                )
+            ) is True:
+                break
+    except OSError:
+        logging.info(f" DOWNLOAD_THREAD({peer_id}): Request timed out or connection was lost")
+    finally:
+        client_socket.close()
+
+        # Gives back any requested chunks that never arrived
+        _release_chunks(chunk_manager, outstanding_chunks)
+        chunk_manager.remove_peer(avalible_chunks)
+        chunk_manager.remove_wakeup(chunks_changed)
+        chunks_changed.close()
+        hash_failed.close()
+        if peer_stats.is_snubbed:
+            connection_manager.connection_snubbed(chunk_manager.torrent_id, peer_id)
+        else:
+            connection_manager.connection_closed(chunk_manager.torrent_id, peer_id)
 
     logging.info(f" DOWNLOAD_THREAD({peer_id}): Closing connection to peer")
 
@@ -118,7 +247,37 @@ def download_task(peer_address, peer_id, chunk_manager: ChunkManager, thread_eve
 # *PRIVATE HELPER FUNCTIONS*
 
 
-def _check_hello_response(hello_response: Message, client_socket, peer_id):
+def _connect_to_peer(peer_ip, peer_port, peer_id, chunk_manager: ChunkManager, version):
+    # Creates connection to peer
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        client_socket.connect((peer_ip, int(peer_port)))
+    except OSError:
+        logging.info(f" DOWNLOAD_THREAD({peer_id}): Failed to connect to peer")
+        client_socket.close()
+        return None
+
+    # Sends hello request offering the protocol version
+    hello_request = Message(
+        type_=MessageType.HELLO_REQUEST,
+        version=version,
+        data=bytes.fromhex(chunk_manager.torrent_id),
+    )
+
+    # Waits until hello response is received, a dropped connection counts as no response
+    message_reader = MessageReader(
+        client_socket, max_length=max_payload_length(chunk_manager.piece_size, chunk_manager.number_of_pieces)
+    )
+    try:
+        hello_request.send(client_socket)
+        hello_response = message_reader.read()
+    except (OSError, ValueError):
+        hello_response = None
+
+    return client_socket, message_reader, hello_response
+
+
+def _check_hello_response(hello_response: Message, client_socket, peer_id, offered_version):
     if hello_response is None:
         logging.info(
             f" DOWNLOAD_THREAD({peer_id}): Failed to parse response, closing connection..."
@@ -129,7 +288,7 @@ def _check_hello_response(hello_response: Message, client_socket, peer_id):
         client_socket.sendall(error_message.to_bytes())
         client_socket.close()
         return 1
-    elif hello_response.version != 1:
+    elif not 1 <= hello_response.version <= offered_version:
         logging.info(f" DOWNLOAD_THREAD({peer_id}): Failed to verify version number")
         error_message = Message(
             MessageType.ERROR, data="Invalid version number".encode()
@@ -149,9 +308,7 @@ def _check_hello_response(hello_response: Message, client_socket, peer_id):
     return 0
 
 
-def _check_piece_response(
-    piece_response: Message, client_socket, peer_id, requested_piece_hash
-):
+def _check_piece_response(piece_response: Message, client_socket, peer_id, version):
     if piece_response is None:
         logging.info(
             f" DOWNLOAD_THREAD({peer_id}): Failed to parse response, closing connection..."
@@ -162,7 +319,7 @@ def _check_piece_response(
         client_socket.sendall(error_message.to_bytes())
         client_socket.close()
         return False
-    elif piece_response.version != 1:
+    elif piece_response.version != version:
         logging.info(f" DOWNLOAD_THREAD({peer_id}): Failed to verify version number")
         error_message = Message(
             MessageType.ERROR, data="Invalid version number".encode()
@@ -178,95 +335,143 @@ def _check_piece_response(
         client_socket.sendall(error_message.to_bytes())
         client_socket.close()
         return False
-    # Checks that the hash is correct
-    elif _verify_hash(piece_response.data, requested_piece_hash) is False:
+
+    return True
+
+
+def _release_chunks(chunk_manager: ChunkManager, outstanding_chunks):
+    while outstanding_chunks:
+        index, _ = outstanding_chunks.popleft()
+        chunk_manager.release_chunk(index)
+
+
+def _download_chunks(
+    chunk_manager: ChunkManager,
+    piece_writer: PieceWriter,
+    upload_scheduler: UploadScheduler,
+    metrics: Metrics,
+    avalible_chunks,
+    peer_id,
+    peer_ip,
+    client_socket,
+    message_reader: MessageReader,
+    version,
+    outstanding_chunks,
+    hash_failed,
+    peer_choked,
+    chunks_changed,
+    peer_stats: PeerStats,
+    thread_event,
+    endgame_threshold,
+):
+    # Stops trusting the peer once one of its pieces had the wrong hash
+    if hash_failed.is_set():
         logging.info(f" DOWNLOAD_THREAD({peer_id}): Hash is incorrect")
         error_message = Message(
             MessageType.ERROR, data="Hash value is incorrect".encode()
         )
         client_socket.sendall(error_message.to_bytes())
         client_socket.close()
-        return False
+        _release_chunks(chunk_manager, outstanding_chunks)
+        return True
 
-    return True
+    # Gives the requested chunks back to other peers once this one is too slow
+    if peer_stats.check_snubbed():
+        logging.info(
+            f" DOWNLOAD_THREAD({peer_id}): Peer is too slow, giving back {len(outstanding_chunks)} chunks"
+        )
+        client_socket.close()
+        _release_chunks(chunk_manager, outstanding_chunks)
+        return True
 
+    # Keeps as many piece requests in flight as the peer's rate calls for unless the peer choked us
+    num_of_bytes_needed = (chunk_manager.number_of_pieces.bit_length() + 7) // 8
+    pipeline_depth = peer_stats.pipeline_depth()
+    while len(outstanding_chunks) < pipeline_depth and not peer_choked.is_set():
+        # Claims the next missing chunk the peer has, or a duplicate of a downloading one in endgame
+        claimed_chunk = chunk_manager.claim_chunk(
+            avalible_chunks,
+            {index for index, _ in outstanding_chunks},
+            endgame_threshold,
+        )
+        if claimed_chunk is None:
+            # Looks again after clearing a pending wakeup so a chunk given back in between isn't missed
+            if chunks_changed.is_set():
+                chunks_changed.clear()
+                continue
+            break
+        index, _ = claimed_chunk
+        logging.info(f" DOWNLOAD_THREAD({peer_id}): Downloading chunk {index + 1}")
+        payload = int.to_bytes(index, byteorder="big", length=num_of_bytes_needed)
+
+        # Creates piece request and sends it to peer
+        piece_request = Message(type_=MessageType.PIECE_REQUEST, version=version, data=payload)
+        logging.info(f" DOWNLOAD_THREAD({peer_id}): Sending piece request {payload}")
+        piece_request.send(client_socket)
+        outstanding_chunks.append(claimed_chunk)
+        peer_stats.request_sent()
+
+    # Checks if the peer has nothing left that we need
+    if not outstanding_chunks:
+        # Only version 2 peers announce chunks they finish later, so only they are worth waiting on
+        if version == 1 or chunk_manager.is_done():
+            logging.info(
+                f" DOWNLOAD_THREAD({peer_id}): Finsihed downloading all avaliable chunks"
+            )
+            return True
+
+    # Sleeps until the next message, a request timing out, a bad hash or shutdown,
+    # and with requests to spare until a chunk may be claimable again
+    waitables = [client_socket, thread_event, hash_failed]
+    if len(outstanding_chunks) < pipeline_depth and not peer_choked.is_set():
+        waitables.append(chunks_changed)
+    if client_socket not in wait_any(waitables, peer_stats.time_left()):
+        return False
 
-def _verify_hash(data, expected_hash):
-    actual_hash = hashlib.sha1(data).hexdigest()
+    # Collects the next message, responses come back in the order they were requested
+    piece_response = message_reader.read()
 
-    # Verifys that the hashes match
-    if actual_hash == expected_hash:
-        return True
-    else:
+    # Updates the peer's bitfield when it announces a new chunk
+    if piece_response is not None and piece_response.type == MessageType.HAVE:
+        index = int.from_bytes(piece_response.data, "big")
+        logging.info(f" DOWNLOAD_THREAD({peer_id}): Peer now has chunk {index + 1}")
+        chunk_manager.add_peer_chunk(avalible_chunks, index)
         return False
 
-
-def _download_chunks(
-    chunk_manager: ChunkManager, avalible_chunks, peer_id, client_socket
-):
-    # Loops through the status map and checks for a match
-    index = 0
-    requested_piece_hash = b""
-    payload = b""
-    is_finshed = True
-    for key in chunk_manager.piece_status_dictionary:
-        # Checks if piece is missing
-        if chunk_manager.piece_status_dictionary[key] == ChunkStatus.MISSING:
-            # Checks if the peers has the piece and that this is the first match
-            if avalible_chunks[index : index + 1] == "1":
-                logging.info(
-                    f" DOWNLOAD_THREAD({peer_id}): Downloading chunk {index + 1}"
-                )
-                num_of_bytes_needed = (
-                    chunk_manager.number_of_pieces.bit_length() + 7
-                ) // 8
-                payload = int.to_bytes(
-                    index, byteorder="big", length=num_of_bytes_needed
-                )
-                chunk_manager.piece_status_dictionary[key] = ChunkStatus.DOWNLOADING
-                requested_piece_hash = key
-                is_finshed = False
-                break
+    # Stops or resumes requesting, requests already sent are still answered after a choke
+    if piece_response is not None and piece_response.type in (MessageType.CHOKE, MessageType.UNCHOKE):
+        logging.info(f" DOWNLOAD_THREAD({peer_id}): Peer sent {piece_response.type.name.lower()}")
+        if piece_response.type == MessageType.CHOKE:
+            peer_choked.set()
         else:
-            index += 1
+            peer_choked.clear()
+        return False
 
-    # Checks if index reached the end of loop and is still set to finsihed
-    if (index == chunk_manager.number_of_pieces) and (is_finshed == True):
-        return is_finshed
+    # Anything else while idle means the peer closed or broke the protocol
+    if not outstanding_chunks:
+        logging.info(f" DOWNLOAD_THREAD({peer_id}): Peer closed idle connection")
+        client_socket.close()
+        return True
+    index, requested_piece_hash = outstanding_chunks[0]
 
-    # Creates piece request and sends it to peer
-    piece_request = Message(type_=MessageType.PIECE_REQUEST, data=payload).to_bytes()
-    logging.info(f" DOWNLOAD_THREAD({peer_id}): Sending piece request {piece_request}")
-    client_socket.sendall(piece_request)
+    # Checks that the piece is valid
+    if _check_piece_response(piece_response, client_socket, peer_id, version) is False:
+        _release_chunks(chunk_manager, outstanding_chunks)
+        return True
+    outstanding_chunks.popleft()
+    latency = peer_stats.piece_received(len(piece_response.data))
+    metrics.record_download(len(piece_response.data), latency)
+    upload_scheduler.record_download(peer_ip, len(piece_response.data))
+
+    # Drops the piece if another peer already delivered it during endgame
+    if chunk_manager.is_chunk_available(index):
+        logging.info(f" DOWNLOAD_THREAD({peer_id}): Dropping duplicate chunk {index + 1}")
+        chunk_manager.release_chunk(index)
+        return False
 
-    # Collects piece from peer
-    piece_response = Message.from_socket(client_socket)
+    # Hands the piece to the writer pool to be verified and saved, blocks while its queue is full
+    piece_writer.submit(
+        chunk_manager, index, piece_response.data, requested_piece_hash, hash_failed.set
+    )
 
-    # Checks that the piece is valid
-    if (
-        _check_piece_response(
-            piece_response, client_socket, peer_id, requested_piece_hash
-        )
-        is False
-    ):
-        is_finshed = True
-        chunk_manager.piece_status_dictionary[
-            requested_piece_hash
-        ] = ChunkStatus.MISSING
-        return is_finshed
-
-    # Saves piece to chunk file and stores file id in dicitionary
-    with open(
-        f"{chunk_manager.folder}/chunks/{chunk_manager.file_name}_{index}_{requested_piece_hash}",
-        "wb",
-    ) as chunk_file:
-        chunk_file.write(piece_response.data)
-        chunk_manager.piece_status_dictionary[
-            requested_piece_hash
-        ] = ChunkStatus.AVAILABLE
-
-    if is_finshed == True:
-        logging.info(
-            f" DOWNLOAD_THREAD({peer_id}): Finsihed downloading all avaliable chunks"
-        )
-    return is_finshed
\ No newline at end of file
+    return False
@@ -0,0 +1,200 @@
+import threading
+import os
+import json
+import logging
+
+from handlers.tracker_thread import create_tracker_thread
+from handlers.client_thread import create_client_thread
+from utils.chunk_manager import ChunkManager
+from utils.torrent_registry import TorrentRegistry
+from utils.connection_manager import ConnectionManager
+from utils.wakeup import Wakeup
+
+# Seconds between scans of the torrent folder for added or removed torrents
+SCAN_INTERVAL = 5
+
+# Creates daemon thread
+def create_daemon_thread(
+    torrent_folder,
+    registry,
+    connection_manager,
+    piece_writer,
+    piece_cache,
+    piece_reader,
+    upload_scheduler,
+    metrics,
+    peer_id,
+    ip_address,
+    port_number,
+    folder,
+    thread_event,
+    storage="file",
+    pipeline_depth=1,
+    endgame_threshold=0,
+    tracker_timeout=10,
+):
+    # Spawn a thread that keeps the running torrents in sync with the torrent folder
+    daemon_thread = threading.Thread(
+        target=daemon_task,
+        args=(
+            torrent_folder,
+            registry,
+            connection_manager,
+            piece_writer,
+            piece_cache,
+            piece_reader,
+            upload_scheduler,
+            metrics,
+            peer_id,
+            ip_address,
+            port_number,
+            folder,
+            thread_event,
+            storage,
+            pipeline_depth,
+            endgame_threshold,
+            tracker_timeout,
+        ),
+    )
+    daemon_thread.setName("Daemon Thread")
+    daemon_thread.start()
+    return daemon_thread
+
+
+# Starts every torrent dropped into the torrent folder and stops the ones taken out of it
+#
+# Each torrent gets its own tracker and client thread, while the upload
+# server, upload slots, connection limit, piece writer and reader pools and piece
+# cache are shared.
+def daemon_task(
+    torrent_folder,
+    registry: TorrentRegistry,
+    connection_manager: ConnectionManager,
+    piece_writer,
+    piece_cache,
+    piece_reader,
+    upload_scheduler,
+    metrics,
+    peer_id,
+    ip_address,
+    port_number,
+    folder,
+    thread_event,
+    storage="file",
+    pipeline_depth=1,
+    endgame_threshold=0,
+    tracker_timeout=10,
+):
+    # Running torrents by the path of their torrent file
+    torrents = {}
+    # Torrent files that couldn't be started with the mtime they had, so they're only retried once changed
+    failed_files = {}
+
+    def start_torrent(torrent_path):
+        # Opens the json file and loads it into a dictionary
+        with open(torrent_path, "r") as torrent:
+            json_data = json.load(torrent)
+
+        # Skips a second torrent file for a torrent that is already running
+        if registry.get(bytes.fromhex(json_data["torrent_id"])) is not None:
+            raise ValueError(f"torrent {json_data['torrent_id']} is already running")
+
+        chunk_manager = ChunkManager(
+            file_name=json_data["file_name"],
+            file_size=json_data["file_size"],
+            piece_size=json_data["piece_size"],
+            pieces=json_data["pieces"],
+            torrent_id=json_data["torrent_id"],
+            folder=folder,
+            storage=storage,
+            piece_cache=piece_cache,
+            piece_reader=piece_reader,
+        )
+        registry.add(chunk_manager)
+
+        # Stops only this torrent's threads when it is removed
+        torrent_event = Wakeup()
+        tracker_thread = create_tracker_thread(
+            peer_id=peer_id,
+            ip_address=ip_address,
+            port_number=port_number,
+            torrent_id=json_data["torrent_id"],
+            tracker_url=json_data["tracker_url"],
+            thread_event=torrent_event,
+            chunk_manager=chunk_manager,
+            connection_manager=connection_manager,
+            timeout=tracker_timeout,
+        )
+        client_thread = create_client_thread(
+            chunk_manager=chunk_manager,
+            connection_manager=connection_manager,
+            piece_writer=piece_writer,
+            upload_scheduler=upload_scheduler,
+            metrics=metrics,
+            thread_event=torrent_event,
+            pipeline_depth=pipeline_depth,
+            endgame_threshold=endgame_threshold,
+        )
+        return {
+            "chunk_manager": chunk_manager,
+            "event": torrent_event,
+            "threads": [tracker_thread, client_thread],
+        }
+
+    def stop_torrent(torrent):
+        # Stops new uploads first, then waits for the torrent's threads and queued pieces before closing its storage
+        chunk_manager = torrent["chunk_manager"]
+        registry.remove(chunk_manager.torrent_id)
+        torrent["event"].set()
+        for torrent_thread in torrent["threads"]:
+            torrent_thread.join()
+        connection_manager.remove_torrent(chunk_manager.torrent_id)
+        piece_writer.drain(chunk_manager)
+        chunk_manager.close()
+        torrent["event"].close()
+
+    while not thread_event.is_set():
+        # Lists the torrent files currently in the folder
+        try:
+            torrent_paths = {
+                os.path.join(torrent_folder, name)
+                for name in os.listdir(torrent_folder)
+                if name.endswith(".ntorrent")
+            }
+        except OSError:
+            logging.info(f" DAEMON_THREAD: Failed to read torrent folder {torrent_folder}")
+            torrent_paths = set(torrents)
+
+        # Stops torrents whose file was removed
+        for torrent_path in set(torrents) - torrent_paths:
+            logging.info(f" DAEMON_THREAD: Removing torrent {torrent_path}")
+            stop_torrent(torrents.pop(torrent_path))
+
+        # Starts torrents whose file was added
+        for torrent_path in sorted(torrent_paths - set(torrents)):
+            try:
+                mtime = os.stat(torrent_path).st_mtime_ns
+            except OSError:
+                continue
+            if failed_files.get(torrent_path) == mtime:
+                continue
+            try:
+                torrents[torrent_path] = start_torrent(torrent_path)
+                failed_files.pop(torrent_path, None)
+                logging.info(f" DAEMON_THREAD: Added torrent {torrent_path}")
+            except (OSError, ValueError, KeyError, TypeError) as error:
+                logging.info(f" DAEMON_THREAD: Failed to start torrent {torrent_path} ({error})")
+                failed_files[torrent_path] = mtime
+        for torrent_path in set(failed_files) - torrent_paths:
+            del failed_files[torrent_path]
+
+        # Waits for the next scan, the folder has to be polled but shutdown is noticed right away
+        thread_event.wait(SCAN_INTERVAL)
+
+    # Stops every torrent on shutdown
+    logging.info(" DAEMON_THREAD: Stopping torrents...")
+    for torrent in torrents.values():
+        torrent["event"].set()
+    for torrent in torrents.values():
+        stop_torrent(torrent)
+    logging.info(" DAEMON_THREAD: <<<Complete>>>")
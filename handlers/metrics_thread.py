@@ -0,0 +1,276 @@
+import threading
+import logging
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.metrics import Metrics
+from utils.torrent_registry import TorrentRegistry
+from utils.connection_manager import ConnectionManager
+from utils.upload_scheduler import UploadScheduler
+from utils.piece_writer import PieceWriter
+from utils.wakeup import wait_any
+
+# Prefix of every exported Prometheus metric
+METRIC_PREFIX = "ntorrent_"
+
+# Creates metrics thread
+def create_metrics_thread(
+    metrics_port,
+    metrics,
+    registry,
+    connection_manager,
+    upload_scheduler,
+    piece_writer,
+    piece_reader,
+    piece_cache,
+    thread_event,
+):
+    # Spawn a thread that serves the metrics endpoint
+    metrics_thread = threading.Thread(
+        target=metrics_task,
+        args=(
+            metrics_port,
+            metrics,
+            registry,
+            connection_manager,
+            upload_scheduler,
+            piece_writer,
+            piece_reader,
+            piece_cache,
+            thread_event,
+        ),
+    )
+    metrics_thread.setName("Metrics Thread")
+    metrics_thread.start()
+    return metrics_thread
+
+
+# Serves the counters on localhost, /metrics in the Prometheus text format and /metrics.json as JSON
+#
+# Nothing is computed until a request comes in, so the endpoint costs the
+# transfer nothing between scrapes.
+def metrics_task(
+    metrics_port,
+    metrics: Metrics,
+    registry: TorrentRegistry,
+    connection_manager: ConnectionManager,
+    upload_scheduler: UploadScheduler,
+    piece_writer: PieceWriter,
+    piece_reader,
+    piece_cache,
+    thread_event,
+):
+    def collect():
+        snapshot = metrics.snapshot()
+        snapshot.update(
+            {
+                "hash_failures": piece_writer.hash_failures,
+                "pieces_written": piece_writer.pieces_written,
+                "writer_queue": piece_writer.queued(),
+                "storage_writes": piece_writer.writes,
+                "storage_syncs": piece_writer.syncs,
+                "reader_queue": piece_reader.queued() if piece_reader is not None else None,
+                "snubbed_peers": connection_manager.snubbed_count,
+                "active_connections": connection_manager.active_count(),
+                "threads": threading.active_count(),
+                "piece_cache": piece_cache.stats() if piece_cache is not None else None,
+                "torrents": [
+                    {
+                        "torrent_id": chunk_manager.torrent_id,
+                        "file_name": chunk_manager.file_name,
+                        "pieces": chunk_manager.number_of_pieces,
+                        "pieces_left": chunk_manager.number_of_pieces - chunk_manager.available_count,
+                        "bytes_left": chunk_manager.bytes_left(),
+                        "downloaded_bytes": chunk_manager.bytes_downloaded,
+                        "uploaded_bytes": chunk_manager.bytes_uploaded,
+                    }
+                    for chunk_manager in registry.chunk_managers()
+                ],
+                "download_connections": [
+                    connection
+                    for connection in connection_manager.connections()
+                    if connection["state"] == "connected"
+                ],
+                "upload_slots": upload_scheduler.peers(),
+            }
+        )
+        return snapshot
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = _to_prometheus(collect()).encode()
+                content_type = "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body = json.dumps(collect()).encode()
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.info(f" METRICS_THREAD: {self.address_string()} {format % args}")
+
+    # Creates the http server, only reachable from this machine
+    server = ThreadingHTTPServer(("127.0.0.1", metrics_port), MetricsHandler)
+    server.daemon_threads = True
+    logging.info(f" METRICS_THREAD: Serving metrics on http://127.0.0.1:{metrics_port}/metrics")
+
+    # Handles requests as they come in until the thread event is triggered
+    while not thread_event.is_set():
+        if server in wait_any([server, thread_event]):
+            server.handle_request()
+
+    server.server_close()
+    logging.info(" METRICS_THREAD: <<<Complete>>>")
+
+
+# *PRIVATE HELPER FUNCTIONS*
+
+
+def _to_prometheus(snapshot):
+    lines = []
+
+    def add(name, type_, help_, samples):
+        lines.append(f"# HELP {METRIC_PREFIX}{name} {help_}")
+        lines.append(f"# TYPE {METRIC_PREFIX}{name} {type_}")
+        for labels, value in samples:
+            lines.append(f"{METRIC_PREFIX}{name}{_labels(labels)} {value}")
+
+    add("uptime_seconds", "gauge", "Seconds since the peer started.", [({}, snapshot["uptime"])])
+    add("downloaded_bytes_total", "counter", "Piece bytes received from peers.", [({}, snapshot["downloaded_bytes"])])
+    add("downloaded_pieces_total", "counter", "Pieces received from peers.", [({}, snapshot["downloaded_pieces"])])
+    add("uploaded_bytes_total", "counter", "Piece bytes sent to peers.", [({}, snapshot["uploaded_bytes"])])
+    add("uploaded_pieces_total", "counter", "Pieces sent to peers.", [({}, snapshot["uploaded_pieces"])])
+    add("download_rate_bytes", "gauge", "Recent download rate in bytes per second.", [({}, snapshot["download_rate"])])
+    add("upload_rate_bytes", "gauge", "Recent upload rate in bytes per second.", [({}, snapshot["upload_rate"])])
+
+    # Histogram buckets are cumulative in the text format
+    latency = snapshot["request_latency"]
+    samples = []
+    cumulative = 0
+    for bound, count in latency["buckets"]:
+        cumulative += count
+        samples.append(({"le": bound}, cumulative))
+    samples.append(({"le": "+Inf"}, latency["count"]))
+    lines.append(f"# HELP {METRIC_PREFIX}request_latency_seconds Seconds from sending a piece request to receiving the piece.")
+    lines.append(f"# TYPE {METRIC_PREFIX}request_latency_seconds histogram")
+    for labels, value in samples:
+        lines.append(f"{METRIC_PREFIX}request_latency_seconds_bucket{_labels(labels)} {value}")
+    lines.append(f"{METRIC_PREFIX}request_latency_seconds_sum {latency['sum']}")
+    lines.append(f"{METRIC_PREFIX}request_latency_seconds_count {latency['count']}")
+
+    add("hash_failures_total", "counter", "Downloaded pieces that failed their hash check.", [({}, snapshot["hash_failures"])])
+    add("pieces_written_total", "counter", "Verified pieces saved to storage.", [({}, snapshot["pieces_written"])])
+    add("writer_queue_pieces", "gauge", "Pieces waiting to be verified and saved.", [({}, snapshot["writer_queue"])])
+    add("storage_writes_total", "counter", "Writes of adjacent verified pieces to storage.", [({}, snapshot["storage_writes"])])
+    add("storage_syncs_total", "counter", "Flushes of written pieces to the disk.", [({}, snapshot["storage_syncs"])])
+    if snapshot["reader_queue"] is not None:
+        add("reader_queue_pieces", "gauge", "Upload reads waiting for the disk.", [({}, snapshot["reader_queue"])])
+    add("snubbed_peers_total", "counter", "Download connections closed for being too slow.", [({}, snapshot["snubbed_peers"])])
+    add("active_connections", "gauge", "Download connections open or being dialed.", [({}, snapshot["active_connections"])])
+    add("upload_connections", "gauge", "Upload connections open.", [({}, len(snapshot["upload_connections"]))])
+    add("threads", "gauge", "Threads running in the process.", [({}, snapshot["threads"])])
+    if (cache := snapshot["piece_cache"]) is not None:
+        add("piece_cache_hits_total", "counter", "Uploads served from the piece cache.", [({}, cache["hits"])])
+        add("piece_cache_misses_total", "counter", "Uploads read from storage.", [({}, cache["misses"])])
+        add("piece_cache_bytes", "gauge", "Bytes held in the piece cache.", [({}, cache["bytes"])])
+
+    torrents = snapshot["torrents"]
+    for name, key, type_, help_ in (
+        ("torrent_pieces", "pieces", "gauge", "Pieces in the torrent."),
+        ("torrent_pieces_left", "pieces_left", "gauge", "Pieces still missing."),
+        ("torrent_bytes_left", "bytes_left", "gauge", "Bytes still missing."),
+        ("torrent_downloaded_bytes_total", "downloaded_bytes", "counter", "Verified bytes saved this session."),
+        ("torrent_uploaded_bytes_total", "uploaded_bytes", "counter", "Bytes uploaded this session."),
+    ):
+        add(name, type_, help_, [({"torrent": torrent["torrent_id"]}, torrent[key]) for torrent in torrents])
+
+    downloads = snapshot["download_connections"]
+    add(
+        "peer_download_rate_bytes",
+        "gauge",
+        "Recent download rate of each download connection in bytes per second.",
+        [(_peer_labels(connection), connection["download_rate"]) for connection in downloads],
+    )
+    add(
+        "peer_pieces_per_second",
+        "gauge",
+        "Recent pieces per second of each download connection.",
+        [(_peer_labels(connection), connection["pieces_per_second"]) for connection in downloads],
+    )
+    add(
+        "peer_downloaded_bytes_total",
+        "counter",
+        "Piece bytes received on each download connection.",
+        [(_peer_labels(connection), connection["downloaded_bytes"]) for connection in downloads],
+    )
+
+    uploads = snapshot["upload_connections"]
+    add(
+        "peer_uploaded_bytes_total",
+        "counter",
+        "Piece bytes sent on each upload connection.",
+        [({"address": upload["address"]}, upload["uploaded_bytes"]) for upload in uploads],
+    )
+    add(
+        "peer_uploaded_pieces_total",
+        "counter",
+        "Pieces sent on each upload connection.",
+        [({"address": upload["address"]}, upload["uploaded_pieces"]) for upload in uploads],
+    )
+
+    # Upload slots of version 2 connections, with the rates they are ranked by
+    slots = snapshot["upload_slots"]
+    add(
+        "peer_upload_rate_bytes",
+        "gauge",
+        "Recent upload rate of each version 2 upload connection in bytes per second.",
+        [(_slot_labels(slot), slot["upload_rate"]) for slot in slots],
+    )
+    add(
+        "peer_ranked_download_rate_bytes",
+        "gauge",
+        "Recent download rate from the IP of each version 2 upload connection, which upload slots are ranked by.",
+        [(_slot_labels(slot), slot["download_rate"]) for slot in slots],
+    )
+    add(
+        "peer_choked",
+        "gauge",
+        "Whether each version 2 upload connection is choked.",
+        [(_slot_labels(slot), int(slot["choked"])) for slot in slots],
+    )
+    add(
+        "peer_optimistic_unchoke",
+        "gauge",
+        "Whether each version 2 upload connection holds the optimistic unchoke.",
+        [(_slot_labels(slot), int(slot["optimistic"])) for slot in slots],
+    )
+    return "\n".join(lines) + "\n"
+
+
+def _slot_labels(slot):
+    return {"peer": slot["ip"], "address": slot["address"]}
+
+
+def _peer_labels(connection):
+    return {
+        "torrent": connection["torrent_id"],
+        "peer_id": connection["peer_id"],
+        "address": connection["address"],
+    }
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -2,14 +2,29 @@ import threading
 import logging
 import socket
 
-from utils.message import Message, MessageType
-from utils.chunk_manager import ChunkStatus, ChunkManager
+from utils.message import (
+    Message,
+    MessageType,
+    MessageReader,
+    SUPPORTED_VERSIONS,
+    V1_MAX_LENGTH,
+    HAVE_INDEX_SIZE,
+    max_payload_length,
+)
+from utils.chunk_manager import ChunkManager
+from utils.torrent_registry import TorrentRegistry
+from utils.upload_scheduler import UploadScheduler
+from utils.metrics import Metrics
+from utils.wakeup import Wakeup, wait_any
+
+# Seconds a send to or a half received message from an upload peer may stall before the connection is dropped
+UPLOAD_TIMEOUT = 30
 
 # Creates tracker thread
-def create_server_thread(server_port, chunk_manager, thread_event):
+def create_server_thread(server_port, registry, upload_scheduler, metrics, thread_event):
     # Spawn a thread to communicate to the tracker
     server_thread = threading.Thread(
-        target=server_task, args=(server_port, chunk_manager, thread_event)
+        target=server_task, args=(server_port, registry, upload_scheduler, metrics, thread_event)
     )
     server_thread.setName("Server Thread")
     server_thread.start()
@@ -17,77 +32,169 @@ def create_server_thread(server_port, chunk_manager, thread_event):
 
 
 # Sever task controls creation of child task to upload file chunks to other peers
-def server_task(server_port, chunk_manager, thread_event):
+def server_task(server_port, registry: TorrentRegistry, upload_scheduler, metrics, thread_event):
 
     # Creates a server socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind(("", server_port))
     server_socket.listen()
-    server_socket.settimeout(1)
+    # Never blocks in accept when a connection is dropped between select and accept
+    server_socket.setblocking(False)
     logging.info(f" SERVER_THREAD: Created server on port {server_port}")
 
-    # Loops passing on new connection to upload_task
+    # Loops passing on new connection to upload_task, sleeping until a peer connects or the peer closes
     while 1:
+        wait_any([server_socket, thread_event])
+        if thread_event.is_set():
+            logging.info(f" SERVER_THREAD: Closing server socket...")
+            server_socket.close()
+            break
         try:
             conn, addr = server_socket.accept()
-            logging.info(
-                f" SERVER_THREAD: Accepted new upload peer @ {addr[0]}:{addr[1]}"
-            )
-            upload_peer = threading.Thread(
-                target=upload_task, args=(conn, addr, chunk_manager, thread_event), daemon=True
-            )
-            upload_peer.setName(f"Upload Peer:{addr[0]}")
-            upload_peer.start()
-        except socket.timeout:
-            if thread_event.is_set():
-                logging.info(f" SERVER_THREAD: Closing server socket...")
-                server_socket.close()
-                break
+        except OSError:
+            continue
+        logging.info(
+            f" SERVER_THREAD: Accepted new upload peer @ {addr[0]}:{addr[1]}"
+        )
+        upload_peer = threading.Thread(
+            target=upload_task,
+            args=(conn, addr, registry, upload_scheduler, metrics, thread_event),
+            daemon=True,
+        )
+        upload_peer.setName(f"Upload Peer:{addr[0]}")
+        upload_peer.start()
 
     logging.info(f" SERVER_THREAD: <<<Complete>>>")
 
 
 # Sends the request chunk to the connected peer
-def upload_task(conn, addr, chunk_manager: ChunkManager, thread_event):
+def upload_task(
+    conn,
+    addr,
+    registry: TorrentRegistry,
+    upload_scheduler: UploadScheduler,
+    metrics: Metrics,
+    thread_event,
+):
+
+    # Drops peers that stop reading or stall halfway through a message instead of blocking forever
+    conn.settimeout(UPLOAD_TIMEOUT)
 
     # Handles hello request from peer
-    hello_request = Message.from_socket(conn)
+    message_reader = MessageReader(conn)
+    try:
+        hello_request = message_reader.read()
+    except OSError:
+        logging.info(f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Connection to peer was lost")
+        conn.close()
+        return
 
-    # Checks that peers message request is valid
-    _check_hello_request(hello_request, addr, conn, chunk_manager.torrent_id)
+    # Looks up the torrent the peer asked for and checks that the request is valid
+    chunk_manager = None
+    if hello_request is not None:
+        chunk_manager = registry.get(hello_request.data)
+    if not _check_hello_request(hello_request, addr, conn, chunk_manager):
+        return
 
-    # Request is valid send a hello response with available chunks
-    logging.info(f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Received successful hello request from peer")
-    logging.info(f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Sending hello response to peer")
-    payload = chunk_manager.check_current_chunks()
-    hello_response = Message(type_=MessageType.HELLO_RESPONSE, data=payload).to_bytes()
-    conn.sendall(hello_response)
+    # Answers in the version the peer asked for so both sides use the same framing
+    version = hello_request.version
+    message_reader.max_length = max_payload_length(chunk_manager.piece_size, chunk_manager.number_of_pieces)
 
-    # Loops forever until peer disconnects or timeout
-    while 1:
+    # Have and choke messages from other threads wait here until this thread sends them between pieces
+    pending_messages = []
+    pending_lock = threading.Lock()
+    has_messages = Wakeup()
 
-        # Waits for a piece request
-        piece_request = Message.from_socket(conn)
+    def queue_message(message):
+        with pending_lock:
+            pending_messages.append(message)
+        has_messages.set()
 
-        # Checks that piece_request is valid
-        _check_piece_request(piece_request, addr, conn)
+    def flush_messages():
+        has_messages.clear()
+        with pending_lock:
+            messages = pending_messages[:]
+            pending_messages.clear()
+        for message in messages:
+            message.send(conn)
+            if message.type == MessageType.CHOKE:
+                upload_scheduler.choke_sent(addr)
 
-        # Handles piece_request and returns a piece response to send
-        piece_response = _handle_piece_request(piece_request, chunk_manager, conn, addr)
+    # Pushes a have message for every chunk completed while a version 2 peer is connected
+    def announce_chunk(index):
+        queue_message(
+            Message(type_=MessageType.HAVE, version=version, data=index.to_bytes(HAVE_INDEX_SIZE, "big"))
+        )
 
-        # Checks if the piece response is good
-        if piece_response is None:
-            return
+    # Tells a version 2 peer when it may or may not send piece requests
+    def send_choke(is_choked):
+        queue_message(Message(type_=MessageType.CHOKE if is_choked else MessageType.UNCHOKE, version=version))
 
-        # Sends piece response to peer
-        conn.sendall(piece_response)
-    
+    # Listens before taking the bitfield so no chunk falls in between
+    if version >= 2:
+        chunk_manager.add_completion_listener(announce_chunk)
+    # Wakes the loop when the torrent is removed so an idle peer doesn't keep the connection open
+    chunk_manager.add_wakeup(has_messages)
+    metrics.upload_opened(addr, f"{addr[0]}:{addr[1]}")
 
+    try:
+        # Request is valid send a hello response with available chunks
+        logging.info(f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Received successful hello request from peer")
+        logging.info(f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Sending hello response to peer")
+        payload = chunk_manager.check_current_chunks()
+        hello_response = Message(type_=MessageType.HELLO_RESPONSE, version=version, data=payload)
+        hello_response.send(conn)
+
+        # Takes an upload slot if one is free, version 1 peers can't be choked and are always served
+        if version >= 2 and upload_scheduler.register(addr, addr[0], send_choke, f"{addr[0]}:{addr[1]}"):
+            logging.info(f" UPLOAD_THREAD({addr[0]}:{addr[1]}): No free upload slot, choking peer")
+            Message(type_=MessageType.CHOKE, version=version).send(conn)
+
+        # Loops forever until peer disconnects, timeout or the torrent is removed
+        while not chunk_manager.is_closed:
+            flush_messages()
+
+            # Waits for a piece request or a message to pass on
+            readable = wait_any([conn, has_messages, thread_event])
+            if thread_event.is_set() or chunk_manager.is_closed:
+                return
+            if conn not in readable:
+                continue
+            piece_request = message_reader.read()
+
+            # Checks that piece_request is valid
+            if not _check_piece_request(piece_request, addr, conn, version):
+                return
+
+            # Refuses a choked peer once the requests it sent before seeing the choke had their grace period
+            if not upload_scheduler.may_request(addr):
+                logging.info(
+                    f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Peer kept requesting while choked, closing connection..."
+                )
+                conn.sendall(Message(MessageType.ERROR, data="Peer is choked".encode()).to_bytes())
+                return
 
+            # Handles piece_request and sends the piece response to the peer
+            if (
+                length := _handle_piece_request(piece_request, chunk_manager, conn, addr, version)
+            ) is None:
+                return
+            upload_scheduler.record_upload(addr, length)
+            metrics.record_upload(addr, length)
+    except OSError:
+        logging.info(f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Connection to peer was lost")
+    finally:
+        conn.close()
+        metrics.upload_closed(addr)
+        if version >= 2:
+            chunk_manager.remove_completion_listener(announce_chunk)
+            upload_scheduler.unregister(addr)
+        chunk_manager.remove_wakeup(has_messages)
+        has_messages.close()
 
 
-def _check_hello_request(hello_request, addr, conn, torrent_id):
+def _check_hello_request(hello_request, addr, conn, chunk_manager: ChunkManager):
     if hello_request is None:
         logging.info(
             f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Failed to parse request, closing connection..."
@@ -97,8 +204,8 @@ def _check_hello_request(hello_request, addr, conn, torrent_id):
         )
         conn.sendall(error_message.to_bytes())
         conn.close()
-        return
-    elif hello_request.version != 1:
+        return False
+    elif hello_request.version not in SUPPORTED_VERSIONS:
         logging.info(
             f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Failed to confirm version number {hello_request.version}, closing connection..."
         )
@@ -107,29 +214,42 @@ def _check_hello_request(hello_request, addr, conn, torrent_id):
         )
         conn.sendall(error_message.to_bytes())
         conn.close()
-        return
-    elif hello_request.type != MessageType.HELLO_REQUEST:
+        return False
+    elif chunk_manager is None:
         logging.info(
-            f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Failed to confirm message as hello request, closing connection..."
+            f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Failed to find torrent_id {bytes(hello_request.data).hex()}, closing connection..."
         )
         error_message = Message(
-            MessageType.ERROR, data="Expected a hello request type".encode()
+            MessageType.ERROR, data="Torrent ID was not valid".encode()
         )
         conn.sendall(error_message.to_bytes())
         conn.close()
-        return
-    elif hello_request.data != bytes.fromhex(torrent_id):
+        return False
+    elif hello_request.version == 1 and chunk_manager.piece_size > V1_MAX_LENGTH:
         logging.info(
-            f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Failed to validate torrent_id \nExpected:{bytes.fromhex(torrent_id)} \nActual:{hello_request.data.decode()}"
+            f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Pieces are too big for version 1, closing connection..."
         )
         error_message = Message(
-            MessageType.ERROR, data="Torrent ID was not valid".encode()
+            MessageType.ERROR, data="Pieces need protocol version 2".encode()
         )
         conn.sendall(error_message.to_bytes())
         conn.close()
-        return
+        return False
+    elif hello_request.type != MessageType.HELLO_REQUEST:
+        logging.info(
+            f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Failed to confirm message as hello request, closing connection..."
+        )
+        error_message = Message(
+            MessageType.ERROR, data="Expected a hello request type".encode()
+        )
+        conn.sendall(error_message.to_bytes())
+        conn.close()
+        return False
+
+    return True
+
 
-def _check_piece_request(piece_request, addr, conn):
+def _check_piece_request(piece_request, addr, conn, version):
     if piece_request is None:
         logging.info(
             f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Failed to parse request, closing connection..."
@@ -139,8 +259,8 @@ def _check_piece_request(piece_request, addr, conn):
         )
         conn.sendall(error_message.to_bytes())
         conn.close()
-        return
-    elif piece_request.version != 1:
+        return False
+    elif piece_request.version != version:
         logging.info(
             f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Failed to confirm version number {piece_request.version}, closing connection..."
         )
@@ -149,7 +269,7 @@ def _check_piece_request(piece_request, addr, conn):
         )
         conn.sendall(error_message.to_bytes())
         conn.close()
-        return
+        return False
     elif piece_request.type != MessageType.PIECE_REQUEST:
         logging.info(
             f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Failed to confirm message as piece request, closing connection..."
@@ -159,19 +279,18 @@ def _check_piece_request(piece_request, addr, conn):
         )
         conn.sendall(error_message.to_bytes())
         conn.close()
-        return
+        return False
 
-def _handle_piece_request(piece_request: Message, chunk_manager: ChunkManager, conn, addr):
+    return True
+
+
+def _handle_piece_request(piece_request: Message, chunk_manager: ChunkManager, conn, addr, version):
     request = int.from_bytes(piece_request.data, 'big')
-    
-    chunk_hashes = list(chunk_manager.piece_status_dictionary.keys())
 
-    # Checks that the request is valid
-    try:
-        requested_hash = chunk_hashes[request]
-    except:
+    # Checks that the request is valid and the chunk is stored
+    if request >= chunk_manager.number_of_pieces or not chunk_manager.is_chunk_available(request):
         logging.info(
-            f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Requested chunk is out of bounds..."
+            f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Requested chunk is out of bounds or missing..."
         )
         error_message = Message(
             MessageType.ERROR, data="Requested chunk is invalid".encode()
@@ -180,10 +299,21 @@ def _handle_piece_request(piece_request: Message, chunk_manager: ChunkManager, c
         conn.close()
         return None
     
-    #Creates a request 
-    payload = b''
-    with open(f"{chunk_manager.folder}/chunks/{chunk_manager.file_name}_{request}_{requested_hash}", "rb") as chunk_file:
-        payload = chunk_file.read()
-    piece_response = Message(type_= MessageType.PIECE_RESPONSE, data=payload).to_bytes()
     logging.info(f" UPLOAD_THREAD({addr[0]}:{addr[1]}): Sending {chunk_manager.file_name}_{request}...")
-    return piece_response
+
+    # Sends the chunk from the piece cache, or from the disk scheduler when there is one
+    payload = chunk_manager.cached_chunk(request)
+    if payload is None and chunk_manager.piece_reader is not None:
+        payload = chunk_manager.read_stored_chunk(request)
+    if payload is not None:
+        Message(type_=MessageType.PIECE_RESPONSE, version=version, data=payload).send(conn)
+        chunk_manager.add_uploaded(len(payload))
+        return len(payload)
+
+    # Sends the header then lets the kernel copy the chunk straight from disk to the socket
+    with chunk_manager.open_chunk(request) as (chunk_file, offset, length):
+        header = Message(type_=MessageType.PIECE_RESPONSE, version=version).to_header(length)
+        conn.sendall(header, getattr(socket, "MSG_MORE", 0))
+        conn.sendfile(chunk_file, offset, length)
+    chunk_manager.add_uploaded(length)
+    return length
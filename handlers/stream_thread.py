@@ -0,0 +1,124 @@
+import threading
+import logging
+import mimetypes
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+
+from utils.chunk_manager import ChunkManager
+from utils.wakeup import wait_any
+
+# Creates stream thread
+def create_stream_thread(stream_port, chunk_manager, thread_event):
+    # Spawn a thread that serves the file being downloaded over http
+    stream_thread = threading.Thread(
+        target=stream_task, args=(stream_port, chunk_manager, thread_event)
+    )
+    stream_thread.setName("Stream Thread")
+    stream_thread.start()
+    return stream_thread
+
+
+# Serves the torrent's file on localhost while it downloads, with Range support so players can seek
+#
+# Every request moves the chunk manager's playhead to the chunk it starts
+# at, so the chunks right after it are downloaded first. Chunks are sent as
+# soon as they are verified and saved, a request waits on a chunk that hasn't
+# arrived yet.
+def stream_task(stream_port, chunk_manager: ChunkManager, thread_event):
+    file_size = chunk_manager.file_size
+    content_type = mimetypes.guess_type(chunk_manager.file_name)[0] or "application/octet-stream"
+
+    class StreamHandler(BaseHTTPRequestHandler):
+        def do_HEAD(self):
+            self._serve(send_body=False)
+
+        def do_GET(self):
+            self._serve(send_body=True)
+
+        def _serve(self, send_body):
+            if unquote(self.path.split("?")[0]) not in ("/", f"/{chunk_manager.file_name}"):
+                self.send_error(404)
+                return
+
+            # Answers the whole file without a Range header and the first range with one
+            range_header = self.headers.get("Range")
+            if (byte_range := _parse_range(range_header, file_size)) is None:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{file_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start, end = byte_range
+            self.send_response(200 if range_header is None else 206)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start + 1))
+            if range_header is not None:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{file_size}")
+            self.end_headers()
+            if not send_body or end < start:
+                return
+
+            logging.info(f" STREAM_THREAD: Serving bytes {start}-{end} of {chunk_manager.file_name}")
+            chunk_manager.set_playhead(start // chunk_manager.piece_size)
+            try:
+                _send_range(self.wfile, chunk_manager, start, end)
+            except OSError:
+                logging.info(f" STREAM_THREAD: Stopped serving bytes {start}-{end}, connection or file closed")
+
+        def log_message(self, format, *args):
+            logging.info(f" STREAM_THREAD: {self.address_string()} {format % args}")
+
+    # Creates the http server, only reachable from this machine
+    server = ThreadingHTTPServer(("127.0.0.1", stream_port), StreamHandler)
+    server.daemon_threads = True
+    logging.info(
+        f" STREAM_THREAD: Streaming on http://127.0.0.1:{stream_port}/{quote(chunk_manager.file_name)}"
+    )
+
+    # Handles requests as they come in until the thread event is triggered
+    while not thread_event.is_set():
+        if server in wait_any([server, thread_event]):
+            server.handle_request()
+
+    server.server_close()
+    logging.info(" STREAM_THREAD: <<<Complete>>>")
+
+
+# *PRIVATE HELPER FUNCTIONS*
+
+
+def _parse_range(range_header, file_size):
+    # Returns the first requested byte range as inclusive (start, end), None if it can't be satisfied
+    if range_header is None:
+        return 0, file_size - 1
+    match = re.match(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)", range_header)
+    if match is None or match.group(1) == match.group(2) == "":
+        return 0, file_size - 1
+
+    # A missing start asks for the last bytes of the file
+    if match.group(1) == "":
+        length = int(match.group(2))
+        if length == 0:
+            return None
+        return max(file_size - length, 0), file_size - 1
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) != "" else file_size - 1
+    if start >= file_size or end < start:
+        return None
+    return start, min(end, file_size - 1)
+
+
+def _send_range(output, chunk_manager: ChunkManager, start, end):
+    # Sends the range chunk by chunk, waiting on every chunk until it has been downloaded or the torrent closes
+    position = start
+    index = start // chunk_manager.piece_size
+    while position <= end:
+        if not chunk_manager.wait_for_chunk(index):
+            return
+        chunk = chunk_manager.read_chunk(index)
+        chunk_start = index * chunk_manager.piece_size
+        output.write(memoryview(chunk)[position - chunk_start : end + 1 - chunk_start])
+        position = chunk_start + len(chunk)
+        index += 1
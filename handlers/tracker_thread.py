@@ -1,11 +1,31 @@
 import threading
 import time
+import random
 import requests
 import logging
 
+from utils.wakeup import Wakeup, wait_any
+
+# Seconds to wait before retrying after the first failed announce
+BASE_BACKOFF = 5
+# Longest wait between retries when the tracker keeps failing
+MAX_BACKOFF = 300
+# Announces early when fewer than this many peers can be dialed
+MIN_USABLE_PEERS = 5
+# Shortest time between two announces, even when starved of peers
+MIN_ANNOUNCE_INTERVAL = 5
+
 # Creates tracker thread
 def create_tracker_thread(
-    peer_id, ip_address, port_number, torrent_id, tracker_url, queue, thread_event
+    peer_id,
+    ip_address,
+    port_number,
+    torrent_id,
+    tracker_url,
+    thread_event,
+    chunk_manager,
+    connection_manager,
+    timeout=10,
 ):
 
     # Spawn a thread to communicate to the tracker
@@ -17,8 +37,10 @@ def create_tracker_thread(
             port_number,
             torrent_id,
             tracker_url,
-            queue,
             thread_event,
+            chunk_manager,
+            connection_manager,
+            timeout,
         ),
     )
     tracker_thread.setName("Tracker Thread")
@@ -26,39 +48,97 @@ def create_tracker_thread(
     return tracker_thread
 
 
-# Sends a request to the torrent tracker every 30 seconds
+# Announces to the torrent tracker every interval, sooner when short on peers
+#
+# Peer lists go straight to the connection manager, which wakes the client.
+# Between announces the thread sleeps until the interval is up, the peer
+# closes or the connection manager reports a change that may have left it
+# short on peers.
 def tracker_task(
-    peer_id, ip_address, port_number, torrent_id, tracker_url, queue, thread_event
+    peer_id,
+    ip_address,
+    port_number,
+    torrent_id,
+    tracker_url,
+    thread_event,
+    chunk_manager,
+    connection_manager,
+    timeout=10,
 ):
+    # Reuses one keep-alive connection to the tracker for every announce
+    session = requests.Session()
+    failures = 0
+    peers_changed = Wakeup()
+    connection_manager.add_wakeup(peers_changed)
+
     while 1:
-        # Makes a http request to the tracker
+        # Makes a http request to the tracker with the transfer stats so far
         payload = {
             "peer_id": peer_id,
             "ip": ip_address,
             "port": port_number,
             "torrent_id": torrent_id,
+            "uploaded": chunk_manager.bytes_uploaded,
+            "downloaded": chunk_manager.bytes_downloaded,
+            "left": chunk_manager.bytes_left(),
         }
-        new_response = requests.get(tracker_url, params=payload).json()
-        peer_list = new_response["peers"]
+        try:
+            new_response = session.get(tracker_url, params=payload, timeout=timeout)
+            new_response.raise_for_status()
+            new_response = new_response.json()
+            peer_list = new_response["peers"]
+            interval = int(new_response["interval"])
+        except (requests.RequestException, ValueError, KeyError, TypeError) as error:
+            # Retries with a jittered exponential backoff so peers don't hammer the tracker together
+            failures += 1
+            backoff = min(BASE_BACKOFF * 2 ** (failures - 1), MAX_BACKOFF)
+            backoff = random.uniform(backoff / 2, backoff)
+            logging.info(
+                f" TRACKER_THREAD: Announce failed ({error}), retrying in {backoff:.1f} seconds"
+            )
+            if thread_event.wait(backoff):
+                break
+            continue
+        failures = 0
 
         # Logs the response object
         logging.info(f" TRACKER_THREAD: Tracker Response")
-        logging.info(f" TRACKER_THREAD: \tInterval: {new_response['interval']}")
+        logging.info(f" TRACKER_THREAD: \tInterval: {interval}")
         logging.info(f" TRACKER_THREAD: \tPeer List:")
         for peer in peer_list:
             logging.info(f" TRACKER_THREAD: \t {peer}")
 
-        # Adds new response to the tracker queue and clears the old results if any
-        queue.queue.clear()
-        queue.put(peer_list)
+        # Hands the peers to the connection manager, which wakes the client to dial them
+        connection_manager.update_peers(torrent_id, peer_list)
 
         # Sleeps for the interval time
-        for i in range(new_response["interval"]):
-            time.sleep(1)
+        announced_at = time.monotonic()
+        while 1:
+            peers_changed.clear()
             # Checks if the main thread is closing
             if thread_event.is_set():
-                logging.info("TRACKER_THREAD: Closing tracker socket...")
-                logging.info("TRACKER_THREAD: <<<Complete>>>")
-                return
+                break
+            elapsed = time.monotonic() - announced_at
+            if elapsed >= interval:
+                break
+
+            # Announces early while still downloading and short on peers to dial
+            if elapsed >= MIN_ANNOUNCE_INTERVAL:
+                if (
+                    not chunk_manager.is_done()
+                    and connection_manager.usable_count(torrent_id) < MIN_USABLE_PEERS
+                ):
+                    logging.info(" TRACKER_THREAD: Too few usable peers, announcing early")
+                    break
+                wait = interval - elapsed
+            else:
+                wait = min(interval, MIN_ANNOUNCE_INTERVAL) - elapsed
+            wait_any([peers_changed, thread_event], wait)
+        if thread_event.is_set():
+            break
 
-    
+    session.close()
+    connection_manager.remove_wakeup(peers_changed)
+    peers_changed.close()
+    logging.info("TRACKER_THREAD: Closing tracker socket...")
+    logging.info("TRACKER_THREAD: <<<Complete>>>")
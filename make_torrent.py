@@ -0,0 +1,176 @@
+import argparse
+import hashlib
+import json
+import math
+import mmap
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.resume import ResumeState
+from utils.storage import HASH_SIZE
+
+# Piece size of the existing torrents
+DEFAULT_PIECE_SIZE = 4096
+# Bytes of the file each pool task hashes, big enough to keep task overhead small
+BATCH_BYTES = 8 * 1024 * 1024
+
+# File the pool workers have mapped, set once per worker process
+_mapped = None
+
+
+# Hashes every piece of the file, in parallel on a process pool over a memory mapped copy of it
+#
+# Every worker maps the file once and hashes whole batches of pieces straight
+# from the page cache, so piece data never gets pickled between processes.
+# Only the 20 byte digests come back.
+def hash_pieces(path, piece_size, workers=None):
+    file_size = os.path.getsize(path)
+    if file_size == 0:
+        return []
+    number_of_pieces = math.ceil(file_size / piece_size)
+    batch = max(1, BATCH_BYTES // piece_size)
+    batches = [
+        (start, min(start + batch, number_of_pieces)) for start in range(0, number_of_pieces, batch)
+    ]
+
+    # Small files don't pay for starting a pool
+    if workers == 1 or len(batches) == 1:
+        _map_file(path, piece_size)
+        try:
+            digests = b"".join(_hash_batch(batch_range) for batch_range in batches)
+        finally:
+            _unmap_file()
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_map_file, initargs=(path, piece_size)
+        ) as executor:
+            digests = b"".join(executor.map(_hash_batch, batches))
+    return [digests[index * HASH_SIZE : (index + 1) * HASH_SIZE].hex() for index in range(number_of_pieces)]
+
+
+# Builds the .ntorrent dictionary peer.py loads
+def make_torrent(path, tracker_url, piece_size=DEFAULT_PIECE_SIZE, workers=None):
+    pieces = hash_pieces(path, piece_size, workers)
+    return {
+        "torrent_id": hashlib.sha1("".join(pieces).encode()).hexdigest(),
+        "tracker_url": tracker_url,
+        "file_size": os.path.getsize(path),
+        "file_name": os.path.basename(path),
+        "piece_size": piece_size,
+        "pieces": pieces,
+    }
+
+
+# Saves the fast-resume state a peer seeding from folder loads, marking every piece as verified
+#
+# The state is built from the file's size and mtime, so the file only has to
+# be readable and is never opened for writing. Returns None if the file no
+# longer has the size it was hashed at.
+def write_resume_state(torrent, folder):
+    path = f"{folder}/{torrent['file_name']}"
+    if os.stat(path).st_size != torrent["file_size"]:
+        return None
+
+    number_of_pieces = len(torrent["pieces"])
+    bitfield = bytearray((number_of_pieces + 7) // 8)
+    for index in range(number_of_pieces):
+        bitfield[index >> 3] |= 0x80 >> (index & 7)
+
+    resume_state = ResumeState(
+        f"{folder}/.{torrent['file_name']}.resume", torrent["torrent_id"], "file", number_of_pieces
+    )
+    resume_state.save_file(path, bitfield)
+    return resume_state.path
+
+
+def main():
+    # Create parser for Command Line
+    parser = argparse.ArgumentParser(
+        allow_abbrev=False, description="Create the .ntorrent file peer.py downloads and seeds from"
+    )
+    parser.add_argument("file", help="file to share")
+    parser.add_argument("-t", "--tracker", required=True, help="announce url of the tracker")
+    parser.add_argument(
+        "--piece-size", type=int, default=DEFAULT_PIECE_SIZE, help="piece size in bytes"
+    )
+    parser.add_argument("-o", "--output", help="torrent file to write, defaults to <file name>.ntorrent")
+    parser.add_argument(
+        "-w", "--workers", type=int, help="processes hashing pieces, defaults to one per CPU"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="also write the fast-resume state so a peer seeding the file starts without hashing it",
+    )
+    parser.add_argument(
+        "--dest",
+        help="folder the seed runs from, exactly as passed to peer.py -d, defaults to the file's folder",
+    )
+    args = parser.parse_args()
+
+    # Checks the arguments are valid
+    if not os.path.isfile(args.file):
+        sys.stderr.write(f"File: {args.file} does not exist\n")
+        sys.exit(1)
+    if args.piece_size < 1:
+        sys.stderr.write(f"Piece size: {args.piece_size} must be at least 1\n")
+        sys.exit(1)
+    if args.workers is not None and args.workers < 1:
+        sys.stderr.write(f"Workers: {args.workers} must be at least 1\n")
+        sys.exit(1)
+    dest = args.dest if args.dest is not None else os.path.dirname(args.file) or "."
+    seed_path = f"{dest}/{os.path.basename(args.file)}"
+    if args.resume and not (os.path.exists(seed_path) and os.path.samefile(seed_path, args.file)):
+        sys.stderr.write(f"Dest: {dest} does not hold {args.file}, the seed couldn't use its resume state\n")
+        sys.exit(1)
+
+    started = time.monotonic()
+    torrent = make_torrent(args.file, args.tracker, args.piece_size, args.workers)
+    elapsed = time.monotonic() - started
+
+    output = args.output if args.output is not None else f"{torrent['file_name']}.ntorrent"
+    with open(output, "w") as torrent_file:
+        json.dump(torrent, torrent_file, indent=4)
+        torrent_file.write("\n")
+    print(
+        f"Wrote {output}: {len(torrent['pieces'])} pieces of {torrent['piece_size']} bytes "
+        f"hashed in {elapsed:.2f}s, torrent id {torrent['torrent_id']}"
+    )
+
+    if args.resume:
+        if (resume_path := write_resume_state(torrent, dest)) is None:
+            sys.stderr.write(f"File: {args.file} changed size while it was hashed, no resume state written\n")
+            sys.exit(1)
+        print(f"Wrote {resume_path}, seed with: python peer.py -d {dest} <peer id> {output}")
+
+
+# *PRIVATE HELPER FUNCTIONS*
+
+
+def _map_file(path, piece_size):
+    global _mapped
+    with open(path, "rb") as data_file:
+        _mapped = (mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ), piece_size)
+
+
+def _unmap_file():
+    global _mapped
+    _mapped[0].close()
+    _mapped = None
+
+
+def _hash_batch(batch_range):
+    # Concatenated digests of the pieces in [start, end)
+    mapped, piece_size = _mapped
+    start, end = batch_range
+    digests = []
+    with memoryview(mapped) as view:
+        for index in range(start, end):
+            digests.append(hashlib.sha1(view[index * piece_size : (index + 1) * piece_size]).digest())
+    return b"".join(digests)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,28 @@
 import argparse
+import math
 import sys
 import os
 import json
 import logging
-import queue
 import socket
-import time
-import threading
 
 from handlers.tracker_thread import create_tracker_thread
 from handlers.server_thread import create_server_thread
 from handlers.client_thread import create_client_thread
+from handlers.async_engine import create_async_engine_thread
+from handlers.daemon_thread import create_daemon_thread
+from handlers.choker_thread import create_choker_thread
+from handlers.metrics_thread import create_metrics_thread
+from handlers.stream_thread import create_stream_thread
 from utils.chunk_manager import ChunkManager
+from utils.piece_cache import PieceCache
+from utils.connection_manager import ConnectionManager
+from utils.piece_writer import PieceWriter, FSYNC_POLICIES
+from utils.piece_reader import PieceReader
+from utils.torrent_registry import TorrentRegistry
+from utils.upload_scheduler import UploadScheduler
+from utils.metrics import Metrics
+from utils.wakeup import Wakeup
 
 
 def main():
@@ -29,9 +40,110 @@ def main():
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="display log messages"
     )
+    parser.add_argument(
+        "--engine",
+        choices=["thread", "asyncio"],
+        default="thread",
+        help="run uploads and downloads on a thread per connection or on one asyncio event loop",
+    )
+    parser.add_argument(
+        "--pipeline-depth",
+        type=int,
+        default=8,
+        help="number of piece requests to keep in flight on each download connection",
+    )
+    parser.add_argument(
+        "--endgame-threshold",
+        type=int,
+        default=20,
+        help="request the last pieces from several peers at once when this many or fewer are left, 0 disables",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=["file", "chunks"],
+        default="file",
+        help="write pieces straight into one preallocated file or into a legacy chunks/ folder",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=32,
+        help="megabytes of recently downloaded pieces to keep in memory for uploads, 0 disables",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=30,
+        help="most download connections to keep open to other peers at once",
+    )
+    parser.add_argument(
+        "--tracker-timeout",
+        type=float,
+        default=10,
+        help="seconds to wait on the tracker before retrying the announce",
+    )
+    parser.add_argument(
+        "--writer-threads",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker threads that verify and save downloaded pieces",
+    )
+    parser.add_argument(
+        "--writer-queue",
+        type=int,
+        default=64,
+        help="most downloaded pieces to hold in memory waiting to be verified and saved",
+    )
+    parser.add_argument(
+        "--fsync",
+        choices=FSYNC_POLICIES,
+        default="complete",
+        help="flush downloaded pieces to the disk never, once the file is complete, or every --fsync-interval megabytes and once complete",
+    )
+    parser.add_argument(
+        "--fsync-interval",
+        type=float,
+        default=64,
+        help="megabytes written to a torrent between flushes with --fsync interval",
+    )
+    parser.add_argument(
+        "--reader-threads",
+        type=int,
+        default=0,
+        help="number of worker threads that read uploaded pieces from the disk in order of their offset, 0 reads on each connection",
+    )
+    parser.add_argument(
+        "--upload-slots",
+        type=int,
+        default=4,
+        help="number of version 2 peers allowed to request pieces at once, the rest are choked, 0 serves everyone",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve transfer, piece and connection metrics on this localhost port at /metrics and /metrics.json",
+    )
+    parser.add_argument(
+        "--stream-port",
+        type=int,
+        help="download the file in order and serve it with Range support on this localhost port while it downloads",
+    )
+    parser.add_argument(
+        "--stream-window",
+        type=float,
+        default=4,
+        help="megabytes after the playhead to download first when streaming",
+    )
+    parser.add_argument(
+        "--daemon",
+        metavar="TORRENT_FOLDER",
+        help="run every .ntorrent file in a folder on one port, picking up added and removed files while running",
+    )
     parser.add_argument("netid", help="Your NETID")
     parser.add_argument(
-        "torrent_file", help="The torrent file for the file you want to download."
+        "torrent_file",
+        nargs="?",
+        help="The torrent file for the file you want to download.",
     )
     args = parser.parse_args()
 
@@ -48,8 +160,88 @@ def main():
         )
         sys.exit(1)
 
+    # Checks that the pipeline depth is valid
+    if args.pipeline_depth < 1:
+        sys.stderr.write(
+            f"Pipeline depth: {args.pipeline_depth} must be at least 1\n"
+        )
+        sys.exit(1)
+
+    # Checks that the cache size is valid
+    if args.cache_size < 0:
+        sys.stderr.write(f"Cache size: {args.cache_size} can't be negative\n")
+        sys.exit(1)
+
+    # Checks that the connection limit is valid
+    if args.max_connections < 1:
+        sys.stderr.write(
+            f"Max connections: {args.max_connections} must be at least 1\n"
+        )
+        sys.exit(1)
+
+    # Checks that the tracker timeout is valid
+    if args.tracker_timeout <= 0:
+        sys.stderr.write(
+            f"Tracker timeout: {args.tracker_timeout} must be greater than 0\n"
+        )
+        sys.exit(1)
+
+    # Checks that the piece writer settings are valid
+    if args.writer_threads < 1 or args.writer_queue < 1:
+        sys.stderr.write(
+            f"Writer threads: {args.writer_threads} and writer queue: {args.writer_queue} must be at least 1\n"
+        )
+        sys.exit(1)
+
+    # Checks that the disk settings are valid
+    if args.fsync_interval <= 0:
+        sys.stderr.write(f"Fsync interval: {args.fsync_interval} must be greater than 0\n")
+        sys.exit(1)
+    if args.reader_threads < 0:
+        sys.stderr.write(f"Reader threads: {args.reader_threads} can't be negative\n")
+        sys.exit(1)
+
+    # Checks that the upload slots are valid
+    if args.upload_slots < 0:
+        sys.stderr.write(f"Upload slots: {args.upload_slots} can't be negative\n")
+        sys.exit(1)
+
+    # Checks that the metrics port is valid
+    if args.metrics_port is not None and not 1024 <= args.metrics_port <= 65535:
+        sys.stderr.write(
+            f"Metrics port: {args.metrics_port} is not a valid port number (1024 - 65535)\n"
+        )
+        sys.exit(1)
+
+    # Checks that the streaming settings are valid
+    if args.stream_port is not None and not 1024 <= args.stream_port <= 65535:
+        sys.stderr.write(
+            f"Stream port: {args.stream_port} is not a valid port number (1024 - 65535)\n"
+        )
+        sys.exit(1)
+    if args.stream_window <= 0:
+        sys.stderr.write(f"Stream window: {args.stream_window} must be greater than 0\n")
+        sys.exit(1)
+
+    # Checks that there is exactly one torrent file or a daemon folder
+    if (args.torrent_file is None) == (args.daemon is None):
+        sys.stderr.write("Give either a torrent file or --daemon with a torrent folder\n")
+        sys.exit(1)
+
+    # Checks that the daemon folder exist and that the engine supports it
+    if args.daemon is not None:
+        if not os.path.isdir(args.daemon):
+            sys.stderr.write(f'"{args.daemon}" is not a folder try a valid torrent folder\n')
+            sys.exit(1)
+        if args.engine != "thread":
+            sys.stderr.write("Daemon mode only runs on the thread engine\n")
+            sys.exit(1)
+        if args.stream_port is not None:
+            sys.stderr.write("Streaming needs a single torrent file, not --daemon\n")
+            sys.exit(1)
+
     # Checks if torrent file exist
-    if not os.path.exists(args.torrent_file):
+    elif not os.path.exists(args.torrent_file):
         sys.stderr.write(
             f'"{args.torrent_file}" does not exist try a valid torrent file\n'
         )
@@ -63,66 +255,224 @@ def main():
     logging.info(f"\tPort: {args.port}")
     logging.info(f"\tFolder: {args.dest}")
     logging.info(f"\tNetID: {args.netid}")
-    logging.info(f"\tTorrent File: {args.torrent_file}\n")
+    logging.info(f"\tEngine: {args.engine}")
+    logging.info(f"\tPipeline Depth: {args.pipeline_depth}")
+    logging.info(f"\tEndgame Threshold: {args.endgame_threshold}")
+    logging.info(f"\tStorage: {args.storage}")
+    logging.info(f"\tCache Size: {args.cache_size} MB")
+    logging.info(f"\tMax Connections: {args.max_connections}")
+    logging.info(f"\tTracker Timeout: {args.tracker_timeout}")
+    logging.info(f"\tWriter Threads: {args.writer_threads}")
+    logging.info(f"\tWriter Queue: {args.writer_queue}")
+    logging.info(f"\tFsync: {args.fsync}")
+    logging.info(f"\tFsync Interval: {args.fsync_interval} MB")
+    logging.info(f"\tReader Threads: {args.reader_threads}")
+    logging.info(f"\tUpload Slots: {args.upload_slots}")
+    logging.info(f"\tMetrics Port: {args.metrics_port}")
+    logging.info(f"\tStream Port: {args.stream_port}")
+    logging.info(f"\tStream Window: {args.stream_window} MB")
+    if args.daemon is not None:
+        logging.info(f"\tTorrent Folder: {args.daemon}\n")
+    else:
+        logging.info(f"\tTorrent File: {args.torrent_file}\n")
 
-    # Opens the json file and loads it into a dictionary
-    with open(args.torrent_file, "r") as torrent:
-        json_data = json.load(torrent)
+    # Creates the piece cache shared by every upload connection
+    piece_cache = None
+    if args.cache_size > 0:
+        piece_cache = PieceCache(max_bytes=args.cache_size * 1024 * 1024)
 
-    # Creates a response queue from the tracker
-    tracker_queue = queue.Queue(maxsize=1)
+    # Creates the connection manager that decides which peers to dial
+    connection_manager = ConnectionManager(
+        current_peer_id=peer_id, max_connections=args.max_connections
+    )
 
-    # *CHUNK MANAGER*
-    # Creates a chunk manager
-    chunk_manager = ChunkManager(
-        file_name=json_data["file_name"],
-        file_size=json_data["file_size"],
-        piece_size=json_data["piece_size"],
-        pieces=json_data["pieces"],
-        torrent_id=json_data["torrent_id"],
-        folder=args.dest
+    # Creates the worker pool that verifies and saves downloaded pieces
+    piece_writer = PieceWriter(
+        workers=args.writer_threads,
+        max_queued=args.writer_queue,
+        fsync=args.fsync,
+        fsync_interval=int(args.fsync_interval * 1024 * 1024),
     )
 
+    # Creates the worker pool that reads uploaded pieces in disk order
+    piece_reader = None
+    if args.reader_threads > 0:
+        piece_reader = PieceReader(workers=args.reader_threads)
+
+    # Creates the registry the upload server finds each torrent in
+    registry = TorrentRegistry()
+
+    # Creates the scheduler that chokes and unchokes upload connections
+    upload_scheduler = UploadScheduler(upload_slots=args.upload_slots)
+
+    # Creates the transfer counters served by the metrics endpoint
+    metrics = Metrics()
+
     # *THREADING*
-    # Creates thread killer event
-    thread_killer = threading.Event()
-
-    # Creates tracker thread
-    tracker_thread = create_tracker_thread(
-        peer_id=peer_id,
-        ip_address=args.host,
-        port_number=args.port,
-        torrent_id=json_data["torrent_id"],
-        tracker_url=json_data["tracker_url"],
-        queue=tracker_queue,
-        thread_event=thread_killer,
-    )
-    # Creates server thread to upload chunks to clients
-    thread_server = create_server_thread(
-        chunk_manager=chunk_manager, server_port=args.port, thread_event=thread_killer
-    )
-    # Creates client thread to download chunks to file
-    thread_client = create_client_thread(
-        peer_list_queue=tracker_queue,
-        chunk_manager=chunk_manager,
-        current_peer_id=peer_id,
-        thread_event=thread_killer,
-    )
+    # Creates thread killer event, selectable so blocked threads wake up the moment it is set
+    thread_killer = Wakeup()
+
+    if args.daemon is not None:
+        # Creates server thread to upload chunks of every torrent to clients
+        thread_server = create_server_thread(
+            registry=registry,
+            upload_scheduler=upload_scheduler,
+            metrics=metrics,
+            server_port=args.port,
+            thread_event=thread_killer,
+        )
+        # Creates daemon thread to start and stop torrents as they appear in the folder
+        thread_daemon = create_daemon_thread(
+            torrent_folder=args.daemon,
+            registry=registry,
+            connection_manager=connection_manager,
+            piece_writer=piece_writer,
+            piece_cache=piece_cache,
+            piece_reader=piece_reader,
+            upload_scheduler=upload_scheduler,
+            metrics=metrics,
+            peer_id=peer_id,
+            ip_address=args.host,
+            port_number=args.port,
+            folder=args.dest,
+            thread_event=thread_killer,
+            storage=args.storage,
+            pipeline_depth=args.pipeline_depth,
+            endgame_threshold=args.endgame_threshold,
+            tracker_timeout=args.tracker_timeout,
+        )
+        # Creates choker thread to hand out upload slots
+        thread_choker = create_choker_thread(
+            upload_scheduler=upload_scheduler, thread_event=thread_killer
+        )
+        chunk_manager = None
+        peer_threads = [thread_server, thread_daemon, thread_choker]
+    else:
+        # Opens the json file and loads it into a dictionary
+        with open(args.torrent_file, "r") as torrent:
+            json_data = json.load(torrent)
+
+        # *CHUNK MANAGER*
+        # Creates a chunk manager
+        chunk_manager = ChunkManager(
+            file_name=json_data["file_name"],
+            file_size=json_data["file_size"],
+            piece_size=json_data["piece_size"],
+            pieces=json_data["pieces"],
+            torrent_id=json_data["torrent_id"],
+            folder=args.dest,
+            storage=args.storage,
+            piece_cache=piece_cache,
+            piece_reader=piece_reader,
+            stream_window=(
+                math.ceil(args.stream_window * 1024 * 1024 / json_data["piece_size"])
+                if args.stream_port is not None
+                else 0
+            ),
+        )
+        registry.add(chunk_manager)
+
+        # Creates tracker thread
+        tracker_thread = create_tracker_thread(
+            peer_id=peer_id,
+            ip_address=args.host,
+            port_number=args.port,
+            torrent_id=json_data["torrent_id"],
+            tracker_url=json_data["tracker_url"],
+            thread_event=thread_killer,
+            chunk_manager=chunk_manager,
+            connection_manager=connection_manager,
+            timeout=args.tracker_timeout,
+        )
+        if args.engine == "asyncio":
+            # Creates a single event loop thread to upload and download chunks
+            peer_threads = [
+                tracker_thread,
+                create_async_engine_thread(
+                    chunk_manager=chunk_manager,
+                    registry=registry,
+                    connection_manager=connection_manager,
+                    piece_writer=piece_writer,
+                    upload_scheduler=upload_scheduler,
+                    metrics=metrics,
+                    server_port=args.port,
+                    thread_event=thread_killer,
+                    pipeline_depth=args.pipeline_depth,
+                    endgame_threshold=args.endgame_threshold,
+                ),
+            ]
+        else:
+            # Creates server thread to upload chunks to clients
+            thread_server = create_server_thread(
+                registry=registry,
+                upload_scheduler=upload_scheduler,
+                metrics=metrics,
+                server_port=args.port,
+                thread_event=thread_killer,
+            )
+            # Creates client thread to download chunks to file
+            thread_client = create_client_thread(
+                chunk_manager=chunk_manager,
+                connection_manager=connection_manager,
+                piece_writer=piece_writer,
+                upload_scheduler=upload_scheduler,
+                metrics=metrics,
+                thread_event=thread_killer,
+                pipeline_depth=args.pipeline_depth,
+                endgame_threshold=args.endgame_threshold,
+            )
+            # Creates choker thread to hand out upload slots
+            thread_choker = create_choker_thread(
+                upload_scheduler=upload_scheduler, thread_event=thread_killer
+            )
+            peer_threads = [tracker_thread, thread_server, thread_client, thread_choker]
+
+        # Creates stream thread to serve the file while it downloads
+        if args.stream_port is not None:
+            peer_threads.append(
+                create_stream_thread(
+                    stream_port=args.stream_port,
+                    chunk_manager=chunk_manager,
+                    thread_event=thread_killer,
+                )
+            )
+
+    # Creates metrics thread to serve the counters when asked for
+    if args.metrics_port is not None:
+        peer_threads.append(
+            create_metrics_thread(
+                metrics_port=args.metrics_port,
+                metrics=metrics,
+                registry=registry,
+                connection_manager=connection_manager,
+                upload_scheduler=upload_scheduler,
+                piece_writer=piece_writer,
+                piece_reader=piece_reader,
+                piece_cache=piece_cache,
+                thread_event=thread_killer,
+            )
+        )
 
     # Keeps main thread alive until a keyboard interrupts is detected
     try:
-        while 1:
-            time.sleep(1)
+        thread_killer.wait()
 
     except KeyboardInterrupt:
         # Gracefully closes the peer
         sys.stderr.write("\nClosing peer...\n")
         thread_killer.set()
 
-        # Waits for threads to end gracefully
-        tracker_thread.join()
-        thread_server.join()
-        thread_client.join()
+        # Waits for threads to end gracefully, the daemon closes its own torrents
+        for peer_thread in peer_threads:
+            peer_thread.join()
+        piece_writer.close()
+        if piece_reader is not None:
+            piece_reader.close()
+        if chunk_manager is not None:
+            chunk_manager.close()
+        if piece_cache is not None:
+            logging.info(f" Piece cache: {piece_cache.stats()}")
+        logging.info(f" Connections: {connection_manager.connections()}")
 
         sys.stderr.write("Peer closed successfully!\n")
 
@@ -0,0 +1,166 @@
+import asyncio
+import socket
+import threading
+import unittest
+
+from utils.message import (
+    HEADER_SIZE,
+    HELLO_MAX_LENGTH,
+    V2_HEADER_SIZE,
+    Message,
+    MessageReader,
+    MessageType,
+    max_payload_length,
+    send_parts,
+)
+
+
+# Connected socket pair shared by the tests below, holds no tests itself
+class SocketPairTest(unittest.TestCase):
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+        self.addCleanup(self.sender.close)
+        self.addCleanup(self.receiver.close)
+
+    def send_in_background(self, *messages):
+        # Sends from another thread so payloads bigger than the socket buffer don't block the test
+        thread = threading.Thread(target=lambda: [message.send(self.sender) for message in messages])
+        thread.start()
+        self.addCleanup(thread.join)
+
+
+class MessageFramingTest(SocketPairTest):
+    def test_header_holds_version_type_and_length(self):
+        message = Message(MessageType.PIECE_REQUEST, data=(7).to_bytes(4, "big"))
+        self.assertEqual(message.to_bytes(), bytes([1, 3, 0, 4, 0, 0, 0, 7]))
+        self.assertEqual(len(message.to_header(4)), HEADER_SIZE)
+
+    def test_reads_messages_back_in_order(self):
+        Message(MessageType.HELLO_REQUEST, data=b"torrent").send(self.sender)
+        Message(MessageType.PIECE_REQUEST, data=(3).to_bytes(4, "big")).send(self.sender)
+        Message(MessageType.ERROR).send(self.sender)
+
+        reader = MessageReader(self.receiver)
+        read = [reader.read() for _ in range(3)]
+        self.assertEqual([message.type for message in read[:2]], [MessageType.HELLO_REQUEST, MessageType.PIECE_REQUEST])
+        self.assertEqual(read[2].type, MessageType.ERROR)
+        self.assertEqual(bytes(read[2].data), b"")
+        self.assertTrue(all(message.version == 1 for message in read))
+
+    def test_reuses_one_buffer_and_grows_it_for_bigger_messages(self):
+        Message(MessageType.HELLO_REQUEST, data=b"first").send(self.sender)
+        Message(MessageType.HELLO_REQUEST, data=b"x" * 500).send(self.sender)
+        Message(MessageType.HELLO_REQUEST, data=b"third").send(self.sender)
+
+        reader = MessageReader(self.receiver)
+        first = reader.read()
+        self.assertIsInstance(first.data, memoryview)
+        self.assertEqual(bytes(first.data), b"first")
+        second = reader.read()
+        self.assertEqual(bytes(second.data), b"x" * 500)
+
+        # The next message lands in the same buffer, a kept payload has to be copied
+        kept = bytes(reader.read().data)
+        self.assertEqual(kept, b"third")
+        self.assertEqual(bytes(second.data[:5]), b"third")
+
+    def test_from_socket_allocates_its_own_payload(self):
+        Message(MessageType.HELLO_RESPONSE, data=b"\xff\x80").send(self.sender)
+        message = Message.from_socket(self.receiver)
+        self.assertEqual(message.type, MessageType.HELLO_RESPONSE)
+        self.assertEqual(bytes(message.data), b"\xff\x80")
+
+    def test_large_payloads_arrive_whole(self):
+        payload = bytes(range(256)) * 255
+        self.send_in_background(Message(MessageType.PIECE_RESPONSE, data=payload))
+        message = MessageReader(self.receiver, max_length=len(payload)).read()
+        self.assertEqual(bytes(message.data), payload)
+
+    def test_send_parts_sends_every_part(self):
+        parts = [b"a" * 300000, b"", b"b" * 5, b"c" * 200000]
+        thread = threading.Thread(target=send_parts, args=(self.sender, *parts))
+        thread.start()
+        received = bytearray()
+        while len(received) < sum(map(len, parts)):
+            received += self.receiver.recv(65536)
+        thread.join()
+        self.assertEqual(bytes(received), b"".join(parts))
+
+    def test_closed_connection_reads_as_none(self):
+        self.sender.sendall(Message(MessageType.HELLO_REQUEST, data=b"torrent").to_bytes()[:6])
+        self.sender.close()
+        self.assertIsNone(MessageReader(self.receiver).read())
+
+
+class MessageV2Test(SocketPairTest):
+
+    def test_header_widens_the_length_to_four_bytes(self):
+        message = Message(MessageType.HAVE, version=2, data=(7).to_bytes(4, "big"))
+        self.assertEqual(message.to_bytes(), bytes([2, 6, 0, 0, 0, 4, 0, 0, 0, 7]))
+        self.assertEqual(len(message.to_header(4)), V2_HEADER_SIZE)
+
+    def test_reads_pieces_longer_than_a_version_1_length(self):
+        payload = bytes(range(256)) * 1024
+        self.send_in_background(
+            Message(MessageType.PIECE_RESPONSE, version=2, data=payload),
+            Message(MessageType.ERROR, data=b"done"),
+        )
+
+        reader = MessageReader(self.receiver, max_length=len(payload))
+        message = reader.read()
+        self.assertEqual((message.version, message.type), (2, MessageType.PIECE_RESPONSE))
+        self.assertEqual(bytes(message.data), payload)
+        # Both versions can share one connection, errors are always sent as version 1
+        message = reader.read()
+        self.assertEqual((message.version, bytes(message.data)), (1, b"done"))
+
+    def test_from_socket_reads_version_2(self):
+        Message(MessageType.CHOKE, version=2).send(self.sender)
+        message = Message.from_socket(self.receiver)
+        self.assertEqual((message.version, message.type, bytes(message.data)), (2, MessageType.CHOKE, b""))
+
+    def test_max_payload_length_fits_a_piece_and_a_bitfield(self):
+        self.assertEqual(max_payload_length(1 << 20, 100), 1 << 20)
+        self.assertEqual(max_payload_length(16, 1 << 20), (1 << 20) // 8)
+        self.assertEqual(max_payload_length(16, 9), HELLO_MAX_LENGTH)
+
+
+# A length over the cap is refused from the header alone, before any payload is read
+class MessageLengthCapTest(SocketPairTest):
+    def send_header(self, length):
+        self.sender.sendall(Message(MessageType.PIECE_RESPONSE, version=2).to_header(length))
+
+    def test_reader_refuses_payloads_over_the_cap(self):
+        self.send_header(HELLO_MAX_LENGTH + 1)
+        reader = MessageReader(self.receiver)
+        self.assertIsNone(reader.read())
+        self.assertLess(len(reader._buffer), HELLO_MAX_LENGTH)
+
+    def test_reader_accepts_payloads_up_to_a_raised_cap(self):
+        payload = b"x" * (HELLO_MAX_LENGTH + 1)
+        Message(MessageType.PIECE_RESPONSE, version=2, data=payload).send(self.sender)
+        reader = MessageReader(self.receiver)
+        reader.max_length = len(payload)
+        self.assertEqual(bytes(reader.read().data), payload)
+
+    def test_from_socket_refuses_payloads_over_the_cap(self):
+        self.send_header(0xFFFFFFFF)
+        self.assertIsNone(Message.from_socket(self.receiver, max_length=1 << 20))
+
+    def test_from_stream_refuses_payloads_over_the_cap(self):
+        async def read(data, max_length):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return await Message.from_stream(reader, max_length)
+
+        header = Message(MessageType.PIECE_RESPONSE, version=2).to_header(100)
+        self.assertIsNone(asyncio.run(read(header, max_length=99)))
+        message = asyncio.run(read(header + b"y" * 100, max_length=100))
+        self.assertEqual((message.version, bytes(message.data)), (2, b"y" * 100))
+        # A stream that ends inside the payload is a lost connection
+        self.assertIsNone(asyncio.run(read(header + b"y" * 50, max_length=100)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+import unittest
+from unittest import mock
+
+from utils import piece_picker
+from utils.piece_picker import PiecePicker, has_piece, iter_pieces
+
+NUMBER_OF_PIECES = 20
+
+
+def bitfield(indexes, number_of_pieces=NUMBER_OF_PIECES):
+    field = bytearray((number_of_pieces + 7) // 8)
+    for index in indexes:
+        field[index >> 3] |= 0x80 >> (index & 7)
+    return field
+
+
+def picker_wanting_all(number_of_pieces=NUMBER_OF_PIECES):
+    picker = PiecePicker(number_of_pieces)
+    picker.want_missing(bitfield([], number_of_pieces))
+    return picker
+
+
+class BitfieldTest(unittest.TestCase):
+    def test_has_piece_treats_a_short_bitfield_as_missing_the_rest(self):
+        field = bitfield([0, 9])
+        self.assertTrue(has_piece(field, 0))
+        self.assertTrue(has_piece(field, 9))
+        self.assertFalse(has_piece(field, 1))
+        self.assertFalse(has_piece(field, 100))
+
+    def test_iter_pieces_ignores_padding_bits(self):
+        field = bitfield([1, 8, 23], number_of_pieces=24)
+        self.assertEqual(list(iter_pieces(field, 20)), [1, 8])
+
+
+class PiecePickerTest(unittest.TestCase):
+    def test_picks_the_rarest_piece_the_peer_has(self):
+        picker = picker_wanting_all()
+        picker.add_peer(bitfield(range(NUMBER_OF_PIECES)))
+        picker.add_peer(bitfield(range(10)))
+        picker.add_peer(bitfield([3]))
+
+        self.assertIn(picker.pick(bitfield(range(10))), range(10))
+        self.assertIn(picker.pick(bitfield(range(NUMBER_OF_PIECES))), range(10, NUMBER_OF_PIECES))
+
+    def test_skips_pieces_nobody_has_and_pieces_the_peer_lacks(self):
+        picker = picker_wanting_all()
+        picker.add_peer(bitfield([5]))
+        self.assertIsNone(picker.pick(bitfield([6])))
+        self.assertEqual(picker.pick(bitfield([5, 6])), 5)
+        self.assertIsNone(picker.pick(bitfield([5, 6])))
+
+    def test_hands_out_each_wanted_piece_once(self):
+        picker = picker_wanting_all()
+        everything = bitfield(range(NUMBER_OF_PIECES))
+        picker.add_peer(everything)
+
+        picked = [picker.pick(everything) for _ in range(NUMBER_OF_PIECES)]
+        self.assertEqual(sorted(picked), list(range(NUMBER_OF_PIECES)))
+        self.assertIsNone(picker.pick(everything))
+        self.assertEqual(picker.wanted_count, 0)
+
+    def test_want_missing_skips_pieces_already_stored(self):
+        picker = PiecePicker(NUMBER_OF_PIECES)
+        picker.want_missing(bitfield(range(1, NUMBER_OF_PIECES)))
+        everything = bitfield(range(NUMBER_OF_PIECES))
+        picker.add_peer(everything)
+
+        self.assertEqual(picker.wanted_count, 1)
+        self.assertEqual(picker.pick(everything), 0)
+
+    def test_returned_pieces_can_be_picked_again(self):
+        picker = picker_wanting_all()
+        picker.add_peer(bitfield([4]))
+        self.assertEqual(picker.pick(bitfield([4])), 4)
+        picker.add_wanted(4)
+        self.assertEqual(picker.pick(bitfield([4])), 4)
+
+    def test_removing_a_peer_lowers_availability(self):
+        picker = picker_wanting_all()
+        seed = bitfield(range(NUMBER_OF_PIECES))
+        picker.add_peer(seed)
+        picker.add_peer(bitfield(range(10)))
+        picker.remove_peer(bitfield(range(10)))
+        picker.add_peer(bitfield([12]))
+
+        self.assertNotEqual(picker.pick(seed), 12)
+        self.assertEqual(picker.pick(bitfield([12])), 12)
+
+    def test_announced_pieces_count_towards_availability(self):
+        picker = picker_wanting_all()
+        seed = bitfield(range(NUMBER_OF_PIECES))
+        picker.add_peer(seed)
+        for index in range(NUMBER_OF_PIECES):
+            if index != 7:
+                picker.add_peer_piece(index)
+
+        self.assertEqual(picker.pick(seed), 7)
+
+    def test_breaks_ties_at_random(self):
+        picks = set()
+        for _ in range(50):
+            picker = picker_wanting_all()
+            picker.add_peer(bitfield(range(NUMBER_OF_PIECES)))
+            picks.add(picker.pick(bitfield(range(NUMBER_OF_PIECES))))
+        self.assertGreater(len(picks), 1)
+
+    def test_serves_the_priority_window_in_order_first(self):
+        picker = picker_wanting_all()
+        everything = bitfield(range(NUMBER_OF_PIECES))
+        picker.add_peer(everything)
+        picker.add_peer(bitfield(range(8, 12)))
+        picker.set_priority(8, 4)
+
+        self.assertEqual([picker.pick(everything) for _ in range(4)], [8, 9, 10, 11])
+        self.assertNotIn(picker.pick(everything), range(8, 12))
+
+    def test_priority_window_skips_pieces_the_peer_lacks(self):
+        picker = picker_wanting_all()
+        picker.add_peer(bitfield(range(NUMBER_OF_PIECES)))
+        picker.set_priority(0, 5)
+        self.assertEqual(picker.pick(bitfield([3, 15])), 3)
+
+
+# Runs the same behavior over bitmasks split into several blocks
+class PiecePickerBlocksTest(PiecePickerTest):
+    def setUp(self):
+        patcher = mock.patch.object(piece_picker, "BLOCK_BITS", 8)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_finds_the_rarest_piece_in_a_later_block(self):
+        picker = picker_wanting_all()
+        everything = bitfield(range(NUMBER_OF_PIECES))
+        picker.add_peer(everything)
+        for index in range(NUMBER_OF_PIECES):
+            if index != 18:
+                picker.add_peer_piece(index)
+
+        for _ in range(20):
+            self.assertEqual(picker.pick(everything), 18)
+            picker.add_wanted(18)
+
+
+if __name__ == "__main__":
+    unittest.main()
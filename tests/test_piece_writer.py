@@ -0,0 +1,202 @@
+import hashlib
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from utils.chunk_manager import ChunkManager, ChunkStatus
+from utils.piece_writer import PieceWriter
+
+TORRENT_ID = "ab" * 20
+PIECE_SIZE = 1024
+NUMBER_OF_PIECES = 8
+PIECES = [bytes([index]) * PIECE_SIZE for index in range(NUMBER_OF_PIECES)]
+# Seconds to wait for a worker to do something before failing
+TIMEOUT = 5
+
+
+# Torrent whose piece holds up the worker that checks it until the test opens the gate
+class Gate:
+    def __init__(self):
+        self.reached = threading.Event()
+        self.opened = threading.Event()
+        self.chunk_manager = mock.Mock()
+        self.chunk_manager.is_chunk_available.side_effect = self._wait
+
+    def _wait(self, index):
+        self.reached.set()
+        self.opened.wait(TIMEOUT)
+        # Reports the piece as delivered so the writer drops it without writing
+        return True
+
+
+class PieceWriterTest(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.chunk_manager = ChunkManager(
+            torrent_id=TORRENT_ID,
+            file_size=PIECE_SIZE * NUMBER_OF_PIECES,
+            file_name="file.bin",
+            piece_size=PIECE_SIZE,
+            pieces=[hashlib.sha1(piece).hexdigest() for piece in PIECES],
+            folder=folder.name,
+        )
+        self.addCleanup(self.chunk_manager.close)
+        # A peer with every piece so the tests can claim any of them
+        self.everything = bytearray(b"\xff" * ((NUMBER_OF_PIECES + 7) // 8))
+        self.chunk_manager.add_peer(self.everything)
+
+    def create_writer(self, **kwargs):
+        writer = PieceWriter(**kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    def claim(self):
+        return self.chunk_manager.claim_chunk(self.everything)
+
+    def block_worker(self, writer):
+        # Keeps the only worker busy so the pieces submitted next wait in the queue
+        gate = Gate()
+        self.addCleanup(gate.opened.set)
+        writer.submit(gate.chunk_manager, 0, b"", b"")
+        self.assertTrue(gate.reached.wait(TIMEOUT))
+        return gate
+
+    def test_writes_and_completes_a_verified_piece(self):
+        writer = self.create_writer(workers=2)
+        index, expected_hash = self.claim()
+        writer.submit(self.chunk_manager, index, memoryview(PIECES[index]), expected_hash)
+        writer.close()
+
+        self.assertTrue(self.chunk_manager.is_chunk_available(index))
+        self.assertEqual(bytes(self.chunk_manager.read_stored_chunk(index)), PIECES[index])
+        self.assertEqual((writer.pieces_written, writer.hash_failures), (1, 0))
+
+    def test_copies_the_payload_before_queueing_it(self):
+        writer = self.create_writer(workers=1)
+        index, expected_hash = self.claim()
+        # Readers reuse their buffer for the next message right after submit returns
+        buffer = bytearray(PIECES[index])
+        writer.submit(self.chunk_manager, index, memoryview(buffer), expected_hash)
+        buffer[:] = bytes(PIECE_SIZE)
+        writer.close()
+
+        self.assertTrue(self.chunk_manager.is_chunk_available(index))
+
+    def test_a_bad_hash_gives_the_piece_back(self):
+        writer = self.create_writer(workers=1)
+        index, expected_hash = self.claim()
+        on_invalid = mock.Mock()
+        writer.submit(self.chunk_manager, index, b"corrupt", expected_hash, on_invalid)
+        writer.close()
+
+        on_invalid.assert_called_once_with()
+        self.assertEqual(writer.hash_failures, 1)
+        self.assertEqual(writer.pieces_written, 0)
+        self.assertEqual(self.chunk_manager.piece_status[index], ChunkStatus.MISSING)
+        # The released piece can be claimed again
+        self.assertIn(index, [self.claim()[0] for _ in range(NUMBER_OF_PIECES)])
+
+    def test_drops_a_piece_another_peer_already_delivered(self):
+        writer = self.create_writer(workers=1)
+        index, expected_hash = self.claim()
+        self.chunk_manager.write_chunk(index, PIECES[index])
+        self.chunk_manager.complete_chunk(index)
+
+        on_invalid = mock.Mock()
+        writer.submit(self.chunk_manager, index, PIECES[index], expected_hash, on_invalid)
+        writer.close()
+
+        on_invalid.assert_not_called()
+        self.assertEqual((writer.pieces_written, writer.hash_failures), (0, 0))
+        self.assertTrue(self.chunk_manager.is_chunk_available(index))
+
+    def test_drain_waits_for_the_pieces_of_its_torrent(self):
+        writer = self.create_writer(workers=1)
+        gate = self.block_worker(writer)
+        index, expected_hash = self.claim()
+        writer.submit(self.chunk_manager, index, PIECES[index], expected_hash)
+
+        drained = threading.Event()
+        # Daemon threads so a drain that never returns fails the test instead of hanging it
+        drain = threading.Thread(target=lambda: (writer.drain(self.chunk_manager), drained.set()), daemon=True)
+        drain.start()
+        self.assertFalse(drained.wait(0.2))
+
+        gate.opened.set()
+        self.assertTrue(drained.wait(TIMEOUT))
+        # Nothing is left in flight once drain returns, so the storage can be closed right away
+        self.assertTrue(self.chunk_manager.is_chunk_available(index))
+
+    def test_drain_returns_at_once_without_pending_pieces(self):
+        writer = self.create_writer(workers=1)
+        self.block_worker(writer)
+        writer.drain(self.chunk_manager)
+
+    def test_a_refused_submit_is_not_waited_for(self):
+        writer = self.create_writer(workers=1, max_queued=1)
+        gate = self.block_worker(writer)
+        index, expected_hash = self.claim()
+        self.assertTrue(writer.submit(self.chunk_manager, index, PIECES[index], expected_hash))
+        other, other_hash = self.claim()
+        self.assertFalse(writer.submit(self.chunk_manager, other, PIECES[other], other_hash, block=False))
+
+        gate.opened.set()
+        drain = threading.Thread(target=writer.drain, args=(self.chunk_manager,), daemon=True)
+        drain.start()
+        drain.join(TIMEOUT)
+        self.assertFalse(drain.is_alive())
+
+    def submit_all(self, writer, indexes):
+        for index in indexes:
+            writer.submit(self.chunk_manager, index, PIECES[index], self.chunk_manager.piece_hash(index))
+
+    def test_joins_adjacent_queued_pieces_into_one_write(self):
+        writer = self.create_writer(workers=1)
+        for _ in range(NUMBER_OF_PIECES):
+            self.claim()
+        gate = self.block_worker(writer)
+        self.submit_all(writer, [4, 2, 6, 3])
+        gate.opened.set()
+        writer.drain(self.chunk_manager)
+
+        # 2 to 4 go out together, 6 on its own
+        self.assertEqual((writer.writes, writer.pieces_written), (2, 4))
+        for index in (2, 3, 4, 6):
+            self.assertEqual(bytes(self.chunk_manager.read_stored_chunk(index)), PIECES[index])
+        self.assertFalse(self.chunk_manager.is_chunk_available(5))
+
+    def test_writes_a_piece_delivered_twice_in_one_batch_once(self):
+        writer = self.create_writer(workers=1)
+        for _ in range(NUMBER_OF_PIECES):
+            self.claim()
+        gate = self.block_worker(writer)
+        self.submit_all(writer, [1, 1])
+        gate.opened.set()
+        writer.drain(self.chunk_manager)
+
+        self.assertEqual((writer.writes, writer.pieces_written), (1, 1))
+
+    def test_interval_policy_syncs_after_enough_bytes(self):
+        writer = self.create_writer(workers=1, fsync="interval", fsync_interval=2 * PIECE_SIZE)
+        for _ in range(NUMBER_OF_PIECES):
+            self.claim()
+        gate = self.block_worker(writer)
+        self.submit_all(writer, [0, 2, 4, 6, 7])
+        gate.opened.set()
+        writer.drain(self.chunk_manager)
+
+        # 0, 2 and 4 are written alone, 6 and 7 together
+        self.assertEqual(writer.writes, 4)
+        self.assertEqual(writer.syncs, 2)
+
+    def test_assemble_syncs_unless_the_policy_is_none(self):
+        for policy, syncs in (("none", 0), ("complete", 1), ("interval", 1)):
+            writer = self.create_writer(workers=1, fsync=policy)
+            writer.assemble(self.chunk_manager)
+            self.assertEqual(writer.syncs, syncs, policy)
+
+
+if __name__ == "__main__":
+    unittest.main()
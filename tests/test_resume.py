@@ -0,0 +1,122 @@
+import os
+import tempfile
+import unittest
+
+from utils.resume import ResumeState
+
+TORRENT_ID = "ab" * 20
+NUMBER_OF_PIECES = 8
+PIECES_PER_FILE = 4
+
+
+def bitfield(indexes):
+    field = bytearray((NUMBER_OF_PIECES + 7) // 8)
+    for index in indexes:
+        field[index >> 3] |= 0x80 >> (index & 7)
+    return field
+
+
+# Storage stand-in with two files of four pieces each that records which pieces were hashed
+class Storage:
+    def __init__(self, folder, valid_pieces):
+        self.files = [os.path.join(folder, f"chunk_{number}") for number in range(2)]
+        for path in self.files:
+            with open(path, "wb") as chunk_file:
+                chunk_file.write(b"data")
+        self.valid_pieces = set(valid_pieces)
+        self.verified = []
+
+    def candidate_pieces(self):
+        return list(range(NUMBER_OF_PIECES))
+
+    def piece_file(self, index):
+        return self.files[index // PIECES_PER_FILE]
+
+    def verify_piece(self, index):
+        self.verified.append(index)
+        return index in self.valid_pieces
+
+
+class ResumeStateTest(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+        self.path = os.path.join(self.folder, ".file.bin.resume")
+        self.storage = Storage(self.folder, valid_pieces=[0, 1, 5])
+
+    def resume_state(self, torrent_id=TORRENT_ID, storage_type="chunks"):
+        return ResumeState(self.path, torrent_id, storage_type, NUMBER_OF_PIECES)
+
+    def load(self, resume_state=None):
+        self.storage.verified = []
+        return sorted((resume_state or self.resume_state()).load_pieces(self.storage, workers=2))
+
+    def touch(self, path):
+        # Moves the mtime far enough that even coarse filesystem timestamps see the change
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    def test_hashes_every_candidate_without_a_state_file(self):
+        self.assertEqual(self.load(), [0, 1, 5])
+        self.assertEqual(sorted(self.storage.verified), list(range(NUMBER_OF_PIECES)))
+
+    def test_unchanged_files_are_not_hashed_again(self):
+        self.resume_state().save(self.storage, bitfield([0, 1, 5]))
+
+        self.assertEqual(self.load(), [0, 1, 5])
+        self.assertEqual(self.storage.verified, [])
+
+    def test_only_the_changed_file_is_hashed_again(self):
+        self.resume_state().save(self.storage, bitfield([0, 1, 5]))
+        self.touch(self.storage.files[1])
+
+        self.assertEqual(self.load(), [0, 1, 5])
+        self.assertEqual(sorted(self.storage.verified), [4, 5, 6, 7])
+
+    def test_a_resized_file_is_hashed_again(self):
+        self.resume_state().save(self.storage, bitfield([0, 1, 5]))
+        with open(self.storage.files[0], "ab") as chunk_file:
+            chunk_file.write(b"more")
+
+        self.assertEqual(self.load(), [0, 1, 5])
+        self.assertEqual(sorted(self.storage.verified), [0, 1, 2, 3])
+
+    def test_files_without_verified_pieces_are_hashed_again(self):
+        # Nothing in the second file was saved as verified, so it has no recorded stat to match
+        self.resume_state().save(self.storage, bitfield([0, 1]))
+
+        self.assertEqual(self.load(), [0, 1, 5])
+        self.assertEqual(sorted(self.storage.verified), [4, 5, 6, 7])
+
+    def test_state_for_another_torrent_or_layout_is_ignored(self):
+        self.resume_state(torrent_id="cd" * 20).save(self.storage, bitfield([0, 1, 5]))
+        self.assertFalse(self.resume_state().is_for_torrent())
+        self.assertEqual(self.load(), [0, 1, 5])
+        self.assertEqual(len(self.storage.verified), NUMBER_OF_PIECES)
+
+        self.resume_state(storage_type="single").save(self.storage, bitfield([0, 1, 5]))
+        self.assertFalse(self.resume_state().is_for_torrent())
+        self.assertEqual(self.load(), [0, 1, 5])
+        self.assertEqual(len(self.storage.verified), NUMBER_OF_PIECES)
+
+    def test_corrupt_state_file_is_ignored(self):
+        with open(self.path, "w") as state_file:
+            state_file.write("{not json")
+
+        self.assertFalse(self.resume_state().is_for_torrent())
+        self.assertEqual(self.load(), [0, 1, 5])
+        self.assertEqual(len(self.storage.verified), NUMBER_OF_PIECES)
+
+    def test_save_file_records_the_pieces_of_one_file(self):
+        resume_state = self.resume_state()
+        resume_state.save_file(self.storage.files[0], bitfield([0, 1]))
+
+        self.assertTrue(resume_state.is_for_torrent())
+        self.assertEqual(self.load(), [0, 1, 5])
+        self.assertEqual(sorted(self.storage.verified), [4, 5, 6, 7])
+        self.assertFalse(os.path.exists(f"{self.path}.tmp"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import io
+import unittest
+
+from handlers.stream_thread import _parse_range, _send_range
+
+FILE_SIZE = 1000
+PIECE_SIZE = 64
+DATA = bytes(index % 251 for index in range(FILE_SIZE))
+
+
+# Chunk manager stand-in serving DATA that can hold back chunks as if they were still downloading
+class Chunks:
+    def __init__(self, missing=()):
+        self.piece_size = PIECE_SIZE
+        self.missing = set(missing)
+        self.waited = []
+
+    def wait_for_chunk(self, index, timeout=None):
+        self.waited.append(index)
+        return index not in self.missing
+
+    def read_chunk(self, index):
+        return DATA[index * PIECE_SIZE : (index + 1) * PIECE_SIZE]
+
+
+class ParseRangeTest(unittest.TestCase):
+    def test_no_header_asks_for_the_whole_file(self):
+        self.assertEqual(_parse_range(None, FILE_SIZE), (0, FILE_SIZE - 1))
+
+    def test_closed_range(self):
+        self.assertEqual(_parse_range("bytes=100-199", FILE_SIZE), (100, 199))
+        self.assertEqual(_parse_range("bytes=5-5", FILE_SIZE), (5, 5))
+
+    def test_open_range_runs_to_the_end(self):
+        self.assertEqual(_parse_range("bytes=900-", FILE_SIZE), (900, FILE_SIZE - 1))
+
+    def test_end_past_the_file_is_cut_to_it(self):
+        self.assertEqual(_parse_range("bytes=900-5000", FILE_SIZE), (900, FILE_SIZE - 1))
+
+    def test_suffix_range_asks_for_the_last_bytes(self):
+        self.assertEqual(_parse_range("bytes=-100", FILE_SIZE), (900, FILE_SIZE - 1))
+        self.assertEqual(_parse_range("bytes=-5000", FILE_SIZE), (0, FILE_SIZE - 1))
+
+    def test_only_the_first_of_several_ranges_is_served(self):
+        self.assertEqual(_parse_range("bytes=0-9, 20-29", FILE_SIZE), (0, 9))
+
+    def test_tolerates_whitespace(self):
+        self.assertEqual(_parse_range(" bytes = 10 - 19", FILE_SIZE), (10, 19))
+
+    def test_unsatisfiable_ranges(self):
+        for range_header in ("bytes=1000-", "bytes=2000-3000", "bytes=20-10", "bytes=-0"):
+            self.assertIsNone(_parse_range(range_header, FILE_SIZE), range_header)
+
+    def test_unparsable_headers_ask_for_the_whole_file(self):
+        for range_header in ("bytes=-", "items=0-10", "garbage"):
+            self.assertEqual(_parse_range(range_header, FILE_SIZE), (0, FILE_SIZE - 1), range_header)
+
+
+class SendRangeTest(unittest.TestCase):
+    def send(self, start, end, chunks=None):
+        chunks = chunks or Chunks()
+        output = io.BytesIO()
+        _send_range(output, chunks, start, end)
+        return output.getvalue(), chunks
+
+    def test_sends_a_range_inside_one_chunk(self):
+        sent, chunks = self.send(70, 80)
+        self.assertEqual(sent, DATA[70:81])
+        self.assertEqual(chunks.waited, [1])
+
+    def test_sends_a_range_across_chunks(self):
+        sent, chunks = self.send(60, 200)
+        self.assertEqual(sent, DATA[60:201])
+        self.assertEqual(chunks.waited, [0, 1, 2, 3])
+
+    def test_sends_the_short_last_chunk(self):
+        sent, _ = self.send(0, FILE_SIZE - 1)
+        self.assertEqual(sent, DATA)
+
+    def test_stops_at_a_chunk_that_never_arrives(self):
+        sent, _ = self.send(0, 300, Chunks(missing=[2]))
+        self.assertEqual(sent, DATA[: 2 * PIECE_SIZE])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from benchmarks.tracker import Tracker
+from handlers import tracker_thread
+from handlers.tracker_thread import create_tracker_thread, tracker_task
+from utils.chunk_manager import ChunkManager
+from utils.connection_manager import ConnectionManager
+from utils.wakeup import Wakeup
+
+PEER_ID = "peer-under-test"
+TORRENT_ID = "ab" * 20
+PIECE_SIZE = 1024
+NUMBER_OF_PIECES = 4
+# Seconds to wait for the tracker thread to do something before failing
+TIMEOUT = 5
+
+
+# Event that records every backoff the tracker waits for and asks it to stop after a few
+class RecordingEvent:
+    def __init__(self, stop_after):
+        self.stop_after = stop_after
+        self.waits = []
+
+    def is_set(self):
+        return len(self.waits) >= self.stop_after
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+        return self.is_set()
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+class TrackerThreadTest(unittest.TestCase):
+    def setUp(self):
+        self.tracker = Tracker(interval=60).start()
+        self.addCleanup(self.tracker.close)
+        # Counts announces while still answering them
+        self.tracker.announce = mock.Mock(wraps=self.tracker.announce)
+
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.chunk_manager = ChunkManager(
+            torrent_id=TORRENT_ID,
+            file_size=PIECE_SIZE * NUMBER_OF_PIECES,
+            file_name="file.bin",
+            piece_size=PIECE_SIZE,
+            pieces=["00" * 20] * NUMBER_OF_PIECES,
+            folder=folder.name,
+        )
+        self.addCleanup(self.chunk_manager.close)
+        self.connection_manager = ConnectionManager(PEER_ID, max_connections=10)
+
+    def start_tracker_thread(self, tracker_url=None):
+        thread_event = Wakeup()
+        thread = create_tracker_thread(
+            peer_id=PEER_ID,
+            ip_address="127.0.0.1",
+            port_number=6881,
+            torrent_id=TORRENT_ID,
+            tracker_url=tracker_url or self.tracker.url,
+            thread_event=thread_event,
+            chunk_manager=self.chunk_manager,
+            connection_manager=self.connection_manager,
+            timeout=TIMEOUT,
+        )
+
+        def stop():
+            thread_event.set()
+            thread.join()
+            thread_event.close()
+
+        self.addCleanup(stop)
+        return thread
+
+    def announces(self):
+        return self.tracker.announce.call_count
+
+    def test_announce_reports_stats_and_hands_peers_to_connection_manager(self):
+        self.tracker.announce(
+            {"peer_id": "other-peer", "ip": "127.0.0.2", "port": "7000", "torrent_id": TORRENT_ID}
+        )
+        self.start_tracker_thread()
+
+        self.assertTrue(wait_until(lambda: PEER_ID in self.tracker.swarm(TORRENT_ID)))
+        self.assertEqual(
+            self.tracker.swarm(TORRENT_ID)[PEER_ID],
+            {
+                "address": "127.0.0.1:6881",
+                "uploaded": 0,
+                "downloaded": 0,
+                "left": PIECE_SIZE * NUMBER_OF_PIECES,
+            },
+        )
+        self.assertTrue(wait_until(lambda: self.connection_manager.usable_count(TORRENT_ID) == 1))
+        [connection] = self.connection_manager.connections()
+        self.assertEqual(connection["peer_id"], "other-peer")
+        self.assertEqual(connection["address"], "127.0.0.2:7000")
+
+    def test_failed_announces_back_off_exponentially_up_to_the_limit(self):
+        thread_event = RecordingEvent(stop_after=9)
+        tracker_task(
+            PEER_ID,
+            "127.0.0.1",
+            6881,
+            TORRENT_ID,
+            self.tracker.url.replace("/announce", "/missing"),
+            thread_event,
+            self.chunk_manager,
+            self.connection_manager,
+            TIMEOUT,
+        )
+
+        self.assertEqual(len(thread_event.waits), 9)
+        for failures, backoff in enumerate(thread_event.waits):
+            limit = min(tracker_thread.BASE_BACKOFF * 2**failures, tracker_thread.MAX_BACKOFF)
+            self.assertGreaterEqual(backoff, limit / 2)
+            self.assertLessEqual(backoff, limit)
+        self.assertEqual(self.announces(), 0)
+
+    def test_announces_early_while_short_on_peers(self):
+        with mock.patch.object(tracker_thread, "MIN_ANNOUNCE_INTERVAL", 0.2):
+            self.start_tracker_thread()
+            self.assertTrue(wait_until(lambda: self.announces() >= 3))
+
+    def test_waits_for_the_interval_once_done(self):
+        with mock.patch.object(tracker_thread, "MIN_ANNOUNCE_INTERVAL", 0.2), mock.patch.object(
+            self.chunk_manager, "is_done", return_value=True
+        ):
+            self.start_tracker_thread()
+            self.assertTrue(wait_until(lambda: self.announces() == 1))
+            time.sleep(1)
+            self.assertEqual(self.announces(), 1)
+
+    def test_waits_for_the_interval_with_enough_peers(self):
+        for number in range(tracker_thread.MIN_USABLE_PEERS):
+            self.tracker.announce(
+                {
+                    "peer_id": f"other-peer-{number}",
+                    "ip": "127.0.0.2",
+                    "port": str(7000 + number),
+                    "torrent_id": TORRENT_ID,
+                }
+            )
+        baseline = self.announces()
+
+        with mock.patch.object(tracker_thread, "MIN_ANNOUNCE_INTERVAL", 0.2):
+            self.start_tracker_thread()
+            self.assertTrue(wait_until(lambda: self.announces() == baseline + 1))
+            time.sleep(1)
+            self.assertEqual(self.announces(), baseline + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+import unittest
+from unittest import mock
+
+from utils.upload_scheduler import UploadScheduler
+
+
+# Upload connection that remembers every choke change the scheduler told it about
+class Connection:
+    def __init__(self, scheduler, key, ip=None):
+        self.key = key
+        self.changes = []
+        self.starts_choked = scheduler.register(key, ip or key, self.changes.append)
+
+
+# Wakeup stand-in that counts how often it was set
+class Counter:
+    def __init__(self):
+        self.count = 0
+
+    def set(self):
+        self.count += 1
+
+
+class UploadSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        # Every rate and timer runs on a clock the tests move by hand
+        self.now = 1000.0
+        patcher = mock.patch("time.monotonic", new=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = UploadScheduler(
+            upload_slots=3, rechoke_interval=10, optimistic_interval=30, choke_grace=5
+        )
+
+    def connect(self, *keys):
+        return [Connection(self.scheduler, key) for key in keys]
+
+    def choked(self):
+        return {peer["ip"] for peer in self.scheduler.peers() if peer["choked"]}
+
+    def test_register_hands_out_free_slots_then_chokes(self):
+        connections = self.connect("a", "b", "c", "d")
+        self.assertEqual([connection.starts_choked for connection in connections], [False, False, False, True])
+
+    def test_never_chokes_without_slots(self):
+        scheduler = UploadScheduler(upload_slots=0)
+        connections = [Connection(scheduler, key) for key in "abcdef"]
+        scheduler.tick()
+        self.assertFalse(any(connection.starts_choked for connection in connections))
+        self.assertFalse(any(connection.changes for connection in connections))
+        self.assertIsNone(scheduler.next_tick_delay())
+
+    def test_rechoke_keeps_the_fastest_downloaders_and_one_optimistic_unchoke(self):
+        self.connect("a", "b", "c", "d", "e")
+        self.now += 1
+        for ip, length in (("a", 100), ("b", 5000), ("c", 10), ("d", 3000), ("e", 20)):
+            self.scheduler.record_download(ip, length)
+        self.now += 1
+        self.scheduler.tick()
+
+        # b and d earn the regular slots, the third goes to one of the slower peers
+        choked = self.choked()
+        self.assertEqual(len(choked), 2)
+        self.assertNotIn("b", choked)
+        self.assertNotIn("d", choked)
+        [optimistic] = [peer["ip"] for peer in self.scheduler.peers() if peer["optimistic"]]
+        self.assertIn(optimistic, {"a", "c", "e"})
+        self.assertNotIn(optimistic, choked)
+
+    def test_seeds_rank_by_upload_rate(self):
+        self.scheduler.upload_slots = 2
+        self.connect("a", "b", "c", "d")
+        self.now += 1
+        for key, length in (("a", 10), ("b", 10), ("c", 9000), ("d", 10)):
+            self.scheduler.record_upload(key, length)
+        self.now += 1
+        self.scheduler.tick()
+        self.assertNotIn("c", self.choked())
+
+    def test_choke_changes_are_reported_to_the_connection(self):
+        a, b, c, d = self.connect("a", "b", "c", "d")
+        self.now += 1
+        self.scheduler.record_download("d", 5000)
+        self.scheduler.record_download("c", 4000)
+        self.now += 1
+        with mock.patch("random.choice", side_effect=lambda keys: keys[0]):
+            self.scheduler.tick()
+
+        self.assertEqual(d.changes, [False])
+        self.assertEqual(c.changes, [])
+        self.assertEqual(a.changes + b.changes, [True])
+
+    def test_freed_slot_wakes_the_choker_and_goes_to_a_choked_peer(self):
+        a, *_ = self.connect("a", "b", "c", "d")
+        slot_freed = Counter()
+        self.scheduler.add_wakeup(slot_freed)
+        self.scheduler.tick()
+        self.now += 1
+
+        self.scheduler.unregister(a.key)
+        self.assertEqual(slot_freed.count, 1)
+        self.scheduler.tick()
+        self.assertEqual(self.choked(), set())
+
+    def test_unregistering_a_choked_peer_does_not_wake_the_choker(self):
+        *_, d = self.connect("a", "b", "c", "d")
+        slot_freed = Counter()
+        self.scheduler.add_wakeup(slot_freed)
+        self.scheduler.unregister(d.key)
+        self.assertEqual(slot_freed.count, 0)
+
+    def test_reranks_after_the_interval(self):
+        self.connect("a", "b", "c", "d")
+        self.scheduler.tick()
+        self.assertAlmostEqual(self.scheduler.next_tick_delay(), 10)
+        self.now += 4
+        self.assertAlmostEqual(self.scheduler.next_tick_delay(), 6)
+
+    def test_sleeps_until_the_first_peer_registers(self):
+        peer_joined = Counter()
+        self.scheduler.add_wakeup(peer_joined)
+        self.assertIsNone(self.scheduler.next_tick_delay())
+
+        self.connect("a", "b")
+        self.assertEqual(peer_joined.count, 1)
+        self.assertIsNotNone(self.scheduler.next_tick_delay())
+
+        self.scheduler.unregister("a")
+        self.scheduler.unregister("b")
+        self.assertIsNone(self.scheduler.next_tick_delay())
+
+    def test_choked_peers_are_served_during_the_grace_period_only(self):
+        *_, d = self.connect("a", "b", "c", "d")
+        self.assertTrue(d.starts_choked)
+        self.now += 4
+        self.assertTrue(self.scheduler.may_request("d"))
+
+        # The grace period starts over once the connection actually sends the choke
+        self.scheduler.choke_sent("d")
+        self.now += 4
+        self.assertTrue(self.scheduler.may_request("d"))
+        self.now += 2
+        self.assertFalse(self.scheduler.may_request("d"))
+
+    def test_unchoked_and_unregistered_peers_may_always_request(self):
+        self.connect("a")
+        self.now += 100
+        self.assertTrue(self.scheduler.may_request("a"))
+        self.assertTrue(self.scheduler.may_request("version 1 peer"))
+
+
+if __name__ == "__main__":
+    unittest.main()
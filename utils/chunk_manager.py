@@ -1,79 +1,307 @@
-from enum import Enum
-import os
-import logging
+from enum import IntEnum
+import threading
 
+from utils.piece_picker import PiecePicker, has_piece
+from utils.storage import STORAGE_TYPES, HASH_SIZE
+from utils.resume import ResumeState
 
-class ChunkStatus(Enum):
+
+class ChunkStatus(IntEnum):
     MISSING = 1
     DOWNLOADING = 2
     AVAILABLE = 3
 
 
 class ChunkManager:
-    def __init__(self, torrent_id, file_size, file_name, piece_size, pieces, folder):
+    def __init__(
+        self,
+        torrent_id,
+        file_size,
+        file_name,
+        piece_size,
+        pieces,
+        folder,
+        storage="file",
+        piece_cache=None,
+        piece_reader=None,
+        verify_workers=None,
+        stream_window=0,
+    ):
         self.torrent_id = torrent_id
         self.file_size = file_size
         self.file_name = file_name
         self.piece_size = piece_size
         self.number_of_pieces = len(pieces)
+        # Every piece hash packed back to back, HASH_SIZE bytes each
+        self.piece_hashes = b"".join(bytes.fromhex(piece) for piece in pieces)
         self.folder = folder
+        self.is_closed = False
+        self.lock = threading.Lock()
+        # Notified whenever a chunk becomes available or the torrent closes
+        self.chunk_ready = threading.Condition(self.lock)
+        # Optional in memory cache shared by every upload connection
+        self.piece_cache = piece_cache
+        # Optional disk scheduler that storage reads are queued on instead of hitting the disk right away
+        self.piece_reader = piece_reader
+
+        # Creates the storage backend, an existing file is only resized if the resume state shows it is this torrent's
+        self.resume_state = ResumeState(
+            f"{folder}/.{file_name}.resume", torrent_id, storage, self.number_of_pieces
+        )
+        self.storage = STORAGE_TYPES[storage](
+            folder,
+            file_name,
+            file_size,
+            piece_size,
+            self.piece_hashes,
+            is_owned=self.resume_state.is_for_torrent(),
+        )
+
+        # Keeps the status of each piece by index plus the bitfield sent in hello responses
+        self.piece_status = bytearray([ChunkStatus.MISSING]) * self.number_of_pieces
+        self.bitfield = bytearray((self.number_of_pieces + 7) // 8)
+        self.available_count = 0
+        # Bytes transferred this session, reported to the tracker
+        self.bytes_uploaded = 0
+        self.bytes_downloaded = 0
+
+        # Marks pieces already in storage as available, trusting the fast-resume file where it still matches
+        for index in self.resume_state.load_pieces(self.storage, verify_workers):
+            self._mark_available(index)
+
+        # Creates a picker that hands out missing chunks rarest first
+        self.picker = PiecePicker(self.number_of_pieces)
+        # Number of requests in flight for each downloading chunk
+        self.downloading_chunks = {}
+        # Callbacks told the index of every chunk that becomes available
+        self.completion_listeners = []
+        # Wakeups set whenever a chunk may have become claimable, completes or the torrent closes
+        self.wakeups = []
+        self.picker.want_missing(self.bitfield)
+
+        # Streams the file in order by downloading the stream_window chunks after the playhead first, 0 disables
+        self.stream_window = stream_window
+        self.playhead = 0
+        self._update_stream_priority()
+
+    def piece_hash(self, index):
+        return self.piece_hashes[index * HASH_SIZE : (index + 1) * HASH_SIZE]
+
+    def peer_bitfield(self, data):
+        # Copies a bitfield from a hello response, padded or cut to the torrent's size so have messages always fit
+        size = len(self.bitfield)
+        return bytearray(data[:size]).ljust(size, b"\0")
+
+    def add_peer(self, peer_chunks):
+        # Counts a connected peer's chunks towards their availability
+        with self.lock:
+            self.picker.add_peer(peer_chunks)
+
+    def remove_peer(self, peer_chunks):
+        with self.lock:
+            self.picker.remove_peer(peer_chunks)
+
+    def add_peer_chunk(self, peer_chunks: bytearray, index):
+        # Marks a chunk a peer announced with a have message in its bitfield
+        if index >= self.number_of_pieces or has_piece(peer_chunks, index):
+            return
+        with self.lock:
+            peer_chunks[index >> 3] |= 0x80 >> (index & 7)
+            self.picker.add_peer_piece(index)
+
+    def add_completion_listener(self, callback):
+        with self.lock:
+            self.completion_listeners.append(callback)
+
+    def remove_completion_listener(self, callback):
+        with self.lock:
+            self.completion_listeners.remove(callback)
+
+    def add_wakeup(self, wakeup):
+        with self.lock:
+            self.wakeups.append(wakeup)
+
+    def remove_wakeup(self, wakeup):
+        with self.lock:
+            self.wakeups.remove(wakeup)
+
+    def claim_chunk(self, peer_chunks, requested_chunks=(), endgame_threshold=0):
+        # Picks the rarest missing chunk the peer has and marks it as downloading
+        with self.lock:
+            index = self.picker.pick(peer_chunks)
+            if index is None:
+                index = self._pick_endgame_chunk(
+                    peer_chunks, requested_chunks, endgame_threshold
+                )
+                if index is None:
+                    return None
+            self.piece_status[index] = ChunkStatus.DOWNLOADING
+            self.downloading_chunks[index] = self.downloading_chunks.get(index, 0) + 1
+            return index, self.piece_hash(index)
+
+    def release_chunk(self, index):
+        # Puts a chunk that failed to download back up for grabs once no one else is fetching it
+        with self.lock:
+            if self._finish_request(index) > 0:
+                return
+            if self.piece_status[index] != ChunkStatus.AVAILABLE:
+                self.piece_status[index] = ChunkStatus.MISSING
+                self.picker.add_wanted(index)
+                self._wake()
+
+    def complete_chunk(self, index):
+        with self.lock:
+            self._finish_request(index)
+            if not self._mark_available(index):
+                return
+            self.bytes_downloaded += self.storage.piece_length(index)
+            completion_listeners = list(self.completion_listeners)
+            if index == self.playhead:
+                self._update_stream_priority()
+            self.chunk_ready.notify_all()
+            self._wake()
+
+        # Tells connected peers about the new chunk outside of the lock
+        for callback in completion_listeners:
+            callback(index)
 
-        # Creates directory if it doesn't exist
-        try:
-            os.makedirs(f"{folder}/chunks")
-        except OSError as error:
-            logging.debug("Directory already exist will ignore error :)")
+    def add_uploaded(self, length):
+        with self.lock:
+            self.bytes_uploaded += length
 
-        # Creates a dictionary entry for each piece
-        piece_status_dictionary = {}
+    def bytes_left(self):
+        # Sums the size of every piece that isn't available yet, only the last piece can be short
+        missing = self.number_of_pieces - self.available_count
+        if missing == 0:
+            return 0
+        last_index = self.number_of_pieces - 1
+        if self.is_chunk_available(last_index):
+            return missing * self.piece_size
+        return (missing - 1) * self.piece_size + self.storage.piece_length(last_index)
 
-        # Loops through each piece and adds it to a list
-        index = 0
-        for piece in pieces:
-            piece_status_dictionary[piece] = ChunkStatus.MISSING
+    def set_playhead(self, index):
+        # Moves the streaming window to where the file is being read from
+        with self.lock:
+            self.playhead = min(max(index, 0), self.number_of_pieces)
+            self._update_stream_priority()
 
-        # Loops through already existing chunks and updates the dictionary
-        chunk_files = os.listdir(f"{folder}/chunks")
-        for cfile in chunk_files:
-            name, value, _hash = cfile.split("_")
-            if name == self.file_name:
-                piece_status_dictionary[_hash] = ChunkStatus.AVAILABLE
+    def wait_for_chunk(self, index, timeout=None):
+        # Blocks until the chunk is available or the torrent closes, returns whether it is available
+        with self.chunk_ready:
+            self.chunk_ready.wait_for(
+                lambda: self.is_closed or self.is_chunk_available(index), timeout
+            )
+            return self.is_chunk_available(index)
 
-        self.piece_status_dictionary = piece_status_dictionary
-    
+    def is_chunk_available(self, index):
+        return self.piece_status[index] == ChunkStatus.AVAILABLE
+
+    def _mark_available(self, index):
+        if self.piece_status[index] == ChunkStatus.AVAILABLE:
+            return False
+        self.piece_status[index] = ChunkStatus.AVAILABLE
+        self.bitfield[index >> 3] |= 0x80 >> (index & 7)
+        self.available_count += 1
+        return True
+
+    def _wake(self):
+        for wakeup in self.wakeups:
+            wakeup.set()
+
+    def _update_stream_priority(self):
+        # Skips the playhead past chunks that are already here and prioritizes the window after it
+        if self.stream_window <= 0:
+            return
+        while (
+            self.playhead < self.number_of_pieces
+            and self.piece_status[self.playhead] == ChunkStatus.AVAILABLE
+        ):
+            self.playhead += 1
+        self.picker.set_priority(self.playhead, self.stream_window)
+
+    def _finish_request(self, index):
+        remaining_requests = self.downloading_chunks.get(index, 1) - 1
+        if remaining_requests > 0:
+            self.downloading_chunks[index] = remaining_requests
+        else:
+            self.downloading_chunks.pop(index, None)
+        return remaining_requests
+
+    def _pick_endgame_chunk(self, peer_chunks, requested_chunks, endgame_threshold):
+        # Only requests chunks that are already downloading once few are left
+        remaining = self.number_of_pieces - self.available_count
+        if remaining == 0 or remaining > endgame_threshold:
+            return None
+
+        # Prefers the chunk with the fewest copies already in flight
+        endgame_chunk = None
+        for index, request_count in self.downloading_chunks.items():
+            # Skips chunks that finished while other copies were still in flight
+            if (
+                index in requested_chunks
+                or self.piece_status[index] == ChunkStatus.AVAILABLE
+                or not has_piece(peer_chunks, index)
+            ):
+                continue
+            if endgame_chunk is None or request_count < self.downloading_chunks[endgame_chunk]:
+                endgame_chunk = index
+        return endgame_chunk
+
+
+    def write_chunk(self, index, data):
+        self.write_chunks(index, [data])
+
+    def write_chunks(self, index, chunks):
+        # Writes consecutive chunks starting at index together
+        self.storage.write_pieces(index, chunks)
+
+        # Freshly downloaded chunks are the ones other peers ask for next
+        if self.piece_cache is not None:
+            for number, data in enumerate(chunks):
+                self.piece_cache.put((self.torrent_id, index + number), bytes(data))
+
+    def cached_chunk(self, index):
+        # Returns the chunk if the piece cache holds it, None otherwise
+        if self.piece_cache is None:
+            return None
+        return self.piece_cache.get((self.torrent_id, index))
+
+    def read_stored_chunk(self, index):
+        # Reads the chunk from storage, through the disk scheduler when there is one
+        if self.piece_reader is None:
+            return self.storage.read_piece(index)
+        return self.piece_reader.read(self.storage, index)
+
+    def read_chunk(self, index):
+        # Serves from memory when possible, the cache is only filled with freshly downloaded chunks
+        data = self.cached_chunk(index)
+        if data is None:
+            data = self.read_stored_chunk(index)
+        return data
+
+    def open_chunk(self, index):
+        # Returns a context manager giving (file, offset, length) so a chunk can be sent with sendfile
+        return self.storage.open_piece(index)
+
+    def assemble_file(self):
+        # Creates the final file, only the legacy chunk layout has to copy anything
+        self.storage.assemble()
+
+    def sync(self):
+        # Flushes what has been written so far to the disk
+        self.storage.sync()
+
+    def close(self):
+        with self.chunk_ready:
+            self.is_closed = True
+            self.chunk_ready.notify_all()
+            self._wake()
+        self.storage.close()
+        self.resume_state.save(self.storage, self.bitfield)
 
     def is_done(self):
-        is_done = True
-        for key in self.piece_status_dictionary:
-            if(self.piece_status_dictionary[key] != ChunkStatus.AVAILABLE):
-                is_done = False
-                break
-        return is_done
-            
+        return self.available_count == self.number_of_pieces
 
     def check_current_chunks(self):
-
-        # Creates a result array
-        result = []
-        _bytearray = bytearray()
-        # Loops through each piece and checks if it is downloaded and creates a binary number
-        for key in self.piece_status_dictionary:
-            # Checks if the piece is available
-            if self.piece_status_dictionary[key] == ChunkStatus.AVAILABLE:
-                result.append(True)
-            else:
-                result.append(False)
-            
-            # Converts the boolean array into a bytearray
-            if result.__len__() == 8:
-                _bytearray.append(sum(v << i for i, v in enumerate(result[::-1])))
-                result.clear()
-
-        # Pads the array if not empty
-        if (remain := result.__len__()) != 0:
-            for i in range(8 - remain):
-                result.append(False)
-            # Appends remaning results to bytearray
-            _bytearray.append(sum(v << i for i, v in enumerate(result[::-1])))
-
-        return bytes(_bytearray)
+        # Returns a snapshot of the bitfield that is kept up to date as pieces complete
+        return bytes(self.bitfield)
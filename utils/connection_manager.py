@@ -0,0 +1,224 @@
+from enum import Enum
+import threading
+import time
+
+# Seconds to wait before redialing a peer after its first failed attempt
+BASE_BACKOFF = 2
+# Seconds to wait before redialing a peer whose connection closed or dropped
+RECONNECT_DELAY = 5
+# Longest a failing peer is left alone before it is tried again
+MAX_BACKOFF = 120
+
+
+class ConnectionState(Enum):
+    IDLE = "idle"
+    CONNECTING = "connecting"
+    CONNECTED = "connected"
+    BACKOFF = "backoff"
+
+
+class PeerConnection:
+    def __init__(self, torrent_id, peer_id, address):
+        self.torrent_id = torrent_id
+        self.peer_id = peer_id
+        self.address = address
+        self.state = ConnectionState.IDLE
+        self.failures = 0
+        self.snubs = 0
+        self.next_attempt = 0
+        self.connected_since = None
+        self.peer_stats = None
+
+
+# Keeps one outgoing connection per peer id and torrent and limits how many are open at once
+#
+# Engines ask for the peers worth dialing and report back when a connection
+# opens, fails, gets snubbed or closes. Peers that fail to connect or keep
+# being too slow are retried after an exponential backoff, closed connections
+# are redialed after RECONNECT_DELAY. Wakeups added with add_wakeup are set on
+# every change that could make a peer dialable or free a slot, so engines
+# sleep until then or until next_dial_delay() instead of polling.
+# The limit is shared by every torrent the peer is running.
+class ConnectionManager:
+    def __init__(self, current_peer_id, max_connections):
+        self.current_peer_id = current_peer_id
+        self.max_connections = max_connections
+        self.lock = threading.Lock()
+        self._peers = {}
+        # Peers snubbed since startup, for monitoring
+        self.snubbed_count = 0
+        self._wakeups = []
+
+    def add_wakeup(self, wakeup):
+        with self.lock:
+            self._wakeups.append(wakeup)
+
+    def remove_wakeup(self, wakeup):
+        with self.lock:
+            self._wakeups.remove(wakeup)
+
+    def update_peers(self, torrent_id, peer_list):
+        # Adds new peers from a tracker response and forgets idle ones it no longer lists
+        with self.lock:
+            listed = set()
+            for address, peer_id in peer_list:
+                if peer_id == self.current_peer_id:
+                    continue
+                key = (torrent_id, peer_id)
+                listed.add(key)
+                if (peer := self._peers.get(key)) is None:
+                    self._peers[key] = PeerConnection(torrent_id, peer_id, address)
+                elif not _is_active(peer):
+                    peer.address = address
+
+            for key in [
+                key
+                for key, peer in self._peers.items()
+                if peer.torrent_id == torrent_id and key not in listed and not _is_active(peer)
+            ]:
+                del self._peers[key]
+            self._wake()
+
+    def remove_torrent(self, torrent_id):
+        with self.lock:
+            for key in [key for key in self._peers if key[0] == torrent_id]:
+                del self._peers[key]
+            self._wake()
+
+    def peers_to_dial(self, torrent_id):
+        # Claims every peer of the torrent that is due for a connection while there are free slots
+        now = time.monotonic()
+        with self.lock:
+            free_slots = self.max_connections - self._active_count()
+            dial = []
+            for peer in self._peers.values():
+                if free_slots <= 0:
+                    break
+                if (
+                    peer.torrent_id == torrent_id
+                    and peer.state in (ConnectionState.IDLE, ConnectionState.BACKOFF)
+                    and peer.next_attempt <= now
+                ):
+                    peer.state = ConnectionState.CONNECTING
+                    dial.append((peer.address, peer.peer_id))
+                    free_slots -= 1
+            return dial
+
+    def next_dial_delay(self, torrent_id):
+        # Seconds until a waiting peer of the torrent is due, None while there is nothing to wait for
+        now = time.monotonic()
+        with self.lock:
+            if self._active_count() >= self.max_connections:
+                return None
+            return min(
+                (
+                    max(peer.next_attempt - now, 0)
+                    for peer in self._peers.values()
+                    if peer.torrent_id == torrent_id
+                    and peer.state in (ConnectionState.IDLE, ConnectionState.BACKOFF)
+                ),
+                default=None,
+            )
+
+    def connection_opened(self, torrent_id, peer_id, peer_stats=None):
+        # Keeps the connection's PeerStats so its rates show up in connections()
+        with self.lock:
+            if (peer := self._peers.get((torrent_id, peer_id))) is not None:
+                peer.state = ConnectionState.CONNECTED
+                peer.failures = 0
+                peer.connected_since = time.monotonic()
+                peer.peer_stats = peer_stats
+
+    def connection_failed(self, torrent_id, peer_id):
+        # Doubles the wait on every failure in a row up to MAX_BACKOFF
+        with self.lock:
+            if (peer := self._peers.get((torrent_id, peer_id))) is not None:
+                peer.failures += 1
+                peer.state = ConnectionState.BACKOFF
+                peer.next_attempt = time.monotonic() + min(
+                    BASE_BACKOFF * 2 ** (peer.failures - 1), MAX_BACKOFF
+                )
+                peer.connected_since = None
+                peer.peer_stats = None
+            self._wake()
+
+    def connection_snubbed(self, torrent_id, peer_id):
+        # Leaves a peer that was too slow alone for longer every time it happens
+        with self.lock:
+            if (peer := self._peers.get((torrent_id, peer_id))) is not None:
+                peer.snubs += 1
+                self.snubbed_count += 1
+                peer.state = ConnectionState.BACKOFF
+                peer.next_attempt = time.monotonic() + min(
+                    RECONNECT_DELAY * 2 ** (peer.snubs - 1), MAX_BACKOFF
+                )
+                peer.connected_since = None
+                peer.peer_stats = None
+            self._wake()
+
+    def connection_closed(self, torrent_id, peer_id):
+        # Lets an established connection be redialed once it has had a moment to settle
+        with self.lock:
+            if (peer := self._peers.get((torrent_id, peer_id))) is not None:
+                peer.state = ConnectionState.IDLE
+                peer.next_attempt = time.monotonic() + RECONNECT_DELAY
+                peer.connected_since = None
+                peer.peer_stats = None
+            self._wake()
+
+    def usable_count(self, torrent_id):
+        # Counts peers of the torrent that are connected or can be dialed right away
+        now = time.monotonic()
+        with self.lock:
+            return sum(
+                peer.torrent_id == torrent_id
+                and (peer.state != ConnectionState.BACKOFF or peer.next_attempt <= now)
+                for peer in self._peers.values()
+            )
+
+    def active_count(self):
+        with self.lock:
+            return self._active_count()
+
+    def connections(self):
+        # Snapshot of the connection table for logging and monitoring
+        now = time.monotonic()
+        with self.lock:
+            return [
+                {
+                    "torrent_id": peer.torrent_id,
+                    "peer_id": peer.peer_id,
+                    "address": peer.address,
+                    "state": peer.state.value,
+                    "failures": peer.failures,
+                    "snubs": peer.snubs,
+                    "retry_in": max(peer.next_attempt - now, 0),
+                    "connected_for": (
+                        now - peer.connected_since if peer.connected_since is not None else 0
+                    ),
+                    "download_rate": (
+                        peer.peer_stats.byte_rate.rate() if peer.peer_stats is not None else 0.0
+                    ),
+                    "downloaded_bytes": (
+                        peer.peer_stats.byte_rate.total if peer.peer_stats is not None else 0
+                    ),
+                    "pieces_per_second": (
+                        peer.peer_stats.piece_rate.rate() if peer.peer_stats is not None else 0.0
+                    ),
+                }
+                for peer in self._peers.values()
+            ]
+
+    def _active_count(self):
+        return sum(_is_active(peer) for peer in self._peers.values())
+
+    def _wake(self):
+        for wakeup in self._wakeups:
+            wakeup.set()
+
+
+# *PRIVATE HELPER FUNCTIONS*
+
+
+def _is_active(peer):
+    return peer.state in (ConnectionState.CONNECTING, ConnectionState.CONNECTED)
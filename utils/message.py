@@ -1,4 +1,26 @@
 from enum import Enum
+import asyncio
+
+# Version, type and a 2 byte length
+HEADER_SIZE = 4
+# Version 2 widens the length to 4 bytes so pieces can be bigger than 64 KiB
+V2_HEADER_SIZE = 6
+V1_MAX_LENGTH = 0xFFFF
+SUPPORTED_VERSIONS = (1, 2)
+LATEST_VERSION = 2
+# Length of the piece index carried by a have message
+HAVE_INDEX_SIZE = 4
+# Longest payload read before a connection's hello is accepted, torrent ids and errors fit easily
+HELLO_MAX_LENGTH = 1024
+
+
+def header_size(version):
+    return HEADER_SIZE if version == 1 else V2_HEADER_SIZE
+
+
+# Longest payload a connection to a torrent needs, a whole piece or the bitfield in a hello response
+def max_payload_length(piece_size, number_of_pieces):
+    return max(piece_size, (number_of_pieces + 7) // 8, HELLO_MAX_LENGTH)
 
 
 class MessageType(Enum):
@@ -7,6 +29,11 @@ class MessageType(Enum):
     PIECE_REQUEST = 3
     PIECE_RESPONSE = 4
     ERROR = 5
+    # Version 2 only, announces a newly completed piece on a live connection
+    HAVE = 6
+    # Version 2 only, tells the downloader to stop or resume sending piece requests
+    CHOKE = 7
+    UNCHOKE = 8
 
 
 class Message:
@@ -16,30 +43,133 @@ class Message:
         self.data = data
 
     @classmethod
-    def from_socket(cls, socket):
-        header = socket.recv(4)
-
-        if not header:
+    def from_socket(cls, socket, max_length=HELLO_MAX_LENGTH):
+        # Reads the header and payload into freshly allocated buffers, None when the payload is longer than max_length
+        header = bytearray(V2_HEADER_SIZE)
+        if not recv_exactly(socket, memoryview(header)[:HEADER_SIZE]):
+            return None
+        if header[0] != 1 and not recv_exactly(socket, memoryview(header)[HEADER_SIZE:]):
+            return None
+        if (type_ := _message_type(header)) is None or _payload_length(header) > max_length:
             return None
 
-        version = header[0]
-        type_ = header[1]
-        length = int.from_bytes(header[2:], "big")
-        total_data = b""
+        total_data = bytearray(_payload_length(header))
+        if not recv_exactly(socket, memoryview(total_data)):
+            return None
 
-        while len(total_data) != length:
-            data = socket.recv(length - len(total_data))
+        return cls(type_, version=header[0], data=total_data)
 
-            if not data:
+    @classmethod
+    async def from_stream(cls, reader: asyncio.StreamReader, max_length=HELLO_MAX_LENGTH):
+        try:
+            header = await reader.readexactly(HEADER_SIZE)
+            if header[0] != 1:
+                header += await reader.readexactly(V2_HEADER_SIZE - HEADER_SIZE)
+            if (type_ := _message_type(header)) is None or _payload_length(header) > max_length:
                 return None
+            total_data = await reader.readexactly(_payload_length(header))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
 
-            total_data += data
+        return cls(type_, version=header[0], data=total_data)
 
-        return cls(MessageType(type_), data=total_data)
+    def to_header(self, length):
+        return (
+            self.version.to_bytes(1, "big")
+            + self.type.value.to_bytes(1, "big")
+            + length.to_bytes(header_size(self.version) - 2, "big")
+        )
 
     def to_bytes(self):
         data = self.data or b""
-        return self.version.to_bytes(1, "big") + self.type.value.to_bytes(1, "big") + len(data).to_bytes(2, "big") + data
+        return self.to_header(len(data)) + data
+
+    def send(self, socket):
+        # Sends the header and payload together without joining them first
+        data = self.data or b""
+        send_parts(socket, self.to_header(len(data)), data)
 
     def __str__(self) -> str:
         return f"<Message(msg_type={self.type}, length={len(self.data)}, data={self.data})>"
+
+
+# Reads messages from a socket into one buffer that is reused for every message
+#
+# The data of a returned message is a memoryview into that buffer, so it is
+# only valid until the next call to read and has to be copied to be kept.
+# A message longer than max_length or of an unknown type is read as a closed
+# connection, so a peer can't make the buffer grow past what the connection
+# needs. Raise max_length once the hello is accepted.
+class MessageReader:
+    def __init__(self, socket, buffer_size=HEADER_SIZE, max_length=HELLO_MAX_LENGTH):
+        self.socket = socket
+        self.max_length = max_length
+        self._header = bytearray(V2_HEADER_SIZE)
+        self._header_view = memoryview(self._header)
+        self._buffer = bytearray(buffer_size)
+        self._buffer_view = memoryview(self._buffer)
+
+    def read(self):
+        # Reads the rest of the header when the version has a wider length
+        if not recv_exactly(self.socket, self._header_view[:HEADER_SIZE]):
+            return None
+        if self._header[0] != 1 and not recv_exactly(
+            self.socket, self._header_view[HEADER_SIZE:]
+        ):
+            return None
+
+        # Grows the buffer when a bigger message than any before shows up
+        length = _payload_length(self._header)
+        if (type_ := _message_type(self._header)) is None or length > self.max_length:
+            return None
+        if length > len(self._buffer):
+            self._buffer = bytearray(max(length, 2 * len(self._buffer)))
+            self._buffer_view = memoryview(self._buffer)
+
+        payload = self._buffer_view[:length]
+        if not recv_exactly(self.socket, payload):
+            return None
+
+        return Message(type_, version=self._header[0], data=payload)
+
+
+def _message_type(header):
+    # Returns None for a type this version doesn't know, which ends the connection like any parse error
+    try:
+        return MessageType(header[1])
+    except ValueError:
+        return None
+
+
+def _payload_length(header):
+    return int.from_bytes(header[2 : header_size(header[0])], "big")
+
+
+# Fills the whole view from the socket, returns False if the peer closed the connection
+def recv_exactly(socket, view):
+    received = 0
+    while received < len(view):
+        count = socket.recv_into(view[received:])
+        if count == 0:
+            return False
+        received += count
+    return True
+
+
+# Sends several buffers with one scatter-gather call where the platform supports it
+def send_parts(socket, *parts):
+    if not hasattr(socket, "sendmsg"):
+        for part in parts:
+            socket.sendall(part)
+        return
+
+    views = [memoryview(part) for part in parts if len(part) > 0]
+    while views:
+        sent = socket.sendmsg(views)
+
+        # Drops whatever was fully sent and retries the rest
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent > 0:
+            views[0] = views[0][sent:]
@@ -0,0 +1,84 @@
+import bisect
+import threading
+import time
+
+from utils.rate_estimator import RateEstimator
+
+# Upper bounds in seconds of the piece request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class UploadCounter:
+    def __init__(self, address):
+        self.address = address
+        self.bytes = 0
+        self.pieces = 0
+
+
+# Transfer counters updated on the download and upload hot paths
+#
+# Every update is a few additions under one lock, so the counters are kept
+# whether or not the metrics endpoint is enabled. Per connection download
+# counters live in each connection's PeerStats, upload ones are kept here by
+# connection.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.bytes_downloaded = 0
+        self.pieces_downloaded = 0
+        self.bytes_uploaded = 0
+        self.pieces_uploaded = 0
+        self.download_rate = RateEstimator()
+        self.upload_rate = RateEstimator()
+        # Pieces answered within each latency bucket, the last one counts everything slower
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self._uploads = {}
+
+    def record_download(self, length, latency):
+        with self.lock:
+            self.bytes_downloaded += length
+            self.pieces_downloaded += 1
+            self.latency_counts[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            self.latency_sum += latency
+        self.download_rate.add(length)
+
+    def upload_opened(self, key, address):
+        with self.lock:
+            self._uploads[key] = UploadCounter(address)
+
+    def record_upload(self, key, length):
+        with self.lock:
+            self.bytes_uploaded += length
+            self.pieces_uploaded += 1
+            if (upload := self._uploads.get(key)) is not None:
+                upload.bytes += length
+                upload.pieces += 1
+        self.upload_rate.add(length)
+
+    def upload_closed(self, key):
+        with self.lock:
+            self._uploads.pop(key, None)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime": time.monotonic() - self.started,
+                "downloaded_bytes": self.bytes_downloaded,
+                "downloaded_pieces": self.pieces_downloaded,
+                "uploaded_bytes": self.bytes_uploaded,
+                "uploaded_pieces": self.pieces_uploaded,
+                "download_rate": self.download_rate.rate(),
+                "upload_rate": self.upload_rate.rate(),
+                "request_latency": {
+                    "buckets": list(zip(LATENCY_BUCKETS, self.latency_counts)),
+                    "slower": self.latency_counts[-1],
+                    "sum": self.latency_sum,
+                    "count": sum(self.latency_counts),
+                },
+                "upload_connections": [
+                    {"address": upload.address, "uploaded_bytes": upload.bytes, "uploaded_pieces": upload.pieces}
+                    for upload in self._uploads.values()
+                ],
+            }
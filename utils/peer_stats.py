@@ -0,0 +1,98 @@
+import math
+import time
+from collections import deque
+
+from utils.rate_estimator import RateEstimator
+
+# Seconds to wait on a piece request before the peer's rate is known
+REQUEST_TIMEOUT = 10
+# Bounds on the request timeout once it is scaled to the peer's measured rate
+MIN_REQUEST_TIMEOUT = 5
+MAX_REQUEST_TIMEOUT = 60
+# How many times longer than its measured rate suggests the next piece may take
+REQUEST_TIMEOUT_FACTOR = 4
+# Bytes per second a peer with requests outstanding has to keep up to not be snubbed
+SNUB_RATE = 1024
+# Seconds a peer may stay below SNUB_RATE before it is snubbed
+SNUB_PERIOD = 30
+# Seconds of transfer at the measured rate to keep requested ahead
+PIPELINE_SECONDS = 2
+# Requests kept in flight until the first piece arrives
+INITIAL_PIPELINE_DEPTH = 2
+# Seconds of history the rates of a connection reflect
+RATE_WINDOW = 5
+
+
+# Measures how fast one download connection delivers and decides when the peer is snubbed
+#
+# A request times out once the next piece takes several times longer than the
+# peer's measured rate suggests, and a peer whose rate stays under SNUB_RATE
+# for SNUB_PERIOD while it has requests outstanding is snubbed as well. The
+# pipeline depth follows the rate, so fast peers keep more pieces in flight
+# and slow ones don't sit on pieces that other peers could deliver.
+class PeerStats:
+    def __init__(self, piece_size, max_pipeline_depth):
+        self.piece_size = piece_size
+        self.max_pipeline_depth = max_pipeline_depth
+        self.byte_rate = RateEstimator(window=RATE_WINDOW)
+        self.piece_rate = RateEstimator(window=RATE_WINDOW)
+        self.is_snubbed = False
+        # When each outstanding request was sent, in the order the pieces come back
+        self._sent_times = deque()
+        self._waiting_since = None
+        self._slow_since = None
+
+    def request_sent(self):
+        # Starts the timer when a request goes out on an empty pipeline
+        now = time.monotonic()
+        if not self._sent_times:
+            self._waiting_since = now
+        self._sent_times.append(now)
+
+    def piece_received(self, length):
+        # Restarts the timer for the next outstanding request and returns how long this one took
+        now = time.monotonic()
+        self.byte_rate.add(length)
+        self.piece_rate.add(1)
+        latency = now - self._sent_times.popleft() if self._sent_times else 0.0
+        self._waiting_since = now if self._sent_times else None
+        return latency
+
+    def request_timeout(self):
+        if self.piece_rate.total == 0:
+            return REQUEST_TIMEOUT
+        expected = self.piece_size / max(self.byte_rate.rate(), 1)
+        return min(max(REQUEST_TIMEOUT_FACTOR * expected, MIN_REQUEST_TIMEOUT), MAX_REQUEST_TIMEOUT)
+
+    def time_left(self):
+        # Seconds until the oldest outstanding request times out or a slow peer is due to be snubbed,
+        # None with nothing outstanding
+        if self._waiting_since is None:
+            return None
+        deadline = self._waiting_since + self.request_timeout()
+        if self._slow_since is not None:
+            deadline = min(deadline, self._slow_since + SNUB_PERIOD)
+        return deadline - time.monotonic()
+
+    def check_snubbed(self):
+        if self._waiting_since is None:
+            self._slow_since = None
+            return self.is_snubbed
+
+        now = time.monotonic()
+        if now - self._waiting_since >= self.request_timeout():
+            self.is_snubbed = True
+        elif self.byte_rate.rate() >= SNUB_RATE:
+            self._slow_since = None
+        elif self._slow_since is None:
+            self._slow_since = now
+        elif now - self._slow_since >= SNUB_PERIOD:
+            self.is_snubbed = True
+        return self.is_snubbed
+
+    def pipeline_depth(self):
+        # Covers PIPELINE_SECONDS of transfer at the measured rate, between 1 and the configured depth
+        if self.piece_rate.total == 0:
+            return min(INITIAL_PIPELINE_DEPTH, self.max_pipeline_depth)
+        depth = math.ceil(self.byte_rate.rate() * PIPELINE_SECONDS / self.piece_size)
+        return min(max(depth, 1), self.max_pipeline_depth)
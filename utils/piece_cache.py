@@ -0,0 +1,53 @@
+import threading
+from collections import OrderedDict
+
+
+# Keeps recently used pieces in memory up to a byte budget, evicting the least recently used
+class PieceCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pieces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._pieces.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._pieces.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        # Skips pieces that could never fit
+        if len(data) > self.max_bytes:
+            return
+
+        with self._lock:
+            old_data = self._pieces.pop(key, None)
+            if old_data is not None:
+                self.current_bytes -= len(old_data)
+            self._pieces[key] = data
+            self.current_bytes += len(data)
+
+            # Evicts the oldest pieces until the cache is back under budget
+            while self.current_bytes > self.max_bytes:
+                _, evicted_data = self._pieces.popitem(last=False)
+                self.current_bytes -= len(evicted_data)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "pieces": len(self._pieces),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,185 @@
+import random
+
+
+# Checks if a piece is marked in a bitfield from a hello response
+def has_piece(bitfield, index):
+    byte_index = index >> 3
+    return byte_index < len(bitfield) and (bitfield[byte_index] >> (7 - (index & 7))) & 1 == 1
+
+
+# Yields the index of every piece marked in a bitfield
+def iter_pieces(bitfield, number_of_pieces):
+    for byte_index, byte in enumerate(bitfield):
+        if byte == 0:
+            continue
+        for bit in range(8):
+            if byte & (0x80 >> bit):
+                index = (byte_index << 3) + bit
+                if index >= number_of_pieces:
+                    return
+                yield index
+
+
+# Most pieces covered by one block of the picker's bitmasks, smaller torrents use a single block
+BLOCK_BITS = 32768
+
+
+# Hands out the rarest missing piece a peer has
+#
+# Every piece sits in one level by how many connected peers have it, and the
+# wanted pieces are marked in a separate mask, so the rarest pieces are found
+# first and wanting or dropping a piece is a single bit flip. Levels and the
+# wanted mask are split into blocks of BLOCK_BITS pieces laid out like a
+# bitfield: finding the pieces a peer has is one AND per block instead of a
+# scan, which matters once a peer only has a few of the pieces we still want,
+# and a peer joining or leaving moves whole blocks between levels. A priority
+# window, used when streaming, is served in order before anything else.
+#
+# Wanting, dropping and counting a single piece are O(1). pick is not: the
+# rarest piece also has to be one the peer has, which no per-level structure
+# can answer without looking at the peer's bitfield, so it ANDs up to
+# levels x blocks masks, O(levels * pieces / BLOCK_BITS) big-int operations.
+# It stops at the first block matching in the lowest occupied level, so a
+# well-seeded torrent usually checks one block, and a torrent of up to
+# BLOCK_BITS pieces is always a single block. Bucket lists of pieces would
+# make the common case O(1) but have to scan a bucket piece by piece for a
+# peer that only has a few of the pieces in it.
+class PiecePicker:
+    def __init__(self, number_of_pieces):
+        self.number_of_pieces = number_of_pieces
+        self.wanted_count = 0
+        self._block_bytes = min(BLOCK_BITS, max(number_of_pieces, 1) + 7) >> 3
+        self._block_bits = self._block_bytes << 3
+        self._block_count = (number_of_pieces + self._block_bits - 1) // self._block_bits
+        # Starts with every piece in level 0, no peer has any of them yet
+        self._levels = [[self._block_mask(block) for block in range(self._block_count)]]
+        self._level_sizes = [number_of_pieces]
+        self._wanted = [0] * self._block_count
+        # (block, mask) of the priority window in piece order
+        self._priority = []
+
+    def want_missing(self, bitfield):
+        # Wants every piece that isn't marked in bitfield, built a block at a time
+        for block in range(self._block_count):
+            self._wanted[block] = self._block_mask(block) & ~self._peer_block(bitfield, block)
+        self.wanted_count = sum(mask.bit_count() for mask in self._wanted)
+
+    def add_wanted(self, index):
+        block, bit = self._position(index)
+        if not self._wanted[block] & bit:
+            self._wanted[block] |= bit
+            self.wanted_count += 1
+
+    def remove_wanted(self, index):
+        block, bit = self._position(index)
+        if self._wanted[block] & bit:
+            self._wanted[block] ^= bit
+            self.wanted_count -= 1
+
+    def add_peer(self, bitfield):
+        # Moves the peer's pieces up one level, starting at the top so no piece moves twice
+        for block in range(self._block_count):
+            if not (remaining := self._peer_block(bitfield, block)):
+                continue
+            for level in reversed(range(len(self._levels))):
+                if moving := self._levels[level][block] & remaining:
+                    self._move(block, moving, level, level + 1)
+                    if not (remaining := remaining ^ moving):
+                        break
+
+    def add_peer_piece(self, index):
+        # Counts a piece a connected peer announced after the hello exchange
+        block, bit = self._position(index)
+        for level in range(len(self._levels)):
+            if self._levels[level][block] & bit:
+                self._move(block, bit, level, level + 1)
+                return
+
+    def remove_peer(self, bitfield):
+        # Moves the peer's pieces down one level, starting at the bottom so no piece moves twice
+        for block in range(self._block_count):
+            if not (remaining := self._peer_block(bitfield, block)):
+                continue
+            for level in range(1, len(self._levels)):
+                if moving := self._levels[level][block] & remaining:
+                    self._move(block, moving, level, level - 1)
+                    if not (remaining := remaining ^ moving):
+                        break
+
+    def set_priority(self, start, length):
+        # Hands out the pieces from start to start + length first and lowest index first
+        end = min(start + length, self.number_of_pieces)
+        self._priority = []
+        for block in range(start // self._block_bits, (end + self._block_bits - 1) // self._block_bits):
+            first = max(start - block * self._block_bits, 0)
+            last = min(end - block * self._block_bits, self._block_bits)
+            self._priority.append((block, ((1 << (last - first)) - 1) << (self._block_bits - last)))
+
+    def pick(self, bitfield):
+        # Takes the first wanted piece in the priority window the peer has
+        for block, mask in self._priority:
+            if matches := mask & self._wanted[block] & self._peer_block(bitfield, block):
+                return self._take(block, self._block_bits - matches.bit_length())
+
+        # Nothing is rarer than the lowest level that has pieces, finding one there ends the search
+        lowest_level = next(
+            (level for level in range(1, len(self._levels)) if self._level_sizes[level]), None
+        )
+        if lowest_level is None:
+            return None
+
+        # Finds the rarest level holding a wanted piece the peer has, starting at a random block to break ties
+        best = None
+        first_block = random.randrange(self._block_count)
+        for offset in range(self._block_count):
+            block = (first_block + offset) % self._block_count
+            if not (candidates := self._wanted[block] & self._peer_block(bitfield, block)):
+                continue
+            for level in range(lowest_level, best[0] if best is not None else len(self._levels)):
+                if matches := self._levels[level][block] & candidates:
+                    best = (level, block, matches)
+                    break
+            if best is not None and best[0] == lowest_level:
+                break
+        if best is None:
+            return None
+        _, block, matches = best
+        return self._take(block, self._random_offset(matches))
+
+    def _block_mask(self, block):
+        # Marks every piece of the block, the last block may be short
+        size = min(self._block_bits, self.number_of_pieces - block * self._block_bits)
+        return ((1 << size) - 1) << (self._block_bits - size)
+
+    def _position(self, index):
+        block, offset = divmod(index, self._block_bits)
+        return block, 1 << (self._block_bits - 1 - offset)
+
+    def _peer_block(self, bitfield, block):
+        # Reads one block of a bitfield, a short bitfield counts as missing the rest
+        chunk = bitfield[block * self._block_bytes : (block + 1) * self._block_bytes]
+        return int.from_bytes(chunk, "big") << ((self._block_bytes - len(chunk)) << 3)
+
+    def _move(self, block, mask, from_level, to_level):
+        if to_level == len(self._levels):
+            self._levels.append([0] * self._block_count)
+            self._level_sizes.append(0)
+        self._levels[from_level][block] ^= mask
+        self._levels[to_level][block] |= mask
+        count = mask.bit_count()
+        self._level_sizes[from_level] -= count
+        self._level_sizes[to_level] += count
+
+    def _take(self, block, offset):
+        index = block * self._block_bits + offset
+        self.remove_wanted(index)
+        return index
+
+    def _random_offset(self, mask):
+        # Takes the nearest set bit at or above a random position, wrapping around to the lowest one
+        shift = random.randrange(self._block_bits)
+        if shifted := mask >> shift:
+            position = (shifted & -shifted).bit_length() - 1 + shift
+        else:
+            position = (mask & -mask).bit_length() - 1
+        return self._block_bits - 1 - position
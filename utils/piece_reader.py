@@ -0,0 +1,91 @@
+import threading
+import heapq
+import itertools
+
+
+# A read waiting in the queue, the worker fills in data or error and sets done
+class _Read:
+    def __init__(self, storage, index):
+        self.storage = storage
+        self.index = index
+        self.done = threading.Event()
+        self.data = None
+        self.error = None
+
+
+# Reads pieces for upload connections on a pool of worker threads, in order of their offset
+#
+# Connections queue a read with read() and wait for it. Workers serve the
+# queue like an elevator: they go through the waiting reads by increasing
+# offset and start over from the lowest once the highest has been read, so
+# the disk sweeps across the file instead of seeking between the pieces every
+# peer asked for. Reads that arrive behind the sweep wait for the next one, so
+# none of them starves.
+class PieceReader:
+    def __init__(self, workers=2):
+        # Reads ahead of the last served offset and the ones left for the next sweep, both heaps by offset
+        self._ahead = []
+        self._behind = []
+        self._position = None
+        # Keeps reads of the same piece in arrival order
+        self._order = itertools.count()
+        self._is_closed = False
+        self._has_reads = threading.Condition()
+        self._workers = []
+        for number in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.setName(f"Piece Reader {number + 1}")
+            worker.start()
+            self._workers.append(worker)
+
+    def read(self, storage, index):
+        # Offsets only compare within one storage, torrents are swept one after the other
+        key = (id(storage), index)
+        request = _Read(storage, index)
+        with self._has_reads:
+            if self._is_closed:
+                return storage.read_piece(index)
+            if self._position is None or key >= self._position:
+                heapq.heappush(self._ahead, (key, next(self._order), request))
+            else:
+                heapq.heappush(self._behind, (key, next(self._order), request))
+            self._has_reads.notify()
+
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.data
+
+    def queued(self):
+        with self._has_reads:
+            return len(self._ahead) + len(self._behind)
+
+    def close(self):
+        # Serves every queued read before the workers exit
+        with self._has_reads:
+            self._is_closed = True
+            self._has_reads.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def _work(self):
+        while (request := self._next()) is not None:
+            try:
+                request.data = request.storage.read_piece(request.index)
+            except OSError as error:
+                request.error = error
+            request.done.set()
+
+    def _next(self):
+        with self._has_reads:
+            while not self._ahead and not self._behind:
+                if self._is_closed:
+                    return None
+                self._has_reads.wait()
+
+            # Starts the next sweep from the lowest offset once nothing is left ahead
+            if not self._ahead:
+                self._ahead, self._behind = self._behind, self._ahead
+            key, _, request = heapq.heappop(self._ahead)
+            self._position = key
+            return request
@@ -0,0 +1,185 @@
+import threading
+import queue
+import logging
+import hashlib
+import weakref
+
+# When written pieces are flushed to the disk: never, once the torrent is complete, or every fsync_interval bytes
+FSYNC_POLICIES = ("none", "complete", "interval")
+# Most queued pieces a worker takes at once to write adjacent ones together
+MAX_BATCH = 32
+
+
+def _adjacent_runs(pieces):
+    # Splits {index: data} into (first index, [data, ...]) runs of consecutive indexes
+    runs = []
+    for index in sorted(pieces):
+        if runs and runs[-1][0] + len(runs[-1][1]) == index:
+            runs[-1][1].append(pieces[index])
+        else:
+            runs.append((index, [pieces[index]]))
+    return runs
+
+
+# Verifies and stores downloaded pieces on a pool of worker threads
+#
+# Network readers hand each received piece to submit() and go straight back to
+# the socket. Workers hash the piece, write it to storage and mark it as
+# available in its ChunkManager. The queue is bounded, so when the disk falls
+# behind the network, submit() blocks the readers instead of buffering pieces
+# without limit.
+#
+# A worker takes every piece already waiting, up to MAX_BATCH, and writes runs
+# of adjacent pieces of a torrent with one sequential write. The backlog that
+# builds up while the disk is slow turns into fewer, larger writes instead of
+# many small ones competing for the disk head.
+class PieceWriter:
+    def __init__(self, workers=4, max_queued=64, fsync="complete", fsync_interval=64 * 1024 * 1024):
+        self.pieces_written = 0
+        self.hash_failures = 0
+        # Storage writes issued, fewer than the pieces written when adjacent pieces were joined
+        self.writes = 0
+        self.syncs = 0
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        # Bytes written to each torrent since its last sync, for the interval policy
+        self._unsynced_bytes = weakref.WeakKeyDictionary()
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        # Pieces of each torrent queued or being written, drain() waits for them to reach zero
+        self._pending = {}
+        self._drained = threading.Condition(self._lock)
+        self._workers = []
+        for number in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.setName(f"Piece Writer {number + 1}")
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, chunk_manager, index, data, expected_hash, on_invalid=None, block=True):
+        # Copies the payload since readers reuse their receive buffer for the next message
+        with self._lock:
+            self._pending[chunk_manager] = self._pending.get(chunk_manager, 0) + 1
+        try:
+            self._queue.put(
+                (chunk_manager, index, bytes(data), expected_hash, on_invalid), block
+            )
+        except queue.Full:
+            self._finish(chunk_manager)
+            return False
+        return True
+
+    def queued(self):
+        return self._queue.qsize()
+
+    def drain(self, chunk_manager):
+        # Waits until every piece submitted for the torrent has been written or dropped, so its storage can be closed
+        with self._drained:
+            self._drained.wait_for(lambda: chunk_manager not in self._pending)
+
+    def assemble(self, chunk_manager):
+        # Creates the final file of a finished torrent and flushes it unless the policy is none
+        chunk_manager.assemble_file()
+        if self.fsync != "none":
+            self._sync(chunk_manager)
+
+    def close(self):
+        # Finishes every queued piece before the workers exit
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _work(self):
+        while (item := self._queue.get()) is not None:
+            # Takes the pieces already waiting so adjacent ones can be written together
+            batch = [item]
+            while len(batch) < MAX_BATCH:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    break
+                batch.append(item)
+            try:
+                self._commit(batch)
+            finally:
+                for chunk_manager, *_ in batch:
+                    self._finish(chunk_manager)
+            if item is None:
+                return
+
+    def _finish(self, chunk_manager):
+        with self._drained:
+            self._pending[chunk_manager] -= 1
+            if not self._pending[chunk_manager]:
+                del self._pending[chunk_manager]
+                self._drained.notify_all()
+
+    def _commit(self, batch):
+        # Verifies every piece, then writes the good ones in runs of adjacent pieces per torrent
+        verified = {}
+        for chunk_manager, index, data, expected_hash, on_invalid in batch:
+            if not self._verify(chunk_manager, index, data, expected_hash, on_invalid):
+                continue
+            pieces = verified.setdefault(chunk_manager, {})
+            # Two endgame copies of a piece in one batch only need one write
+            if index in pieces:
+                chunk_manager.release_chunk(index)
+                continue
+            pieces[index] = data
+        for chunk_manager, pieces in verified.items():
+            for start, run in _adjacent_runs(pieces):
+                self._write_run(chunk_manager, start, run)
+
+    def _verify(self, chunk_manager, index, data, expected_hash, on_invalid):
+        # Drops the piece if another peer already delivered it during endgame
+        if chunk_manager.is_chunk_available(index):
+            chunk_manager.release_chunk(index)
+            return False
+
+        # Gives the chunk back and tells the connection when the hash is wrong
+        if hashlib.sha1(data).digest() != expected_hash:
+            logging.info(f" PIECE_WRITER: Hash is incorrect for chunk {index + 1}")
+            with self._lock:
+                self.hash_failures += 1
+            chunk_manager.release_chunk(index)
+            if on_invalid is not None:
+                on_invalid()
+            return False
+        return True
+
+    def _write_run(self, chunk_manager, start, run):
+        # Saves the run to storage and marks its pieces as available
+        indexes = range(start, start + len(run))
+        try:
+            chunk_manager.write_chunks(start, run)
+        except OSError:
+            logging.info(f" PIECE_WRITER: Failed to write chunks {start + 1} to {start + len(run)}")
+            for index in indexes:
+                chunk_manager.release_chunk(index)
+            return
+        for index in indexes:
+            chunk_manager.complete_chunk(index)
+
+        # Flushes the torrent once enough has been written since its last sync
+        should_sync = False
+        with self._lock:
+            self.pieces_written += len(run)
+            self.writes += 1
+            if self.fsync == "interval":
+                unsynced = self._unsynced_bytes.get(chunk_manager, 0) + sum(len(data) for data in run)
+                should_sync = unsynced >= self.fsync_interval
+                self._unsynced_bytes[chunk_manager] = 0 if should_sync else unsynced
+        if should_sync:
+            self._sync(chunk_manager)
+
+    def _sync(self, chunk_manager):
+        try:
+            chunk_manager.sync()
+        except OSError:
+            logging.info(f" PIECE_WRITER: Failed to sync {chunk_manager.file_name}")
+            return
+        with self._lock:
+            self.syncs += 1
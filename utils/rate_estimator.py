@@ -0,0 +1,43 @@
+import math
+import threading
+import time
+
+
+# Estimates a transfer rate per second as an exponentially weighted moving average
+#
+# Amounts (bytes, pieces) are folded in whenever the rate is updated, weighted
+# by how much time passed since the last update, so the estimate decays
+# towards zero once a transfer stalls. window is roughly how many seconds of
+# history it reflects. The average starts from zero, so it is scaled up by the
+# weight gathered so far to give a fair estimate in the first few seconds.
+class RateEstimator:
+    def __init__(self, window=10):
+        self.window = window
+        self.total = 0
+        self._rate = 0.0
+        self._pending = 0
+        self._started = self._last_update = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, amount):
+        with self._lock:
+            self.total += amount
+            self._pending += amount
+            self._update(time.monotonic())
+
+    def rate(self):
+        with self._lock:
+            self._update(time.monotonic())
+            age = self._last_update - self._started
+            if age <= 0:
+                return 0.0
+            return self._rate / (1 - math.exp(-age / self.window))
+
+    def _update(self, now):
+        elapsed = now - self._last_update
+        if elapsed <= 0:
+            return
+        weight = 1 - math.exp(-elapsed / self.window)
+        self._rate += weight * (self._pending / elapsed - self._rate)
+        self._pending = 0
+        self._last_update = now
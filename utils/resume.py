@@ -0,0 +1,123 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.piece_picker import iter_pieces
+
+
+# Remembers which pieces were verified so a clean restart doesn't have to hash them again
+#
+# The state file keeps the bitfield of verified pieces along with the size and
+# mtime of every file backing them. On startup a piece is trusted only if the
+# torrent matches and its file still looks exactly as it did when the state
+# was saved. Pieces missing from the bitfield of such an unchanged file were
+# not valid then and can't be now, so only the pieces of changed or unknown
+# files are hashed again, on a pool of worker threads. hashlib and pread release the GIL, so threads spread the
+# hashing across cores without copying pieces into other processes.
+class ResumeState:
+    def __init__(self, path, torrent_id, storage_type, number_of_pieces):
+        self.path = path
+        self.torrent_id = torrent_id
+        self.storage_type = storage_type
+        self.number_of_pieces = number_of_pieces
+
+    def load_pieces(self, storage, workers=None):
+        candidates = storage.candidate_pieces()
+        if not candidates:
+            return []
+
+        # Splits pieces into ones the state file vouches for, ones it rules out and ones that need hashing
+        trusted_pieces, unchanged_files = self._saved_state(storage)
+        trusted = [index for index in candidates if index in trusted_pieces]
+        stale = [
+            index
+            for index in candidates
+            if index not in trusted_pieces and storage.piece_file(index) not in unchanged_files
+        ]
+        logging.info(
+            f" RESUME: {len(trusted)} pieces trusted from {self.path}, verifying {len(stale)}"
+        )
+        if not stale:
+            return trusted
+
+        # Hashes stale pieces in parallel
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            results = executor.map(storage.verify_piece, stale, chunksize=64)
+            verified = [index for index, is_valid in zip(stale, results) if is_valid]
+        return trusted + verified
+
+    def save(self, storage, bitfield):
+        # Records the size and mtime of every file that holds a verified piece
+        files = {}
+        for index in iter_pieces(bitfield, self.number_of_pieces):
+            path = storage.piece_file(index)
+            if path not in files and (stat := _file_stat(path)) is not None:
+                files[path] = stat
+
+        self._write(bitfield, files)
+
+    def save_file(self, path, bitfield):
+        # Records pieces that all live in one file from its stat alone, the file is never opened
+        stat = _file_stat(path)
+        self._write(bitfield, {path: stat} if stat is not None else {})
+
+    def _write(self, bitfield, files):
+        state = {
+            "torrent_id": self.torrent_id,
+            "storage": self.storage_type,
+            "bitfield": bytes(bitfield).hex(),
+            "files": files,
+        }
+
+        # Writes to a temporary file first so a crash never leaves a half written state file
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, "w") as state_file:
+                json.dump(state, state_file)
+            os.replace(temp_path, self.path)
+        except OSError:
+            logging.info(f" RESUME: Failed to save {self.path}")
+
+    def is_for_torrent(self):
+        # Checks that a state file was saved for this torrent and storage layout
+        try:
+            with open(self.path, "r") as state_file:
+                state = json.load(state_file)
+            return state.get("torrent_id") == self.torrent_id and state.get("storage") == self.storage_type
+        except (OSError, ValueError, AttributeError):
+            return False
+
+    def _saved_state(self, storage):
+        # Returns the pieces the state file vouches for and the files unchanged since it was saved
+        try:
+            with open(self.path, "r") as state_file:
+                state = json.load(state_file)
+            bitfield = bytes.fromhex(state["bitfield"])
+            files = state["files"]
+            unchanged_files = {path for path, stat in files.items() if _file_stat(path) == stat}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return set(), set()
+
+        # Ignores state saved for another torrent or storage layout
+        if state.get("torrent_id") != self.torrent_id or state.get("storage") != self.storage_type:
+            return set(), set()
+
+        # Trusts a piece only if its file hasn't changed since the state was saved
+        trusted = {
+            index
+            for index in iter_pieces(bitfield, self.number_of_pieces)
+            if storage.piece_file(index) in unchanged_files
+        }
+        return trusted, unchanged_files
+
+
+# *PRIVATE HELPER FUNCTIONS*
+
+
+def _file_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
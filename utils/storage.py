@@ -0,0 +1,216 @@
+import os
+import errno
+import logging
+import hashlib
+import threading
+from contextlib import contextmanager
+
+# Length in bytes of a SHA-1 piece hash
+HASH_SIZE = 20
+# Most buffers one pwritev call takes, the kernel refuses more than IOV_MAX
+MAX_IOVECS = 1024
+
+
+def _piece_hash(piece_hashes, index):
+    return piece_hashes[index * HASH_SIZE : (index + 1) * HASH_SIZE]
+
+
+# Stores the torrent in one preallocated file and writes each piece at its offset
+#
+# An existing file of another size is only resized when is_owned says the
+# torrent's resume state was saved for it. Any other file of that name is
+# moved aside, so whatever else was in the download folder is never cut off
+# or overwritten.
+class SingleFileStorage:
+    def __init__(self, folder, file_name, file_size, piece_size, piece_hashes, is_owned=False):
+        self.path = f"{folder}/{file_name}"
+        self.file_size = file_size
+        self.piece_size = piece_size
+        self.piece_hashes = piece_hashes
+
+        os.makedirs(folder, exist_ok=True)
+        self.is_new_file = not os.path.exists(self.path)
+        if not self.is_new_file and not is_owned and os.path.getsize(self.path) != file_size:
+            moved_path = _free_path(f"{self.path}.old")
+            os.rename(self.path, moved_path)
+            logging.info(f" STORAGE: {self.path} isn't the torrent's size, moved it to {moved_path}")
+            self.is_new_file = True
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        # Preallocates the whole file once so pieces can be written in any order
+        if os.fstat(self.fd).st_size != file_size:
+            os.ftruncate(self.fd, file_size)
+        if self.is_new_file and file_size > 0 and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.fd, 0, file_size)
+            except OSError:
+                logging.debug("Filesystem doesn't support fallocate, file stays sparse")
+
+    def piece_offset(self, index):
+        return index * self.piece_size
+
+    def piece_length(self, index):
+        return min(self.piece_size, self.file_size - index * self.piece_size)
+
+    def piece_file(self, index):
+        return self.path
+
+    def _descriptor(self):
+        # Fails like any other I/O error once closed, open() would raise ValueError on the -1 left behind
+        if self.fd < 0:
+            raise OSError(errno.EBADF, f"Storage for {self.path} is closed")
+        return self.fd
+
+    def candidate_pieces(self):
+        # A freshly created file has nothing in it yet, any piece of an old file might be valid
+        if self.is_new_file:
+            return []
+        return list(range(len(self.piece_hashes) // HASH_SIZE))
+
+    def verify_piece(self, index):
+        return hashlib.sha1(self.read_piece(index)).digest() == _piece_hash(self.piece_hashes, index)
+
+    def write_piece(self, index, data):
+        os.pwrite(self._descriptor(), data, self.piece_offset(index))
+
+    def write_pieces(self, index, pieces):
+        # Writes consecutive pieces starting at index with one sequential write where pwritev exists
+        if not hasattr(os, "pwritev"):
+            for number, data in enumerate(pieces):
+                self.write_piece(index + number, data)
+            return
+        offset = self.piece_offset(index)
+        buffers = [memoryview(data) for data in pieces]
+        while buffers:
+            written = os.pwritev(self._descriptor(), buffers[:MAX_IOVECS], offset)
+            offset += written
+
+            # Picks up where a short write stopped
+            while buffers and written >= len(buffers[0]):
+                written -= len(buffers.pop(0))
+            if written:
+                buffers[0] = buffers[0][written:]
+
+    def read_piece(self, index):
+        return os.pread(self._descriptor(), self.piece_length(index), self.piece_offset(index))
+
+    @contextmanager
+    def open_piece(self, index):
+        # Wraps the shared descriptor without reopening the file, all I/O on it is positional
+        with open(self._descriptor(), "rb", buffering=0, closefd=False) as piece_file:
+            yield piece_file, self.piece_offset(index), self.piece_length(index)
+
+    def assemble(self):
+        # Pieces are already in place
+        pass
+
+    def sync(self):
+        os.fsync(self._descriptor())
+
+    def close(self):
+        # Leaves an invalid descriptor behind so late reads and writes fail instead of hitting a reused one
+        fd, self.fd = self.fd, -1
+        os.close(fd)
+
+
+# Legacy layout that keeps every piece in its own file under chunks/
+class ChunkDirectoryStorage:
+    def __init__(self, folder, file_name, file_size, piece_size, piece_hashes, is_owned=False):
+        # is_owned only matters to the single file layout, chunk files are named after their piece hash
+        self.folder = folder
+        self.file_name = file_name
+        self.file_size = file_size
+        self.piece_size = piece_size
+        self.piece_hashes = piece_hashes
+        # Files written since the last sync
+        self._unsynced_paths = set()
+        self._sync_lock = threading.Lock()
+
+        # Creates directory if it doesn't exist
+        os.makedirs(f"{folder}/chunks", exist_ok=True)
+
+    def piece_path(self, index):
+        return f"{self.folder}/chunks/{self.file_name}_{index}_{_piece_hash(self.piece_hashes, index).hex()}"
+
+    def piece_length(self, index):
+        return min(self.piece_size, self.file_size - index * self.piece_size)
+
+    def piece_file(self, index):
+        return self.piece_path(index)
+
+    def candidate_pieces(self):
+        # Loops through already existing chunks, their contents still need to be verified
+        existing = []
+        for cfile in os.listdir(f"{self.folder}/chunks"):
+            if len(parts := cfile.rsplit("_", 2)) != 3:
+                continue
+            name, index, _hash = parts
+            if (
+                name == self.file_name
+                and index.isdigit()
+                and int(index) < len(self.piece_hashes) // HASH_SIZE
+                and _piece_hash(self.piece_hashes, int(index)).hex() == _hash
+            ):
+                existing.append(int(index))
+        return existing
+
+    def verify_piece(self, index):
+        try:
+            data = self.read_piece(index)
+        except OSError:
+            return False
+        return hashlib.sha1(data).digest() == _piece_hash(self.piece_hashes, index)
+
+    def write_piece(self, index, data):
+        with open(self.piece_path(index), "wb") as chunk_file:
+            chunk_file.write(data)
+        with self._sync_lock:
+            self._unsynced_paths.add(self.piece_path(index))
+
+    def write_pieces(self, index, pieces):
+        # Every piece has its own file, so there is nothing to join
+        for number, data in enumerate(pieces):
+            self.write_piece(index + number, data)
+
+    def read_piece(self, index):
+        with open(self.piece_path(index), "rb") as chunk_file:
+            return chunk_file.read()
+
+    @contextmanager
+    def open_piece(self, index):
+        with open(self.piece_path(index), "rb", buffering=0) as chunk_file:
+            yield chunk_file, 0, self.piece_length(index)
+
+    def assemble(self):
+        # Joins every chunk file into the final file
+        with open(f"{self.folder}/{self.file_name}", "ab") as torrent_file:
+            for index in range(len(self.piece_hashes) // HASH_SIZE):
+                with open(self.piece_path(index), "rb") as chunk:
+                    torrent_file.write(chunk.read())
+        with self._sync_lock:
+            self._unsynced_paths.add(f"{self.folder}/{self.file_name}")
+
+    def sync(self):
+        with self._sync_lock:
+            paths, self._unsynced_paths = self._unsynced_paths, set()
+        for path in paths:
+            with open(path, "rb") as synced_file:
+                os.fsync(synced_file.fileno())
+
+    def close(self):
+        pass
+
+
+STORAGE_TYPES = {"file": SingleFileStorage, "chunks": ChunkDirectoryStorage}
+
+
+# *PRIVATE HELPER FUNCTIONS*
+
+
+def _free_path(path):
+    # Appends a number until the path isn't taken
+    free_path, number = path, 0
+    while os.path.lexists(free_path):
+        number += 1
+        free_path = f"{path}.{number}"
+    return free_path
@@ -0,0 +1,32 @@
+import threading
+
+
+# Looks up the chunk manager of every torrent being served by its torrent id
+#
+# The upload server routes each incoming connection with the torrent id sent
+# in its hello request, so one listening port can serve every torrent.
+class TorrentRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._chunk_managers = {}
+
+    def add(self, chunk_manager):
+        with self.lock:
+            self._chunk_managers[bytes.fromhex(chunk_manager.torrent_id)] = chunk_manager
+
+    def remove(self, torrent_id):
+        with self.lock:
+            return self._chunk_managers.pop(bytes.fromhex(torrent_id), None)
+
+    def get(self, torrent_id_bytes):
+        # Takes the raw torrent id from a hello request
+        with self.lock:
+            return self._chunk_managers.get(bytes(torrent_id_bytes))
+
+    def chunk_managers(self):
+        with self.lock:
+            return list(self._chunk_managers.values())
+
+    def __len__(self):
+        with self.lock:
+            return len(self._chunk_managers)
@@ -0,0 +1,225 @@
+import random
+import threading
+import time
+
+from utils.rate_estimator import RateEstimator
+
+# Seconds between reranking which peers get the regular upload slots
+RECHOKE_INTERVAL = 10
+# Seconds before the optimistic unchoke moves on to another choked peer
+OPTIMISTIC_INTERVAL = 30
+# Seconds after a choke is sent that piece requests the peer had already sent are still answered
+CHOKE_GRACE = 5
+
+
+class UploadPeer:
+    def __init__(self, ip, on_choke, address):
+        self.ip = ip
+        self.address = address
+        self.on_choke = on_choke
+        self.is_choked = False
+        # When the last choke was sent, requests arriving long after it are refused
+        self.choked_at = None
+        self.upload_rate = RateEstimator()
+
+
+# Decides which version 2 upload connections are allowed to send piece requests
+#
+# All but one of the upload slots go to the peers we download from the
+# fastest (tit-for-tat), falling back to the ones we upload to the fastest
+# once nothing is coming back, as a seed does. The last slot is an optimistic
+# unchoke that rotates through the choked peers so new peers get a chance to
+# prove themselves. Download rates are kept by IP since upload connections
+# don't know the remote peer id. Version 1 peers can't be choked and are
+# always served outside of the slots. Wakeups added with add_wakeup are set
+# whenever a slot frees up, so the choker can hand it out right away, and when
+# the first peer registers, since the choker sleeps while there are none.
+#
+# Connections check may_request before serving a piece. A choked peer is
+# still answered for choke_grace seconds after its choke went out, which
+# covers the requests it pipelined before seeing the choke, and refused after
+# that.
+class UploadScheduler:
+    def __init__(
+        self,
+        upload_slots=4,
+        rechoke_interval=RECHOKE_INTERVAL,
+        optimistic_interval=OPTIMISTIC_INTERVAL,
+        choke_grace=CHOKE_GRACE,
+    ):
+        self.upload_slots = upload_slots
+        self.rechoke_interval = rechoke_interval
+        self.optimistic_interval = optimistic_interval
+        self.choke_grace = choke_grace
+        self.lock = threading.Lock()
+        self._peers = {}
+        self._download_rates = {}
+        self._optimistic_key = None
+        self._next_rechoke = 0
+        self._next_optimistic = 0
+        self._wakeups = []
+
+    def add_wakeup(self, wakeup):
+        with self.lock:
+            self._wakeups.append(wakeup)
+
+    def remove_wakeup(self, wakeup):
+        with self.lock:
+            self._wakeups.remove(wakeup)
+
+    def record_download(self, ip, length):
+        # Credits a peer for a piece it sent us
+        with self.lock:
+            if (download_rate := self._download_rates.get(ip)) is None:
+                download_rate = self._download_rates[ip] = RateEstimator()
+        download_rate.add(length)
+
+    def record_upload(self, key, length):
+        with self.lock:
+            peer = self._peers.get(key)
+        if peer is not None:
+            peer.upload_rate.add(length)
+
+    def register(self, key, ip, on_choke, address=None):
+        # Adds a connection and returns whether it starts out choked, on_choke is called on every change after
+        with self.lock:
+            peer = UploadPeer(ip, on_choke, address or ip)
+            peer.is_choked = 0 < self.upload_slots <= self._unchoked_count()
+            if peer.is_choked:
+                peer.choked_at = time.monotonic()
+            self._peers[key] = peer
+
+            # Wakes the choker, which has nothing to schedule until the first peer arrives
+            if len(self._peers) == 1:
+                for wakeup in self._wakeups:
+                    wakeup.set()
+            return peer.is_choked
+
+    def unregister(self, key):
+        with self.lock:
+            peer = self._peers.pop(key, None)
+            if self._optimistic_key == key:
+                self._optimistic_key = None
+
+            # Wakes the choker when a slot frees up
+            if peer is not None and not peer.is_choked:
+                for wakeup in self._wakeups:
+                    wakeup.set()
+
+    def tick(self):
+        # Reranks the slots when due and otherwise hands free slots to choked peers,
+        # callbacks are run outside of the lock so they can queue messages on their connection
+        if self.upload_slots == 0:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if now >= self._next_rechoke:
+                self._next_rechoke = now + self.rechoke_interval
+                self._forget_idle_ips()
+                unchoked = self._pick_unchoked(now)
+            else:
+                unchoked = {key for key, peer in self._peers.items() if not peer.is_choked}
+                free_slots = self.upload_slots - len(unchoked)
+                if free_slots <= 0:
+                    return
+                for key in self._ranked_keys():
+                    if free_slots == 0:
+                        break
+                    if key not in unchoked:
+                        unchoked.add(key)
+                        free_slots -= 1
+
+            changes = []
+            for key, peer in self._peers.items():
+                if peer.is_choked != (key not in unchoked):
+                    peer.is_choked = key not in unchoked
+                    peer.choked_at = now if peer.is_choked else None
+                    changes.append((peer.on_choke, peer.is_choked))
+
+        for on_choke, is_choked in changes:
+            on_choke(is_choked)
+
+    def choke_sent(self, key):
+        # Restarts the grace period once the connection actually sent the choke, it may have waited behind a piece
+        with self.lock:
+            peer = self._peers.get(key)
+            if peer is not None and peer.is_choked:
+                peer.choked_at = time.monotonic()
+
+    def may_request(self, key):
+        # Whether a piece request on the connection may be served, unregistered version 1 peers always are
+        with self.lock:
+            peer = self._peers.get(key)
+            return (
+                peer is None
+                or not peer.is_choked
+                or time.monotonic() - peer.choked_at < self.choke_grace
+            )
+
+    def next_tick_delay(self):
+        # Seconds until the slots are due to be reranked, None when uploads are never choked or nobody is connected
+        if self.upload_slots == 0:
+            return None
+        with self.lock:
+            if not self._peers:
+                return None
+            return max(self._next_rechoke - time.monotonic(), 0)
+
+    def peers(self):
+        # Snapshot of the upload connections for logging and monitoring
+        with self.lock:
+            return [
+                {
+                    "ip": peer.ip,
+                    "address": peer.address,
+                    "choked": peer.is_choked,
+                    "optimistic": key == self._optimistic_key,
+                    "upload_rate": peer.upload_rate.rate(),
+                    "download_rate": self._download_rate(peer.ip),
+                }
+                for key, peer in self._peers.items()
+            ]
+
+    def _pick_unchoked(self, now):
+        ranked = self._ranked_keys()
+        unchoked = set(ranked[: self.upload_slots - 1])
+
+        # Rotates the optimistic unchoke on its own timer, or sooner if its peer left or earned a regular slot
+        if (
+            now >= self._next_optimistic
+            or self._optimistic_key not in self._peers
+            or self._optimistic_key in unchoked
+        ):
+            self._next_optimistic = now + self.optimistic_interval
+            choked = [key for key in ranked if key not in unchoked]
+            self._optimistic_key = random.choice(choked) if choked else None
+        if self._optimistic_key is not None:
+            unchoked.add(self._optimistic_key)
+        return unchoked
+
+    def _ranked_keys(self):
+        return sorted(
+            self._peers,
+            key=lambda key: (
+                self._download_rate(self._peers[key].ip),
+                self._peers[key].upload_rate.rate(),
+            ),
+            reverse=True,
+        )
+
+    def _forget_idle_ips(self):
+        # Drops download rates of peers that stopped sending to us long ago
+        connected_ips = {peer.ip for peer in self._peers.values()}
+        for ip in [
+            ip
+            for ip, download_rate in self._download_rates.items()
+            if ip not in connected_ips and download_rate.rate() < 1
+        ]:
+            del self._download_rates[ip]
+
+    def _download_rate(self, ip):
+        download_rate = self._download_rates.get(ip)
+        return download_rate.rate() if download_rate is not None else 0.0
+
+    def _unchoked_count(self):
+        return sum(not peer.is_choked for peer in self._peers.values())
@@ -0,0 +1,78 @@
+import os
+import math
+import select
+import selectors
+import threading
+
+
+# An Event that can also be waited on with select, together with sockets and other wakeups
+#
+# Setting it makes its file descriptor readable until it is cleared, so a
+# thread blocked in select on a socket wakes up the moment another thread has
+# news for it instead of polling on a timeout. Uses an eventfd where the
+# platform has one and a pipe everywhere else.
+class Wakeup(threading.Event):
+    def __init__(self):
+        super().__init__()
+        self._fd_lock = threading.Lock()
+        if hasattr(os, "eventfd"):
+            self._read_fd = self._write_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._read_fd, self._write_fd = os.pipe()
+            os.set_blocking(self._read_fd, False)
+            os.set_blocking(self._write_fd, False)
+
+    def fileno(self):
+        return self._read_fd
+
+    def set(self):
+        # Only the first set writes, later ones find the descriptor already readable
+        with self._fd_lock:
+            if not self.is_set() and self._write_fd >= 0:
+                os.write(self._write_fd, (1).to_bytes(8, "little"))
+            super().set()
+
+    def clear(self):
+        with self._fd_lock:
+            if not self.is_set():
+                return
+            super().clear()
+            if self._read_fd >= 0:
+                try:
+                    os.read(self._read_fd, 8 if self._read_fd == self._write_fd else 4096)
+                except BlockingIOError:
+                    pass
+
+    def close(self):
+        # Leaves invalid descriptors behind so a late set only flips the flag
+        with self._fd_lock:
+            read_fd, write_fd = self._read_fd, self._write_fd
+            self._read_fd = self._write_fd = -1
+        if read_fd >= 0:
+            os.close(read_fd)
+        if write_fd >= 0 and write_fd != read_fd:
+            os.close(write_fd)
+
+
+# Blocks until one of the sockets or wakeups is readable or the timeout passes, None waits forever
+#
+# Uses poll, which unlike select takes descriptors numbered past FD_SETSIZE, as
+# a busy seed or the daemon soon has. Platforms without poll go through
+# selectors instead.
+def wait_any(waitables, timeout=None):
+    if timeout is not None:
+        timeout = max(timeout, 0)
+    if not hasattr(select, "poll"):
+        with selectors.DefaultSelector() as selector:
+            for waitable in waitables:
+                selector.register(waitable, selectors.EVENT_READ)
+            return [key.fileobj for key, _ in selector.select(timeout)]
+
+    poller = select.poll()
+    by_fd = {}
+    for waitable in waitables:
+        by_fd[waitable.fileno()] = waitable
+        poller.register(waitable, select.POLLIN)
+    # Rounds up so a timeout under a millisecond doesn't turn into a busy loop
+    events = poller.poll(None if timeout is None else math.ceil(timeout * 1000))
+    return [by_fd[fd] for fd, _ in events]